@@ -0,0 +1,140 @@
+/*
+Canvas module for the delta encoded frames sent by overload_canvas_grid.CanvasGrid.
+
+The static layer (restriction matrix) arrives with every keyframe, and is drawn on one
+offscreen canvas per layer. Every frame then only updates the cells that changed,
+and the canvas is drawn by blitting each static layer and drawing the agents of
+that layer on top of it, in layer order.
+*/
+
+const CanvasDeltaModule = function (
+  canvas_width,
+  canvas_height,
+  grid_width,
+  grid_height
+) {
+  const createElement = (tagName, attrs) => {
+    const element = document.createElement(tagName);
+    Object.assign(element, attrs);
+    return element;
+  };
+
+  // Create the element
+  // ------------------
+  //
+  const parent = createElement("div", {
+    style: `height:${canvas_height}px;`,
+    className: "world-grid-parent",
+  });
+
+  // Create the tag with absolute positioning :
+  const createCanvas = () => {
+    const el = createElement("canvas", {
+      width: canvas_width,
+      height: canvas_height,
+      className: "world-grid",
+    });
+    return el;
+  };
+  const canvas = createCanvas();
+  const interaction_canvas = createCanvas();
+
+  // Append it to parent:
+  parent.appendChild(canvas);
+  parent.appendChild(interaction_canvas);
+
+  // Append it to #elements
+  const elements = document.getElementById("elements");
+  elements.appendChild(parent);
+
+  // Create the context for the agents and interactions and the drawing controller:
+  const context = canvas.getContext("2d");
+
+  // Create an interaction handler using the
+  const interactionHandler = new InteractionHandler(
+    canvas_width,
+    canvas_height,
+    grid_width,
+    grid_height,
+    interaction_canvas.getContext("2d")
+  );
+  const canvasDraw = new GridVisualization(
+    canvas_width,
+    canvas_height,
+    grid_width,
+    grid_height,
+    context,
+    interactionHandler
+  );
+
+  // Session state: palette of styles, static layers, agents by cell, and last frame
+  let styles = {};
+  let staticLayers = {};
+  let cells = new Map();
+  let frame = null;
+
+  // GridVisualization modifies the portrayals it draws, so a new one is built every time
+  const portrayal = (style, index) =>
+    Object.assign({}, styles[style], {
+      x: index % grid_width,
+      y: Math.floor(index / grid_width),
+    });
+
+  const drawStatic = (data) => {
+    const layers = {};
+    data.values.forEach((value, index) => {
+      const style = data.styles[value];
+      if (style === undefined) return;
+      const p = portrayal(style, index);
+      (layers[p.Layer] ??= []).push(p);
+    });
+    staticLayers = {};
+    for (const layer in layers) {
+      const offscreen = createCanvas();
+      new GridVisualization(
+        canvas_width,
+        canvas_height,
+        grid_width,
+        grid_height,
+        offscreen.getContext("2d"),
+        null
+      ).drawLayer(layers[layer]);
+      staticLayers[layer] = offscreen;
+    }
+  };
+
+  this.render = (data) => {
+    Object.assign(styles, data.styles);
+    if (data.static) drawStatic(data.static);
+    if (data.base === null) cells = new Map();
+    else if (data.base !== frame) return; // a frame was missed, wait for next keyframe
+    for (const [index, cellStyles] of data.cells) {
+      if (cellStyles.length) cells.set(index, cellStyles);
+      else cells.delete(index);
+    }
+    frame = data.frame;
+
+    const layers = {};
+    for (const [index, cellStyles] of cells) {
+      for (const style of cellStyles) {
+        const p = portrayal(style, index);
+        (layers[p.Layer] ??= []).push(p);
+      }
+    }
+    const layerKeys = new Set([...Object.keys(staticLayers), ...Object.keys(layers)]);
+    canvasDraw.resetCanvas();
+    for (const layer of [...layerKeys].sort((a, b) => a - b)) {
+      if (staticLayers[layer]) context.drawImage(staticLayers[layer], 0, 0);
+      if (layers[layer]) canvasDraw.drawLayer(layers[layer]);
+    }
+    canvasDraw.drawGridLines("#eee");
+  };
+
+  this.reset = () => {
+    canvasDraw.resetCanvas();
+    styles = {};
+    staticLayers = {};
+    cells = new Map();
+    frame = null;
+  };
+};
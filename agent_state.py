@@ -0,0 +1,104 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+from array import array
+from operator import attrgetter
+from types import SimpleNamespace
+
+import numpy as np
+
+
+# state of every agent of a kind, owned by the model (see TrafficModel.vehicle_state and
+# TrafficModel.traffic_light_state), as one typed column per attribute instead of a Python
+# object per value. Columns are array.array, growing by one value when an agent is created,
+# and agents only keep their index into them. Positions are stored as flat grid indexes,
+# x * width + y, -1 when not placed on the grid (kept by OccupancyGrid)
+class AgentState:
+
+    def __init__(self, model, **typecodes):
+        self.model = model
+        self.typecodes = dict(unique_id='q', position='q', **typecodes)
+        for name, typecode in self.typecodes.items():
+            setattr(self, name, array(typecode))
+
+    def __len__(self):
+        return len(self.unique_id)
+
+    # appends a new agent, returning its index
+    def add(self, **values):
+        index = len(self)
+        for name in self.typecodes:
+            getattr(self, name).append(values.get(name, -1 if name == 'position' else 0))
+        return index
+
+    # appends count agents at once, from a sequence of values per column (columns not given get
+    # the default values of add), returning the index of the first one
+    def extend(self, count, **columns):
+        index = len(self)
+        for name, typecode in self.typecodes.items():
+            values = columns.get(name)
+            if values is None:
+                values = np.full(count, -1 if name == 'position' else 0)
+            getattr(self, name).frombytes(np.asarray(values, dtype=typecode).tobytes())
+        return index
+
+    # copy of a column as a NumPy array
+    def column(self, name):
+        return np.array(getattr(self, name))
+
+    # every column as a NumPy array sharing its memory, to update them in place. Columns can't
+    # grow while these views are alive
+    def arrays(self):
+        return SimpleNamespace(**{name: np.frombuffer(getattr(self, name), dtype=typecode)
+                                  for name, typecode in self.typecodes.items()})
+
+
+# agent attribute stored in a column of its AgentState (agent.store), read through its index
+# (optionally converted, like flags stored as bytes)
+def state_attribute(name, convert=None):
+    column = attrgetter(name)
+    if convert is None:
+        def get(agent):
+            return column(agent.store)[agent.index]
+    else:
+        def get(agent):
+            return convert(column(agent.store)[agent.index])
+
+    def set(agent, value):
+        column(agent.store)[agent.index] = value
+    return property(get, set)
+
+
+# slotted stand-in of mesa.Agent, for agents whose state is kept in an AgentState: an agent is
+# just its model, its store and index in it, and its grid position, without a __dict__
+# (subclasses declare empty __slots__, and their attributes with state_attribute)
+class StateAgent:
+    __slots__ = ('model', 'store', 'index', 'pos')
+    unique_id = state_attribute('unique_id')
+
+    def __init__(self, store, **values):
+        self.model = store.model
+        self.store = store
+        self.index = store.add(**values)
+        self.pos = None
+
+    # agent viewing an index already in store (see AgentState.extend), without adding values
+    @classmethod
+    def view(cls, store, index):
+        agent = cls.__new__(cls)
+        agent.model = store.model
+        agent.store = store
+        agent.index = index
+        agent.pos = None
+        return agent
+
+    @property
+    def random(self):
+        return self.store.model.random
+
+    def step(self):
+        pass
+
+    def advance(self):
+        pass
@@ -2,29 +2,36 @@
 Author: Enrique Vilchez Campillejo
 """
 
-import mesa
-import random
-
-import agents
-
-
-class TrafficLightAgent(mesa.Agent):
-    def __init__(self, unique_id, model, pos):
-        super().__init__(unique_id, model)
-        self.time_green = random.randint(1, 10)
-        self.time_red = random.randint(1, 10)
-        self.time_green_counter = self.time_green
-        self.time_red_counter = 0
+from agent_state import StateAgent, state_attribute
+
+
+class TrafficLightAgent(StateAgent):
+    # state is kept in the columns of model.traffic_light_state (see agent_state.AgentState),
+    # a traffic light is just a view of its index there. Traffic lights are not stepped one by
+    # one, the model light controller decides all of them at once (see light_controllers)
+    __slots__ = ()
+    time_green = state_attribute('time_green')
+    time_red = state_attribute('time_red')
+    time_green_counter = state_attribute('time_green_counter')
+    time_red_counter = state_attribute('time_red_counter')
+
+    def __init__(self, unique_id, model, pos, time_green=None, time_red=None):
+        # random green and red times, unless already drawn (all at once) by the model
+        time_green = model.random.randint(1, 10) if time_green is None else time_green
+        time_red = model.random.randint(1, 10) if time_red is None else time_red
+        super().__init__(model.traffic_light_state, unique_id=unique_id, time_green=time_green,
+                         time_red=time_red, time_green_counter=time_green, time_red_counter=0)
 
     def state(self):
         state = True  # True is green, False is red
-        if self.time_red_counter > 0:
+        if self.store.time_red_counter[self.index] > 0:
             state = False
         return state
 
     # checks if there are any vehicles in the actual position of self traffic light,
     # and in adjacent corners located in the direction of actual position. In case of any
     # vehicles located in any of described positions, traffic light turns red, otherwise turns green
+    # (light_controllers.VehicleActuatedController for a single light, used by ActiveScheduler)
     def check_for_other_vehicles(self):
         actual_direction = self.model.get_direction(list(self.pos))
 
@@ -39,76 +46,74 @@ class TrafficLightAgent(mesa.Agent):
         second_adjacent = [aux[0] + pos_x_second_corner[actual_direction], aux[1] + pos_y_second_corner[actual_direction]]
         in_limits = (first_adjacent[0] in range(self.model.height) and first_adjacent[1] in range(self.model.width)) and \
                         (second_adjacent[0] in range(self.model.height) and second_adjacent[1] in range(self.model.width))
-        vehicle_in_actual_cell = self.model.grid.get_cell_list_contents([tuple(aux)])
-        if in_limits and any(isinstance(a, agents.VehicleAgent) for a in vehicle_in_actual_cell):
-            cellmates_first = self.model.grid.get_cell_list_contents([tuple(first_adjacent)])
-            cellmates_second = self.model.grid.get_cell_list_contents([tuple(second_adjacent)])
-            if (any(isinstance(a, agents.VehicleAgent) for a in cellmates_first) or \
-            any(isinstance(a, agents.VehicleAgent) for a in cellmates_second)):
+        grid = self.model.grid
+        if in_limits and grid.has_vehicle(aux):
+            if grid.has_vehicle(first_adjacent) or grid.has_vehicle(second_adjacent):
                 self.time_red_counter = 1
                 self.time_green_counter = 0
             else:
                 self.time_red_counter = 0
                 self.time_green_counter = 1
 
-    def step(self):
-        if self.model.third_scenario:
-            self.check_for_other_vehicles()
-        else:
-            self.random_time()
-
-    # allows to turn self traffic light into red, by random waiting time. While self is red,
-    # it isn't green, and viceversa
-    def random_time(self):
+    # jumps straight to the next phase, like light_controllers.FixedTimeController does when its
+    # counter gets to 0, and returns the steps it lasts (used by scheduler.ActiveScheduler, to
+    # skip the steps in between)
+    def change_phase(self):
         if self.time_red_counter == 0:
-            self.time_green_counter = max(0, self.time_green_counter - 1)
-            if self.time_green_counter == 0:
-                self.time_red_counter = self.time_red
-        else:
-            self.time_red_counter = max(0, self.time_red_counter - 1)
-            if self.time_red_counter == 0:
-                self.time_green_counter = self.time_green
+            self.time_green_counter = 0
+            self.time_red_counter = self.time_red
+            return self.time_red
+        self.time_red_counter = 0
+        self.time_green_counter = self.time_green
+        return self.time_green
 
 
-class VehicleAgent(mesa.Agent):
+class VehicleAgent(StateAgent):
     """A vehicle agent with fixed ."""
+    # state is kept in the columns of model.vehicle_state (see agent_state.AgentState), a
+    # vehicle is just a view of its index there
+    __slots__ = ()
+    waiting_for_cars = state_attribute('waiting_for_cars')
+    waiting_traffic_lights = state_attribute('waiting_traffic_lights')
+    counter_parking = state_attribute('counter_parking')
+    parking = state_attribute('parking', bool)
 
     def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
         # starts at bottom left cell, like specified in mesa Docs,
         # MultiGrid has position [0, 0] in the bottom-left, and
         # [width-1, height-1] in the top-right
-        self.waiting_for_cars = 0
-        self.waiting_traffic_lights = 0
-        self.counter_parking = self.model.max_waiting_time_non_transitable_in_steps
-        self.parking = False
+        super().__init__(model.vehicle_state, unique_id=unique_id, waiting_for_cars=0,
+                         waiting_traffic_lights=0,
+                         counter_parking=model.max_waiting_time_non_transitable_in_steps, parking=False)
 
     def move(self):
-        direction = self.model.get_direction(self.pos)
-        possible_steps = self.model.grid.get_neighborhood(
-            self.pos, moore=False, include_center=False
-        )
         # check for traffic lights in actual self.pos
         traffic_light, state = self.traffic_light()
         # code can keep going checking if vehicle can move,
         # if there is not a traffic light, or there is one but is green
         if not traffic_light or (traffic_light and state):
-            definitive_possible_steps = self.obtain_possible_steps_from_restriction_matrix(direction, possible_steps)
+            # copied, because vehicle_in_front discards the options it has already tried
+            definitive_possible_steps = list(self.model.possible_steps(self.pos))
             if definitive_possible_steps:
-                new_position = random.choice(definitive_possible_steps)
+                new_position = self.random.choice(definitive_possible_steps)
                 # if adjacent random chosen cell is transitable and self vehicle is not parking
                 if self.model.is_transitable(new_position) and not self.parking:
                     self.vehicle_in_front(definitive_possible_steps, new_position)
                 elif self.counter_parking > 0:  # this allows vehicle to park in same cell it found next non
                     # transitable cell, and stays there for certain amount of time, and then try to find another
                     # direction same way as normally
+                    if not self.parking:
+                        self.count('parking_events')
+                        heatmap = self.model.heatmap
+                        if heatmap is not None:
+                            heatmap.parking[self.store.position[self.index]] += 1
                     self.counter_parking = max(0, self.counter_parking - 1)
                     self.parking = True
                 elif self.counter_parking == 0:
                     self.counter_parking = self.model.max_waiting_time_non_transitable_in_steps
                     self.parking = False
         elif traffic_light and not state:  # there is a traffic light, and it's red
-            self.waiting_traffic_lights += 1
+            self.wait_for_traffic_light()
 
     # checks if some vehicles in adjacent cell, and if it is the case, tries to
     # choose another option. If none exist, then vehicle is considered waiting for another
@@ -117,82 +122,68 @@ class VehicleAgent(mesa.Agent):
     # directions for cells, it would be interesting testing it in proper enviroments)
     def vehicle_in_front(self, definitive_possible_steps, new_position):
         if not self.vehicle(new_position):
-            self.model.grid.move_agent(self, tuple(new_position))
+            self.move_to(new_position)
+            self.count('moves')
         elif self.model.second_scenario:  # only if second scenario activated, then checking the rest is usefull
             definitive_possible_steps.remove(new_position)
             moved = False
             for possible in definitive_possible_steps:
                 if self.model.is_transitable(possible) and not self.vehicle(possible):
-                    self.model.grid.move_agent(self, tuple(possible))
+                    self.move_to(possible)
                     moved = True
                     self.model.counter += 1
-                    print(self.model.counter)
+                    self.count('moves')
+                    self.count('detours')
                     break
                 else:
                     definitive_possible_steps.remove(possible)
             if not moved:
-                self.waiting_for_cars += 1
+                self.wait_for_cars()
         else:
-            self.waiting_for_cars += 1
-
-    # method for vehicle to not go in the oposite direction
-    def check_oposite_direction(self, pos, direction):
-        oposite_direction = False
-        # 0 is right, checking left, 1 is down, checking up, etc
-        pos_x = [0, 1, 0, -1]
-        pos_y = [-1, 0, 1, 0]
-
-        aux = list(self.pos)
-        pos_to_check = [aux[0] + pos_x[direction], aux[1] + pos_y[direction]]
-        if pos_to_check == pos:
-            oposite_direction = True
-
-        return oposite_direction
-
-    # check adjacent possible steps from a certain position. Specifically, not oposite directions
-    # are allowed, nor adjacent cell that crosses actual one, or same directions. Neither allowed
-    # positions that are outside restriction matrix
-    def obtain_possible_steps_from_restriction_matrix(self, direction, possible_steps):
-        definitive_possible_steps = []
-        for adjacent_position in possible_steps:
-            aux = list(adjacent_position)
-            aux2 = list(self.pos)
-            adjacent_direction = self.model.get_direction(aux)
-            # needed to put it here, DON'T PUT IT BEFORE
-            aux[0] = self.model.height - aux[0] - 1
-            aux2[0] = self.model.height - aux2[0] - 1
-            _, crossing_from_adjacent_from_pos = self.model.crossing_adjacent(aux2)
-            _, crossing_from_adjacent = self.model.crossing_adjacent(aux)
-            crossing_from_adjacent_from_pos_bool = (crossing_from_adjacent_from_pos == aux)
-            # revert matrix adaptation, to adapt to grid, DON'T PUT IT BEFORE
-            aux[0] = abs(aux[0] - self.model.height + 1)
-            oposite_direction = self.check_oposite_direction(aux, direction)
-            if not oposite_direction and crossing_from_adjacent != aux2 and \
-                    abs(direction - adjacent_direction) not in (0, 2) or \
-                    crossing_from_adjacent_from_pos_bool:
-                if not self.model.check_limits(aux):
-                    definitive_possible_steps.append(aux)
-        return definitive_possible_steps
+            self.wait_for_cars()
+
+    # moves to pos, accumulating the occupancy of both cells first when the congestion
+    # heatmap is enabled
+    def move_to(self, pos):
+        heatmap = self.model.heatmap
+        if heatmap is not None:
+            heatmap.moved(self.store.position[self.index], pos[0] * self.model.width + pos[1])
+        self.model.grid.move_agent(self, tuple(pos))
+
+    # waiting times are also summed up to the model totals, read by the reporters, and to the
+    # cell of the vehicle in the congestion heatmap, when enabled
+    def wait_for_cars(self):
+        self.store.waiting_for_cars[self.index] += 1
+        self.model.waiting_for_cars += 1
+        self.count('blocked_moves')
+        heatmap = self.model.heatmap
+        if heatmap is not None:
+            heatmap.blocked[self.store.position[self.index]] += 1
+
+    def wait_for_traffic_light(self):
+        self.store.waiting_traffic_lights[self.index] += 1
+        self.model.waiting_traffic_lights += 1
+        self.count('red_light_waits')
+        heatmap = self.model.heatmap
+        if heatmap is not None:
+            heatmap.red_light[self.store.position[self.index]] += 1
+
+    # counts an event in the model instrumentation, only if it is enabled
+    def count(self, counter):
+        instrumentation = self.model.instrumentation
+        if instrumentation is not None:
+            instrumentation.count(counter)
 
     # checks if vehicle is in certain positions
     def vehicle(self, pos):
-        vehicle = False
-        cellmates = self.model.grid.get_cell_list_contents([tuple(pos)])
-        for a in cellmates:
-            if type(a) is agents.VehicleAgent:
-                vehicle = True
-        return vehicle
+        return self.model.grid.has_vehicle(pos)
 
     # check for the state of a certain traffic light
     def traffic_light(self):
-        traffic_light = False
-        state = False
-        cellmates = self.model.grid.get_cell_list_contents([self.pos])
-        for a in cellmates:
-            if type(a) is agents.TrafficLightAgent:
-                traffic_light = True
-                state = a.state()
-        return traffic_light, state
+        traffic_light = self.model.grid.traffic_light_at(self.pos)
+        if traffic_light is None:
+            return False, False
+        return True, traffic_light.state()
 
     def step(self):
         self.move()
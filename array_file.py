@@ -0,0 +1,65 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import json
+
+import numpy as np
+
+
+# File of named NumPy arrays, memory mapped when read (used by checkpoints and compiled road
+# networks): MAGIC, the length of a JSON header (8 bytes, little endian), the header (with the
+# dtype, shape and offset of every array), and then the arrays, each one aligned to ALIGNMENT
+# bytes, so they are mapped as they are instead of being read and parsed
+MAGIC = b'TRAFFIC1'
+ALIGNMENT = 64
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+# numpy scalars (like counters of the engines) as plain Python values
+def to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def write_arrays(path, header, arrays):
+    header = dict(header, arrays={})
+    offset = 0
+    for name, values in arrays.items():
+        header['arrays'][name] = {'dtype': values.dtype.str, 'shape': values.shape, 'offset': offset}
+        offset = align(offset + values.nbytes)
+    encoded = json.dumps(header, default=to_json).encode()
+    data_start = align(len(MAGIC) + 8 + len(encoded))
+    with open(path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(len(encoded).to_bytes(8, 'little'))
+        file.write(encoded)
+        for name, values in arrays.items():
+            file.seek(data_start + header['arrays'][name]['offset'])
+            # written from the array buffer, so memory mapped arrays are not copied in memory first
+            file.write(np.ascontiguousarray(values).data)
+
+
+# header and arrays of a file, memory mapped with mode (copy-on-write by default, 'r' for
+# read only)
+def read_arrays(path, mode='c'):
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a traffic model array file' % path)
+        length = int.from_bytes(file.read(8), 'little')
+        header = json.loads(file.read(length))
+    data_start = align(len(MAGIC) + 8 + length)
+    arrays = {}
+    for name, description in header.pop('arrays').items():
+        dtype, shape = np.dtype(description['dtype']), tuple(description['shape'])
+        if dtype.itemsize * int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            # plain arrays on the memory map, indexing a np.memmap is much slower
+            arrays[name] = np.asarray(np.memmap(path, dtype=dtype, mode=mode,
+                                                offset=data_start + description['offset'], shape=shape))
+    return header, arrays
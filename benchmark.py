@@ -0,0 +1,187 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+from multiprocessing import Pool
+
+from model import TrafficModel
+
+SCENARIOS = {'first': (False, False), 'second': (True, False), 'third': (False, True)}
+
+# metrics where a higher value is a slowdown (the rest, steps per second, is the opposite)
+HIGHER_IS_WORSE = ('startup', 'generate_matrix', 'compile_routing_table', 'set_traffic_lights',
+                   'step_p50', 'step_p95', 'step_p99', 'render_first', 'render_mean', 'peak_memory')
+# metrics in seconds, whose changes under the noise floor are not regressions (see compare)
+TIMERS = tuple(metric for metric in HIGHER_IS_WORSE if metric != 'peak_memory')
+
+
+# times a method of the model into model.startup_times, for methods called inside __init__
+def timed(method):
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        vars(self).setdefault('startup_times', {})[method.__name__] = time.perf_counter() - start
+        return result
+    return wrapper
+
+
+class BenchmarkModel(TrafficModel):
+    generate_matrix = timed(TrafficModel.generate_matrix)
+    compile_routing_table = timed(TrafficModel.compile_routing_table)
+    set_traffic_lights = timed(TrafficModel.set_traffic_lights)
+
+
+def case_key(case):
+    return '{size}x{size} vehicles={vehicles}% non_transitable={non_transitable}% ' \
+           'scenario={scenario} engine={engine}'.format(**case)
+
+
+def make_model(case, steps):
+    second_scenario, third_scenario = SCENARIOS[case['scenario']]
+    with contextlib.redirect_stdout(io.StringIO()):
+        return BenchmarkModel(case['size'], case['size'], steps, case['non_transitable'],
+                              case['vehicles'], 2, second_scenario, third_scenario,
+                              engine=case['engine'], seed=case['seed'])
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+# runs a single case: startup time (and its phases), steps per second and per step latency
+# percentiles, CanvasGrid.render times (agents engine only, the other engines don't place
+# vehicles and lights on the grid it draws), and, in a second run traced by tracemalloc (which
+# slows allocations down), the peak memory of startup plus steps
+def run_case(args):
+    case, steps, frames = args
+    start = time.perf_counter()
+    model = make_model(case, steps)
+    startup = time.perf_counter() - start
+    startup_times = model.startup_times
+
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(steps):
+            start = time.perf_counter()
+            model.step()
+            latencies.append(time.perf_counter() - start)
+
+    render_times = []
+    if case['engine'] == 'agents':
+        with contextlib.redirect_stdout(io.StringIO()):
+            from model_viz import agent_portrayal
+        from overload_canvas_grid import CanvasGrid
+        grid = CanvasGrid(agent_portrayal, model.width, model.height)
+        for _ in range(frames):
+            start = time.perf_counter()
+            grid.render(model)
+            render_times.append(time.perf_counter() - start)
+            with contextlib.redirect_stdout(io.StringIO()):
+                model.step()
+
+    tracemalloc.start()
+    model = make_model(case, steps)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(steps):
+            model.step()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {'startup': startup, 'steps_per_second': steps / sum(latencies),
+              'step_p50': percentile(latencies, 50), 'step_p95': percentile(latencies, 95),
+              'step_p99': percentile(latencies, 99), 'peak_memory': peak_memory}
+    result.update(startup_times)
+    if render_times:
+        result['render_first'] = render_times[0]
+        result['render_mean'] = statistics.mean(render_times[1:] or render_times)
+    return case_key(case), result
+
+
+# every case of the sweep, run one by one repeat times, each in a new process so startup and
+# peak memory of a case are not affected by the previous ones. Every metric of a case is the
+# median of its repetitions
+def run_benchmark(sizes, vehicles, non_transitable, scenarios, engines, steps, frames, seed, repeat=1):
+    cases = [dict(size=size, vehicles=v, non_transitable=n, scenario=scenario, engine=engine, seed=seed)
+             for size, v, n, scenario, engine in itertools.product(sizes, vehicles, non_transitable,
+                                                                   scenarios, engines)]
+    runs = [(case, steps, frames) for case in cases for _ in range(repeat)]
+    repetitions = {}
+    with Pool(1, maxtasksperchild=1) as pool:
+        for key, result in pool.imap(run_case, runs):
+            repetitions.setdefault(key, []).append(result)
+    results = {}
+    for key, repeated in repetitions.items():
+        results[key] = {metric: statistics.median(result[metric] for result in repeated) for metric in repeated[0]}
+        print(key, ' '.join('%s=%.4g' % item for item in sorted(results[key].items())))
+    return {'python': platform.python_version(), 'machine': platform.machine(),
+            'steps': steps, 'repeat': repeat, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'cases': results}
+
+
+# compares results against a baseline, returning the metrics of every case that got worse
+# by more than threshold (relative, 0.2 is 20%). Timers (and the time of all the steps) that
+# got slower by less than noise_floor seconds are not regressions, for the ones taking a few
+# milliseconds, where scheduling noise alone is a large relative change
+def compare(results, baseline, threshold, noise_floor=0.01):
+    regressions = []
+    for key, result in results['cases'].items():
+        reference = baseline['cases'].get(key)
+        if reference is None:
+            continue
+        for metric, value in result.items():
+            base = reference.get(metric)
+            if not base:
+                continue
+            change = (value - base) / base
+            if metric not in HIGHER_IS_WORSE:
+                change = -change
+            if metric in TIMERS and value - base < noise_floor:
+                continue
+            if metric == 'steps_per_second' and results['steps'] / value - baseline['steps'] / base < noise_floor:
+                continue
+            if change > threshold:
+                regressions.append((key, metric, base, value, change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Performance benchmark of TrafficModel')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 100])
+    parser.add_argument('--vehicles', type=int, nargs='+', default=[5, 20])
+    parser.add_argument('--non-transitable', type=int, nargs='+', default=[10])
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--engines', nargs='+', default=['agents'], choices=['agents', 'vectorized'])
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--frames', type=int, default=10, help='CanvasGrid.render calls per case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of every case, compared by the median of every metric')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store results as the new baseline, instead of comparing against it')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown flagged as a regression (default 0.2, 20%%)')
+    parser.add_argument('--noise-floor', type=float, default=0.01,
+                        help='slowdown in seconds under which timers are not regressions (default 0.01)')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.vehicles, args.non_transitable, args.scenarios,
+                            args.engines, args.steps, args.frames, args.seed, args.repeat)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold, args.noise_floor)
+        for key, metric, base, value, change in regressions:
+            print('REGRESSION %s %s: %.4g -> %.4g (%+.0f%%)' % (key, metric, base, value, change * 100))
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,151 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+from array import array
+
+import numpy as np
+
+from array_file import read_arrays, write_arrays
+from model import TrafficModel
+from road_network import RoadNetwork
+from scheduler import ActiveScheduler
+
+
+# Checkpoints of a TrafficModel, to start simulations from an already warmed up state (or to
+# fork several what-if runs from the same one). A checkpoint is an array file (see
+# array_file.write_arrays) with a header of parameters, counters, random generator states and
+# collected data, and the arrays of the restriction matrix, traffic lights and vehicles, loaded
+# as copy-on-write memory maps instead of being read and parsed. The state is stored in the
+# same form for every engine, so a checkpoint can be restored with any of them
+VEHICLE_COLUMNS = ('position', 'waiting_for_cars', 'waiting_traffic_lights', 'counter_parking', 'parking')
+LIGHT_COUNTERS = ('time_green_counter', 'time_red_counter')
+# vehicles sleeping in ActiveScheduler (see ActiveScheduler.sleepers)
+SLEEPER_COLUMNS = ('sleeper_vehicle', 'sleeper_wakeup', 'sleeper_red_light_since')
+
+# parameters that define the map, which can't be changed when restoring
+MAP_PARAMETERS = ('width', 'height', 'non_transitable_cells', 'vehicles', 'restriction_matrix', 'traffic_lights',
+                  'road_network')
+
+
+# state of the vehicles introduced in the grid (in the order they were introduced) and of the
+# traffic light counters (in the order of model.traffic_light_state), as dicts of arrays,
+# plus the state of the random generator of the engine (None for the agents engine)
+def model_state(model):
+    if model.vectorized_engine is not None:
+        return model.vectorized_engine.state()
+    vehicles = {name: model.vehicle_state.column(name) for name in VEHICLE_COLUMNS}
+    lights = {name: model.traffic_light_state.column(name) for name in LIGHT_COUNTERS}
+    if type(model.schedule) is ActiveScheduler:
+        model.schedule.bring_up_to_date(vehicles, lights)
+    return vehicles, lights, None
+
+
+def save_checkpoint(model, path):
+    vehicles, lights, engine_random_state = model_state(model)
+    light_state = model.traffic_light_state
+    arrays = {
+        'restriction_matrix': np.asarray(model.restriction_matrix, dtype=np.int8),
+        'light_cell': light_state.column('position'),
+        'light_time_green': light_state.column('time_green'),
+        'light_time_red': light_state.column('time_red'),
+    }
+    arrays.update(('light_' + name, np.asarray(values)) for name, values in lights.items())
+    arrays.update(('vehicle_' + name, np.asarray(values)) for name, values in vehicles.items())
+    if type(model.schedule) is ActiveScheduler:
+        arrays.update(zip(SLEEPER_COLUMNS, model.schedule.sleepers()))
+    header = {
+        'parameters': {
+            'width': model.width,
+            'height': model.height,
+            'max_steps': model.max_steps,
+            'non_transitable_cells': model.non_transitable_cells_percentage,
+            'vehicles': model.vehicles_percentage,
+            'max_waiting_time_non_transitable_in_steps': model.max_waiting_time_non_transitable_in_steps,
+            'second_scenario': model.second_scenario,
+            'third_scenario': model.third_scenario,
+            'engine': model.engine,
+            'collect_interval': model.collect_interval,
+            'tiles': model.tiles,
+            'scheduler': model.scheduler,
+            'entry_cells': model.entry_cells,
+            'spawn_rate': model.spawn_rate,
+            'poisson_arrivals': model.poisson_arrivals,
+            'road_network': None if model.road_network is None else model.road_network.path,
+            'light_controller': model.light_controller.spec(),
+        },
+        'road_network_key': None if model.road_network is None else model.road_network.key,
+        'steps_counter': model.steps_counter,
+        'schedule_steps': model.schedule.steps,
+        'waiting_for_cars': model.waiting_for_cars,
+        'waiting_traffic_lights': model.waiting_traffic_lights,
+        'counter': model.counter,
+        'random_state': model.random.getstate(),
+        'engine_random_state': engine_random_state,
+        'spawner': model.spawner.state(),
+        'model_vars': model.datacollector.model_vars,
+    }
+    write_arrays(path, header, arrays)
+
+
+# restores the model saved in path. Any parameter of TrafficModel but the ones defining the map
+# can be overridden (like max_steps, the scenarios, the engine, or a sink). Without seed, the
+# model continues exactly like the saved one would have (with the same engine, and tiles when
+# sharded), and with a seed, it is a fork drawing from a new random generator
+def load_checkpoint(path, seed=None, **overrides):
+    fixed = [name for name in overrides if name in MAP_PARAMETERS]
+    if fixed:
+        raise ValueError('%s defined by the checkpoint, and can not be changed' % ', '.join(fixed))
+    header, arrays = read_arrays(path)
+    parameters = dict(header['parameters'], **overrides)
+    parameters['tiles'] = tuple(parameters['tiles'])
+    parameters['entry_cells'] = [tuple(pos) for pos in parameters['entry_cells']]
+    # maps loaded from a file are loaded again (from its compiled cache), if it didn't change
+    restriction_matrix = arrays['restriction_matrix']
+    if parameters['road_network'] is not None:
+        parameters['road_network'] = RoadNetwork(parameters['road_network'])
+        if parameters['road_network'].key != header['road_network_key']:
+            raise ValueError('map %s changed since the checkpoint was saved' % parameters['road_network'].path)
+        restriction_matrix = None
+    model = TrafficModel(**parameters, seed=seed, restriction_matrix=restriction_matrix,
+                         traffic_lights=(arrays['light_cell'], arrays['light_time_green'],
+                                         arrays['light_time_red']))
+
+    model.steps_counter = header['steps_counter']
+    model.schedule.steps = model.schedule.time = header['schedule_steps']
+    model.waiting_for_cars = header['waiting_for_cars']
+    model.waiting_traffic_lights = header['waiting_traffic_lights']
+    model.counter = header['counter']
+    model.datacollector.model_vars = header['model_vars']
+    # heatmaps count from the restored step (counters are not saved)
+    if model.heatmap is not None:
+        model.heatmap.attach(model)
+    vehicles = {name: arrays['vehicle_' + name] for name in VEHICLE_COLUMNS}
+    lights = {name: arrays['light_' + name] for name in LIGHT_COUNTERS}
+    if seed is None:
+        random_state = header['random_state']
+        model.random.setstate((random_state[0], tuple(random_state[1]), random_state[2]))
+    model.spawner.load_state(header['spawner'], seed is None)
+
+    if model.vectorized_engine is not None:
+        engine_random_state = None
+        saved = header['parameters']
+        if seed is None and parameters['engine'] == saved['engine'] and \
+                (parameters['engine'] != 'sharded' or parameters['tiles'] == tuple(saved['tiles'])):
+            engine_random_state = header['engine_random_state']
+        model.vectorized_engine.load_state(vehicles, lights, engine_random_state)
+        model.introduced_vehicles = len(vehicles['position'])
+        return model
+
+    light_state = model.traffic_light_state
+    for name in LIGHT_COUNTERS:
+        getattr(light_state, name)[:] = array(light_state.typecodes[name], lights[name].tolist())
+    if type(model.schedule) is ActiveScheduler:
+        model.schedule.reschedule_traffic_lights()
+    model.introduce(vehicles['position'].tolist())
+    vehicle_state = model.vehicle_state
+    for name in VEHICLE_COLUMNS[1:]:
+        getattr(vehicle_state, name)[:] = array(vehicle_state.typecodes[name], vehicles[name].astype(np.int64).tolist())
+    if type(model.schedule) is ActiveScheduler and SLEEPER_COLUMNS[0] in arrays:
+        model.schedule.load_sleepers(*(arrays[name] for name in SLEEPER_COLUMNS))
+    return model
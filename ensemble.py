@@ -0,0 +1,296 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import queue
+import tempfile
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from model import TrafficModel
+from road_network import RoadNetwork, write_map
+from sweep import make_runs
+
+METRICS = ("Total waiting time for vehicles", "Waiting time for vehicles in front", "Waiting time for traffic lights")
+
+
+# probability of |T| < t for the Student's t distribution with an integer amount df of degrees
+# of freedom, in closed form (Abramowitz and Stegun 26.7.3 and 26.7.4)
+def t_central(t, df):
+    theta = math.atan(t / math.sqrt(df))
+    cos2 = math.cos(theta) ** 2
+    term, total = 1.0, 1.0
+    if df % 2:
+        for k in range(3, df, 2):
+            term *= (k - 1) / k * cos2
+            total += term
+        return 2 / math.pi * (theta + (math.sin(theta) * math.cos(theta) * total if df > 1 else 0))
+    for k in range(4, df + 1, 2):
+        term *= (k - 3) / (k - 2) * cos2
+        total += term
+    return math.sin(theta) * total
+
+
+# quantile p of the Student's t distribution with df degrees of freedom, inverting the exact
+# distribution by bisection (the usual normal approximations are too small, so too narrow
+# intervals, for the few replications an ensemble starts with)
+def t_quantile(p, df):
+    if p < 0.5:
+        return -t_quantile(1 - p, df)
+    central = 2 * p - 1
+    low, high = 0.0, 1.0
+    while t_central(high, df) < central:
+        low, high = high, 2 * high
+    for _ in range(100):
+        middle = (low + high) / 2
+        if t_central(middle, df) < central:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+# running mean and variance of a metric (Welford's algorithm), and the confidence interval
+# of the mean
+class RunningStatistic:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.squares = 0.0  # sum of squared differences from the mean
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.squares += delta * (value - self.mean)
+
+    def std(self):
+        return math.sqrt(self.squares / (self.count - 1)) if self.count > 1 else math.nan
+
+    def half_width(self, confidence):
+        if self.count < 2:
+            return math.inf
+        return t_quantile((1 + confidence) / 2, self.count - 1) * self.std() / math.sqrt(self.count)
+
+
+# replications of a configuration: statistics of every metric, over the replications
+# accepted in order of index (results of later replications that finished first wait in
+# pending), so how long a replication takes never biases the stopping decision, and the
+# result is the same for any amount of processes
+class Configuration:
+    def __init__(self, index, parameters):
+        self.index = index
+        self.parameters = parameters
+        self.statistics = {metric: RunningStatistic() for metric in METRICS}
+        self.launched = 0
+        self.accepted = []  # metrics of the accepted replications
+        self.pending = {}
+        self.done = False
+        self.converged = False
+
+    def accept(self, replication, values):
+        self.pending[replication] = values
+
+    # accepts the next replication in order of index, if it has finished
+    def accept_next(self):
+        if len(self.accepted) not in self.pending:
+            return False
+        values = self.pending.pop(len(self.accepted))
+        for metric, value in zip(METRICS, values):
+            self.statistics[metric].add(value)
+        self.accepted.append(values)
+        return True
+
+    # whether the confidence intervals of metrics are within the precision: relative to the
+    # mean, or absolute if given
+    def precise(self, metrics, confidence, relative_precision, absolute_precision):
+        for statistic in (self.statistics[metric] for metric in metrics):
+            limit = absolute_precision if absolute_precision is not None else relative_precision * abs(statistic.mean)
+            if statistic.half_width(confidence) > limit:
+                return False
+        return True
+
+    def summary(self, confidence):
+        row = dict(self.parameters, Configuration=self.index, Replications=len(self.accepted),
+                   Converged=self.converged)
+        for metric, statistic in self.statistics.items():
+            half_width = statistic.half_width(confidence)
+            row[metric + ' mean'] = statistic.mean
+            row[metric + ' std'] = statistic.std()
+            row[metric + ' CI low'] = statistic.mean - half_width
+            row[metric + ' CI high'] = statistic.mean + half_width
+        return row
+
+
+# map of a map seed: the restriction matrix and traffic lights a model generates with that
+# seed (they only depend on the size and the non transitable cells), written to cache_dir
+# and compiled once (see road_network.RoadNetwork), for every replication sharing it
+def make_map(parameters, map_seed, cache_dir):
+    name = 'map_%dx%d_%s_%d.npy' % (parameters['height'], parameters['width'],
+                                    parameters['non_transitable_cells'], map_seed)
+    path = os.path.join(cache_dir, name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = TrafficModel(parameters['width'], parameters['height'], 0, parameters['non_transitable_cells'],
+                             0, 0, seed=map_seed)
+    write_map(path, model.restriction_matrix)
+    RoadNetwork(path)
+    light_state = model.traffic_light_state
+    return path, (light_state.column('position'), light_state.column('time_green'), light_state.column('time_red'))
+
+
+# road networks already loaded by this process, by path
+road_networks = {}
+
+
+# runs a replication until max_steps, and returns the final value of every metric
+def run_replication(task):
+    configuration, replication, parameters, seed, network = task
+    parameters = dict(parameters, seed=seed)
+    if network is not None:
+        path, traffic_lights = network
+        if path not in road_networks:
+            road_networks[path] = RoadNetwork(path)
+        parameters.update(road_network=road_networks[path], traffic_lights=traffic_lights)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = TrafficModel(**parameters)
+    for _ in range(model.max_steps):
+        model.step()
+    reporters = model.datacollector.model_reporters
+    return configuration, replication, [reporters[metric]() for metric in METRICS]
+
+
+# Adaptive Monte Carlo ensemble: runs replications of every configuration (dicts of
+# TrafficModel parameters) in a process pool (all cores by default), and stops each
+# configuration as soon as the confidence interval of the mean of every metric (waiting times
+# at max_steps) is within the precision, after min_replications and up to max_replications.
+# Only metrics are required to reach the precision, the rest are just tracked.
+# Replication r of every configuration runs with the same seed, derived from seed (common
+# random numbers, so configurations are compared on the same draws), on the map of a map seed:
+# its own seed by default (a new map every replication), or map_seeds[r % len(map_seeds)], so
+# estimates are over those maps. Every map is generated and compiled once, for all the
+# replications and configurations of that size sharing it (configurations with a road_network
+# use it instead). Returns a summary (a row per configuration) and the metrics of every
+# accepted replication
+def run_ensemble(configurations, confidence=0.95, relative_precision=0.05, absolute_precision=None,
+                 metrics=METRICS, min_replications=5, max_replications=100, map_seeds=None, seed=0,
+                 processes=None, cache_dir=None):
+    if min_replications < 2 or max_replications < min_replications:
+        raise ValueError('min_replications must be at least 2, and max_replications at least min_replications')
+    configurations = [Configuration(i, parameters) for i, parameters in enumerate(configurations)]
+    seeds = np.random.SeedSequence(seed).generate_state(max_replications, dtype=np.uint64).tolist()
+    temporary = None
+    if cache_dir is None:
+        temporary = tempfile.TemporaryDirectory()
+        cache_dir = temporary.name
+    maps = {}
+
+    def map_seed(replication):
+        return seeds[replication] if map_seeds is None else map_seeds[replication % len(map_seeds)]
+
+    def task(configuration):
+        replication = configuration.launched
+        configuration.launched += 1
+        parameters = configuration.parameters
+        network = None
+        if parameters.get('road_network') is None:
+            key = (parameters['width'], parameters['height'], parameters['non_transitable_cells'], map_seed(replication))
+            if key not in maps:
+                maps[key] = make_map(parameters, key[3], cache_dir)
+            network = maps[key]
+        return configuration.index, replication, parameters, seeds[replication], network
+
+    # amount replications to launch, in turns between the configurations still running (the
+    # ones with less replications waiting for a result first)
+    def next_tasks(amount):
+        tasks = []
+        while len(tasks) < amount:
+            running = [c for c in configurations if not c.done and c.launched < max_replications]
+            if not running:
+                break
+            running.sort(key=lambda c: c.launched - len(c.accepted))
+            tasks += [task(c) for c in running[:amount - len(tasks)]]
+        return tasks
+
+    def finish(configuration, replication, values):
+        configuration = configurations[configuration]
+        if configuration.done:
+            return
+        configuration.accept(replication, values)
+        # the stopping rule after every accepted replication, even when a result lets in others
+        # waiting for it
+        while not configuration.done and configuration.accept_next():
+            if len(configuration.accepted) >= min_replications and \
+                    configuration.precise(metrics, confidence, relative_precision, absolute_precision):
+                configuration.converged = configuration.done = True
+            elif len(configuration.accepted) >= max_replications:
+                configuration.done = True
+
+    try:
+        if processes == 1:
+            while not all(c.done for c in configurations):
+                for t in next_tasks(1):
+                    finish(*run_replication(t))
+        else:
+            workers = processes or os.cpu_count()
+            finished = queue.Queue()
+            in_flight = 0
+            with Pool(workers) as pool:
+                while not all(c.done for c in configurations):
+                    for t in next_tasks(workers - in_flight):
+                        pool.apply_async(run_replication, (t,), callback=finished.put, error_callback=finished.put)
+                        in_flight += 1
+                    result = finished.get()
+                    in_flight -= 1
+                    if isinstance(result, BaseException):
+                        raise result
+                    finish(*result)
+    finally:
+        road_networks.clear()
+        if temporary is not None:
+            temporary.cleanup()
+
+    summary = pd.DataFrame([c.summary(confidence) for c in configurations])
+    replications = pd.DataFrame(
+        [dict(Configuration=c.index, Replication=r, Seed=seeds[r],
+              **({'Map seed': map_seed(r)} if c.parameters.get('road_network') is None else {}),
+              **dict(zip(METRICS, values)))
+         for c in configurations for r, values in enumerate(c.accepted)])
+    return summary, replications
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adaptive Monte Carlo ensemble of TrafficModel configurations')
+    parser.add_argument('parameters', help='JSON file with TrafficModel parameters, single values or '
+                                           '{"sweep": [values]}, every combination is a configuration (like in sweep)')
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--relative-precision', type=float, default=0.05,
+                        help='half width of the confidence intervals, relative to the mean')
+    parser.add_argument('--absolute-precision', type=float, default=None)
+    parser.add_argument('--metrics', nargs='+', default=list(METRICS), choices=METRICS,
+                        help='metrics that must reach the precision')
+    parser.add_argument('--min-replications', type=int, default=5)
+    parser.add_argument('--max-replications', type=int, default=100)
+    parser.add_argument('--map-seeds', type=int, nargs='+', default=None,
+                        help='maps shared by the replications, in turns (a new map every replication by default)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None, help='defaults to all cores')
+    parser.add_argument('--output', default='ensemble.csv')
+    args = parser.parse_args()
+    with open(args.parameters) as f:
+        parameters = json.load(f)
+    configurations = [{name: value for name, value in run.items() if name != 'seed'}
+                      for run in make_runs(parameters, [None])]
+    summary, replications = run_ensemble(
+        configurations, args.confidence, args.relative_precision, args.absolute_precision, args.metrics,
+        args.min_replications, args.max_replications, args.map_seeds, args.seed, args.processes)
+    summary.to_csv(args.output, index=False)
+    root, extension = os.path.splitext(args.output)
+    replications.to_csv(root + '_replications' + extension, index=False)
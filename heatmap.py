@@ -0,0 +1,116 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+from collections import deque
+
+import numpy as np
+
+from metrics_sink import open_writer
+
+# counters of every cell: vehicles in the cell at the end of every step, steps vehicles waited
+# in the cell for a vehicle in front and for a red traffic light, and vehicles that started
+# parking in the cell
+COUNTERS = ('occupancy', 'blocked', 'red_light', 'parking')
+LABELS = {'occupancy': 'Occupancy steps', 'blocked': 'Blocked waits', 'red_light': 'Red light waits',
+          'parking': 'Parking events'}
+
+
+# Per cell congestion counters, kept by TrafficModel when enabled (TrafficModel(...,
+# heatmap=True) or an instance), updated by the vehicles as they move and wait: blocked and
+# red light waits and parking events are an increment in the cell of the vehicle, and
+# occupancy steps are accumulated lazily, only for the cells whose amount of vehicles changes
+# (see touch), so every move costs the same regardless of the grid size. Cells are flat grid
+# indexes, x * width + y, and snapshots are arrays of the restriction matrix shape.
+# Every interval steps, the counters so far are kept (the last history of them), to take
+# windowed or decayed snapshots on demand (see snapshot). Not available with the sharded engine
+class CongestionHeatmap:
+
+    def __init__(self, interval=100, history=100):
+        self.interval = interval
+        self.history = deque(maxlen=history)  # (step, counters) every interval steps
+        self.model = None
+
+    # starts counting from the current step of model (also when restoring a checkpoint, see
+    # checkpoint.load_checkpoint)
+    def attach(self, model):
+        self.model = model
+        n_cells = model.width * model.height
+        self.start = model.steps_counter
+        self.vehicle_count = model.grid.vehicle_count
+        self.occupancy = np.zeros(n_cells, dtype=np.int64)
+        self.occupancy_since = np.full(n_cells, self.start, dtype=np.int64)  # step occupancy is accumulated up to
+        self.blocked = np.zeros(n_cells, dtype=np.int64)
+        self.red_light = np.zeros(n_cells, dtype=np.int64)
+        self.parking = np.zeros(n_cells, dtype=np.int64)
+        self.history.clear()
+
+    # accumulates the occupancy of a cell (or an array of distinct cells) up to now, before
+    # the amount of vehicles in it changes in this step
+    def touch(self, cells):
+        step = self.model.steps_counter
+        self.occupancy[cells] += self.vehicle_count[cells] * (step - self.occupancy_since[cells])
+        self.occupancy_since[cells] = step
+
+    def moved(self, cell, new_cell):
+        self.touch(cell)
+        self.touch(new_cell)
+
+    # called by the model after every step
+    def step_done(self, step):
+        if step % self.interval == 0:
+            self.history.append((step, self.counters()))
+
+    # counters of every cell so far (flat arrays): occupancy up to now, and, with
+    # ActiveScheduler, the waits of vehicles still sleeping at red lights
+    def counters(self):
+        model = self.model
+        counters = {'occupancy': self.occupancy + self.vehicle_count * (model.steps_counter - self.occupancy_since),
+                    'blocked': self.blocked.copy(), 'red_light': self.red_light.copy(), 'parking': self.parking.copy()}
+        pending_red_light_waits = getattr(model.schedule, 'pending_red_light_waits', None)
+        if pending_red_light_waits is not None:
+            for cell, steps in pending_red_light_waits():
+                counters['red_light'][cell] += steps
+        return counters
+
+    # counters of every cell as arrays of the restriction matrix shape: since the beginning,
+    # or only the last window steps, or with exponential decay, the counts of half_life steps
+    # ago weighting half. Windows and decay are taken from the kept counters, so their
+    # resolution is interval steps (a window starts at the last kept counters at or before
+    # now - window), and their range, interval * history steps (ValueError for windows
+    # starting before the kept counters, unless they start before counting did)
+    def snapshot(self, window=None, half_life=None):
+        model = self.model
+        now = model.steps_counter
+        counters = self.counters()
+        if window is not None:
+            before = [kept for step, kept in self.history if step <= now - window]
+            if before:
+                counters = {name: values - before[-1][name] for name, values in counters.items()}
+            elif now - window > self.start:
+                raise ValueError('no counters kept at or before step %d (window of %d steps at step %d), they are '
+                                 'kept every %d steps, for the last %d times'
+                                 % (now - window, window, now, self.interval, self.history.maxlen))
+        elif half_life is not None:
+            decayed = {name: np.zeros(len(values), dtype=np.float64) for name, values in counters.items()}
+            previous = None
+            for step, kept in list(self.history) + [(now, counters)]:
+                weight = 0.5 ** ((now - step) / half_life)
+                for name, values in kept.items():
+                    decayed[name] += weight * (values if previous is None else values - previous[name])
+                previous = kept
+            counters = decayed
+        return {name: values.reshape(model.height, model.width)[::-1] for name, values in counters.items()}
+
+    # writes a snapshot (see snapshot) of the cells with any count: as a .npz of the arrays, or
+    # as rows (restriction matrix row and column, and counters) in any format of
+    # metrics_sink.open_writer
+    def export(self, path, window=None, half_life=None):
+        snapshot = self.snapshot(window, half_life)
+        if path.endswith('.npz'):
+            np.savez_compressed(path, **snapshot)
+            return
+        rows, columns = np.nonzero(sum(values != 0 for values in snapshot.values()))
+        writer = open_writer(path, ['Row', 'Column'] + [LABELS[name] for name in COUNTERS])
+        writer.write(zip(rows.tolist(), columns.tolist(), *(snapshot[name][rows, columns].tolist() for name in COUNTERS)))
+        writer.close()
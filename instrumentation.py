@@ -0,0 +1,46 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import contextlib
+import json
+import time
+
+PHASES = ('traffic_lights', 'vehicles', 'data_collection', 'rendering')
+COUNTERS = ('moves', 'blocked_moves', 'detours', 'red_light_waits', 'parking_events')
+
+
+# cumulative timers for every phase of a step, and counters of the vehicle events. It is
+# turned on by giving it to TrafficModel (TrafficModel(..., instrumentation=True) or an
+# instance), or setting model.instrumentation, and off by setting it back to None: the hot
+# loop only checks for None, so it costs nearly nothing when disabled. Every dump_interval
+# steps (if given) a JSON line with the snapshot is written through output
+class Instrumentation:
+
+    def __init__(self, dump_interval=None, output=print):
+        self.dump_interval = dump_interval
+        self.output = output
+        self.reset()
+
+    def reset(self):
+        self.timers = dict.fromkeys(PHASES, 0.0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[phase] += time.perf_counter() - start
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def snapshot(self):
+        return {'timers': dict(self.timers), 'counters': dict(self.counters)}
+
+    # called by the model after every step
+    def step_done(self, step):
+        if self.dump_interval and step % self.dump_interval == 0:
+            self.output(json.dumps(dict(self.snapshot(), step=step)))
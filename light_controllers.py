@@ -0,0 +1,135 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import numpy as np
+
+
+# Traffic light controllers (TrafficModel(..., light_controller=...)): policies deciding the
+# phase of every light at once, with array operations over the light counters and the grid
+# occupancy, instead of every light checking its own cells. A controller compiles, once per
+# map, the cells each light watches (see compile, flat grid indexes x * width + y, -1 for
+# none), and then step updates time_green_counter and time_red_counter of lights, an object
+# with them as arrays (along with time_green, time_red and light_cell). A light is red while
+# its time_red_counter is above 0, like in TrafficLightAgent.state
+class LightController:
+    policy = None
+    # whether step reads the occupancy (the sharded engine then exchanges its tile borders)
+    reads_occupancy = True
+
+    def compile(self, model, cells):
+        return np.zeros((len(cells), 0), dtype=np.int64)
+
+    def step(self, lights, watched, occupancy):
+        raise NotImplementedError
+
+    # policy and parameters, enough for make_controller to build it again (see checkpoint)
+    def spec(self):
+        return dict(policy=self.policy, **vars(self))
+
+
+# fixed time cycle: every light is green time_green steps, and then red time_red steps
+class FixedTimeController(LightController):
+    policy = 'fixed'
+    reads_occupancy = False
+
+    def step(self, lights, watched, occupancy):
+        green = lights.time_red_counter == 0
+        lights.time_green_counter[green] = np.maximum(0, lights.time_green_counter[green] - 1)
+        turns_red = green & (lights.time_green_counter == 0)
+        red = ~green
+        lights.time_red_counter[red] = np.maximum(0, lights.time_red_counter[red] - 1)
+        turns_green = red & (lights.time_red_counter == 0)
+        lights.time_red_counter[turns_red] = lights.time_red[turns_red]
+        lights.time_green_counter[turns_green] = lights.time_green[turns_green]
+
+
+# vehicle actuated (third scenario): a light with a vehicle in its cell turns red when there
+# are vehicles in any of the two adjacent corners located in its direction, and green
+# otherwise (see TrafficLightAgent.check_for_other_vehicles). Lights whose corners are out of
+# the grid keep their phase
+class VehicleActuatedController(LightController):
+    policy = 'actuated'
+
+    def compile(self, model, cells):
+        x, y = np.divmod(cells, model.width)
+        # a non transitable cell has direction -1, like in TrafficModel.get_direction
+        direction = np.asarray(model.restriction_matrix)[model.height - x - 1, y]
+        corners = np.stack([x + np.array([1, -1, -1, 1])[direction], y + np.array([1, 1, -1, -1])[direction],
+                            x + np.array([-1, -1, 1, 1])[direction], y + np.array([1, -1, -1, 1])[direction]], axis=1)
+        corner_x, corner_y = corners[:, ::2], corners[:, 1::2]
+        in_limits = ((0 <= corner_x) & (corner_x < model.height) & (0 <= corner_y) & (corner_y < model.width)).all(axis=1)
+        return np.where(in_limits[:, None], corner_x * model.width + corner_y, -1)
+
+    def step(self, lights, watched, occupancy):
+        occupied = occupancy > 0
+        checked = (watched[:, 0] >= 0) & occupied[lights.light_cell]
+        red = checked & (occupied[watched[:, 0]] | occupied[watched[:, 1]])
+        green = checked & ~red
+        lights.time_red_counter[red] = 1
+        lights.time_green_counter[red] = 0
+        lights.time_red_counter[green] = 0
+        lights.time_green_counter[green] = 1
+
+
+# queue length based: the queue of a light is the amount of vehicles in its cell and the
+# depth - 1 cells behind it (against its direction). A green light stays green at least
+# min_green steps, and then until its queue is empty, and a red light turns green when its
+# queue reaches threshold vehicles, or after max_red steps. min_green and max_red default to
+# the green and red times of every light. In the sharded engine, queues are only counted
+# within the tile and its border cells
+class QueueLengthController(LightController):
+    policy = 'queue'
+
+    def __init__(self, threshold=2, depth=3, min_green=None, max_red=None):
+        self.threshold = threshold
+        self.depth = depth
+        self.min_green = min_green
+        self.max_red = max_red
+
+    def compile(self, model, cells):
+        x, y = np.divmod(cells, model.width)
+        direction = np.asarray(model.restriction_matrix)[model.height - x - 1, y]
+        # grid offsets of the cell each direction points to (right, down, left and up in the matrix)
+        offset_x = np.array([0, -1, 0, 1])[direction]
+        offset_y = np.array([1, 0, -1, 0])[direction]
+        behind = np.arange(self.depth)
+        queue_x = x[:, None] - behind * offset_x[:, None]
+        queue_y = y[:, None] - behind * offset_y[:, None]
+        inside = (0 <= queue_x) & (queue_x < model.height) & (0 <= queue_y) & (queue_y < model.width)
+        return np.where(inside, queue_x * model.width + queue_y, -1)
+
+    def step(self, lights, watched, occupancy):
+        queue = np.where(watched >= 0, occupancy[watched], 0).sum(axis=1)
+        green = lights.time_red_counter == 0
+        lights.time_green_counter[green] = np.maximum(0, lights.time_green_counter[green] - 1)
+        turns_red = green & (lights.time_green_counter == 0) & (queue == 0)
+        red = ~green
+        lights.time_red_counter[red] = np.maximum(0, lights.time_red_counter[red] - 1)
+        turns_green = red & ((lights.time_red_counter == 0) | (queue >= self.threshold))
+        max_red = lights.time_red if self.max_red is None else np.full(len(queue), self.max_red)
+        min_green = lights.time_green if self.min_green is None else np.full(len(queue), self.min_green)
+        lights.time_red_counter[turns_red] = max_red[turns_red]
+        lights.time_green_counter[turns_green] = min_green[turns_green]
+        lights.time_red_counter[turns_green] = 0
+
+
+CONTROLLERS = {controller.policy: controller for controller in
+               (FixedTimeController, VehicleActuatedController, QueueLengthController)}
+
+
+# controller from a policy name, a dict with the policy and its parameters (like
+# {'policy': 'queue', 'threshold': 3}), or a controller. By default, fixed time, or vehicle
+# actuated in the third scenario
+def make_controller(controller=None, third_scenario=False):
+    if controller is None:
+        controller = 'actuated' if third_scenario else 'fixed'
+    if isinstance(controller, str):
+        controller = {'policy': controller}
+    if isinstance(controller, dict):
+        parameters = dict(controller)
+        policy = parameters.pop('policy')
+        if policy not in CONTROLLERS:
+            raise ValueError('light controller must be one of %s, not %r' % (', '.join(CONTROLLERS), policy))
+        controller = CONTROLLERS[policy](**parameters)
+    return controller
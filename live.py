@@ -0,0 +1,245 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+import mesa
+import numpy as np
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+
+from checkpoint import model_state
+from model import TrafficModel
+from overload_canvas_grid import CanvasGrid
+
+# static files of mesa visualization (GridDraw.js and InteractionHandler.js, used by CanvasDeltaModule.js)
+MESA_TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(mesa.__file__)), 'visualization', 'templates')
+
+
+# state of a model needed to draw a frame: vehicle cells, red traffic lights (in the order of
+# model.traffic_light_state) and reporters, in the same form for every engine
+def snapshot(model):
+    vehicles, lights, _ = model_state(model)
+    return {'step': model.steps_counter,
+            'vehicles': np.asarray(vehicles['position'], dtype=np.int64),
+            'red': np.asarray(lights['time_red_counter']) > 0,
+            'metrics': {"Total waiting time for vehicles": model.compute_total_waiting_time(),
+                        "Waiting time for vehicles in front": model.compute_waiting_time_for_vehicles_in_front(),
+                        "Waiting time for traffic lights": model.compute_total_waiting_time_traffic_lights()}}
+
+
+# simulation process of LiveServer: runs the model at full speed, and publishes a snapshot on
+# channel at most publish_rate times per second. The channel is bounded, when the server is
+# behind the snapshot is dropped instead of waiting for it (but the layout and the final one)
+def simulate(parameters, channel, stop, publish_rate):
+    model = TrafficModel(**parameters)
+    channel.put(('layout', {'restriction_matrix': np.asarray(model.restriction_matrix),
+                            'light_cell': model.traffic_light_state.column('position'),
+                            'max_steps': model.max_steps}))
+    interval = 1 / publish_rate
+    next_publish = 0
+    while model.steps_counter < model.max_steps and not stop.is_set():
+        model.step()
+        now = time.monotonic()
+        if model.steps_counter == model.max_steps:
+            channel.put(('snapshot', snapshot(model)))
+        elif now >= next_publish:
+            next_publish = now + interval
+            try:
+                channel.put_nowait(('snapshot', snapshot(model)))
+            except queue.Full:
+                pass
+    channel.put(('done', None))
+
+
+# what CanvasGrid reads from a model, for the last snapshot received from the simulation process
+class LiveView:
+    def __init__(self, layout):
+        self.restriction_matrix = layout['restriction_matrix']
+        self.light_cell = layout['light_cell']
+        self.max_steps = layout['max_steps']
+        self.snapshot = None
+        self.instrumentation = None
+
+
+# CanvasGrid drawing snapshots (see LiveView) instead of a model: the static layer is the same,
+# and cells get the portrayals of light_portrayal(green) and vehicle_portrayal(), once per
+# vehicle, like the agents of a grid cell
+class SnapshotCanvas(CanvasGrid):
+
+    def __init__(self, portrayal_method, light_portrayal, vehicle_portrayal, grid_width, grid_height,
+                 canvas_width=500, canvas_height=500, keyframe_interval=100):
+        super().__init__(portrayal_method, grid_width, grid_height, canvas_width, canvas_height, keyframe_interval)
+        self.light_portrayal = light_portrayal
+        self.vehicle_portrayal = vehicle_portrayal
+
+    def render_cells(self, view):
+        snapshot = view.snapshot
+        green = self.style_id(self.light_portrayal(True))
+        red = self.style_id(self.light_portrayal(False))
+        vehicle = self.style_id(self.vehicle_portrayal())
+        cells = {cell: [red if is_red else green]
+                 for cell, is_red in zip(view.light_cell.tolist(), snapshot['red'].tolist())}
+        counts = np.bincount(snapshot['vehicles'], minlength=self.grid_width * self.grid_height)
+        for cell in np.flatnonzero(counts).tolist():
+            cells.setdefault(cell, []).extend([vehicle] * int(counts[cell]))
+        return cells
+
+
+PAGE = """<!DOCTYPE html>
+<head>
+    <title>{name} (live)</title>
+    <link href="/static/css/visualization.css" type="text/css" rel="stylesheet" />
+</head>
+<body>
+    <p>Step: <span id="step">0</span> / {max_steps} <span id="done"></span></p>
+    <p id="metrics"></p>
+    <div id="elements"></div>
+    <script src="/static/js/GridDraw.js"></script>
+    <script src="/static/js/InteractionHandler.js"></script>
+    <script src="/local/CanvasDeltaModule.js"></script>
+    <script>
+        const elements = [];
+        {js_code}
+        const socket = new WebSocket(`ws://${{location.host}}/ws`);
+        socket.onmessage = (event) => {{
+            const message = JSON.parse(event.data);
+            if (message.done) document.getElementById("done").textContent = "(finished)";
+            if (!message.frame) return;
+            elements[0].render(message.frame);
+            document.getElementById("step").textContent = message.step;
+            document.getElementById("metrics").textContent = Object.entries(message.metrics)
+                .map(([label, value]) => `${{label}}: ${{value}}`).join(", ");
+        }};
+    </script>
+</body>
+"""
+
+
+class LivePageHandler(tornado.web.RequestHandler):
+    def get(self):
+        server = self.application
+        self.write(PAGE.format(name=server.name, max_steps=server.view.max_steps if server.view else '?',
+                               js_code=server.canvas.js_code))
+
+
+class LiveSocketHandler(tornado.websocket.WebSocketHandler):
+    def open(self):
+        self.sending = None
+        self.needs_keyframe = True
+        self.told_done = False
+        self.application.clients.add(self)
+
+    def on_close(self):
+        self.application.clients.discard(self)
+
+    def check_origin(self, origin):
+        return True
+
+    # sends a message, unless the previous one is still being written: slow clients skip
+    # frames (and get a keyframe when they catch up) instead of slowing down the rest
+    def send(self, message):
+        if self.sending is not None and not self.sending.done():
+            self.needs_keyframe = True
+            return
+        try:
+            self.sending = self.write_message(json.dumps(message))
+        except tornado.websocket.WebSocketClosedError:
+            self.application.clients.discard(self)
+
+
+# Live mode of the visualization: unlike mesa.visualization.ModularServer, which steps the
+# model when the browser asks for a frame, the model runs at full speed in its own process
+# (see simulate), publishing snapshots on a bounded channel, and this server (tornado, on
+# asyncio) samples the latest one fps times per second, and streams it to every client as a
+# CanvasDeltaModule frame (see SnapshotCanvas). Frames are dropped, never the simulation slowed
+class LiveServer(tornado.web.Application):
+
+    def __init__(self, parameters, canvas, name="Traffic Model", fps=10, port=8522, channel_size=2):
+        self.parameters = parameters
+        self.canvas = canvas
+        self.name = name
+        self.fps = fps
+        self.port = port
+        self.clients = set()
+        self.view = None
+        self.done = False
+        self.channel = multiprocessing.Queue(channel_size)
+        self.stop = multiprocessing.Event()
+        self.process = None
+        super().__init__([
+            (r"/", LivePageHandler),
+            (r"/ws", LiveSocketHandler),
+            (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": MESA_TEMPLATES}),
+            (r"/local/(.*)", tornado.web.StaticFileHandler, {"path": canvas.local_dir}),
+        ])
+
+    def start_simulation(self):
+        self.process = multiprocessing.Process(
+            target=simulate, args=(self.parameters, self.channel, self.stop, self.fps), daemon=True)
+        self.process.start()
+
+    # latest message of the simulation process, without waiting (the rest are skipped)
+    def receive(self):
+        latest = None
+        while True:
+            try:
+                kind, data = self.channel.get_nowait()
+            except queue.Empty:
+                return latest
+            if kind == 'layout':
+                self.view = LiveView(data)
+            elif kind == 'done':
+                self.done = True
+            else:
+                latest = data
+
+    # one frame: the latest snapshot, encoded once for every client (plus a keyframe for the
+    # ones that joined or skipped frames)
+    def broadcast(self):
+        latest = self.receive()
+        if latest is not None:
+            self.view.snapshot = latest
+            frame = self.canvas.render(self.view)
+            for client in list(self.clients):
+                if client.needs_keyframe:
+                    continue
+                client.send({"step": latest['step'], "metrics": latest['metrics'], "frame": frame})
+        if self.view is not None and self.view.snapshot is not None:
+            snapshot = self.view.snapshot
+            for client in list(self.clients):
+                if client.needs_keyframe and (client.sending is None or client.sending.done()):
+                    client.needs_keyframe = False
+                    client.send({"step": snapshot['step'], "metrics": snapshot['metrics'],
+                                 "frame": self.canvas.keyframe(self.view), "done": self.done})
+        if self.done:
+            for client in list(self.clients):
+                if not client.told_done:
+                    client.told_done = True
+                    client.send({"done": True})
+
+    async def stream(self):
+        while True:
+            started = time.monotonic()
+            self.broadcast()
+            await asyncio.sleep(max(0, 1 / self.fps - (time.monotonic() - started)))
+
+    def launch(self, port=None):
+        if port is not None:
+            self.port = port
+        print(f"Live interface starting at http://127.0.0.1:{self.port}")
+        self.start_simulation()
+        self.listen(self.port)
+        loop = tornado.ioloop.IOLoop.current()
+        loop.spawn_callback(self.stream)
+        try:
+            loop.start()
+        finally:
+            self.stop.set()
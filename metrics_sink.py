@@ -0,0 +1,135 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import csv
+import os
+
+
+# writes rows to a CSV file, header included with the first chunk
+class CSVWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# writes rows to a Parquet (.parquet) or Arrow IPC (.arrow, .feather) file, one row group
+# or record batch per chunk. pyarrow is only needed when writing these formats
+class ArrowWriter:
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('pyarrow is required for writing Parquet or Arrow files, '
+                              'use a .csv path otherwise')
+        self.pyarrow = pyarrow
+        self.path = path
+        self.columns = columns
+        self.writer = None
+
+    def write(self, rows):
+        table = self.pyarrow.Table.from_pylist([dict(zip(self.columns, row)) for row in rows])
+        if self.writer is None:  # schema is taken from the first chunk
+            if self.path.endswith('.parquet'):
+                import pyarrow.parquet
+                self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            else:
+                import pyarrow.ipc
+                self.writer = pyarrow.ipc.new_file(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_writer(path, columns):
+    if path.endswith('.csv'):
+        return CSVWriter(path, columns)
+    if path.endswith(('.parquet', '.arrow', '.feather')):
+        return ArrowWriter(path, columns)
+    raise ValueError('unknown output format for %r, use .csv, .parquet or .arrow' % path)
+
+
+# output sink for TrafficModel (TrafficModel(..., sink=MetricsSink(path))). Instead of keeping
+# every collected row in memory, like mesa.DataCollector does, rows are buffered and flushed
+# to disk in chunks of chunk_size rows, so memory stays flat regardless of run length.
+# Model reporters go to path, and optionally per vehicle waiting counters to a second file,
+# same name with a _vehicles suffix. The model closes the sink when reaching max_steps
+class MetricsSink:
+
+    def __init__(self, path, chunk_size=10000, vehicles=False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.vehicles = vehicles
+        root, extension = os.path.splitext(path)
+        self.vehicles_path = root + '_vehicles' + extension
+        self.model_writer = None
+        self.vehicles_writer = None
+        self.model_rows = []
+        self.vehicles_rows = []
+
+    def collect(self, model):
+        reporters = model.datacollector.model_reporters
+        if self.model_writer is None:
+            self.model_writer = open_writer(self.path, ['Step'] + list(reporters))
+        self.model_rows.append([model.steps_counter] + [reporter() for reporter in reporters.values()])
+        if len(self.model_rows) >= self.chunk_size:
+            self.flush_model_rows()
+
+        if self.vehicles:
+            if self.vehicles_writer is None:
+                self.vehicles_writer = open_writer(
+                    self.vehicles_path, ['Step', 'AgentID', 'Waiting for vehicles in front',
+                                         'Waiting for traffic lights'])
+            self.vehicles_rows.extend(self.vehicle_rows(model))
+            if len(self.vehicles_rows) >= self.chunk_size:
+                self.flush_vehicles_rows()
+
+    # waiting counters of the vehicles already introduced in the grid (brought up to date for
+    # the vehicles sleeping in ActiveScheduler, see checkpoint.model_state)
+    def vehicle_rows(self, model):
+        step = model.steps_counter
+        engine = model.vectorized_engine
+        if engine is not None:
+            entered, waiting_for_cars, waiting_traffic_lights = engine.vehicle_waiting_times()
+            first_id = model.last_unique_id + 1
+            return zip([step] * len(entered), (entered + first_id).tolist(),
+                       waiting_for_cars.tolist(), waiting_traffic_lights.tolist())
+        from checkpoint import model_state
+        vehicles, _, _ = model_state(model)
+        return zip([step] * len(vehicles['position']), model.vehicle_state.unique_id,
+                   vehicles['waiting_for_cars'].tolist(), vehicles['waiting_traffic_lights'].tolist())
+
+    def flush_model_rows(self):
+        if self.model_rows:
+            self.model_writer.write(self.model_rows)
+            self.model_rows = []
+
+    def flush_vehicles_rows(self):
+        if self.vehicles_rows:
+            self.vehicles_writer.write(self.vehicles_rows)
+            self.vehicles_rows = []
+
+    def close(self):
+        for writer, flush in ((self.model_writer, self.flush_model_rows),
+                              (self.vehicles_writer, self.flush_vehicles_rows)):
+            if writer is not None:
+                flush()
+                writer.close()
+        self.model_writer = None
+        self.vehicles_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
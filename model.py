@@ -3,50 +3,77 @@ Author: Enrique Vilchez Campillejo
 """
 
 import mesa
+import numpy as np
+from agent_state import AgentState
 from agents import TrafficLightAgent, VehicleAgent
-import random
+from heatmap import CongestionHeatmap
+from instrumentation import Instrumentation
+from light_controllers import make_controller
+from occupancy_grid import OccupancyGrid
+from scheduler import ActiveScheduler
+from sharded import ShardedEngine
+from road_network import RoadNetwork, compile_routing
+from spawner import Spawner
+from vectorized import VectorizedEngine
 import json
 
 
 class TrafficModel(mesa.Model):
     """A model with some number of agents."""
 
+    # reporters read the running totals vehicles keep updated (see VehicleAgent.wait_for_cars
+    # and VehicleAgent.wait_for_traffic_light), instead of scanning every agent
     def compute_waiting_time_for_vehicles_in_front(self):
-        waiting_for_vehicles_in_front = [agent.waiting_for_cars for agent in self.schedule.agents if
-                                         type(agent) is VehicleAgent]
-        return sum(waiting_for_vehicles_in_front)
+        return self.waiting_for_cars
 
     def compute_total_waiting_time_traffic_lights(self):
-        waiting_traffic_lights = [agent.waiting_traffic_lights for agent in self.schedule.agents if
-                                  type(agent) is VehicleAgent]
-        return sum(waiting_traffic_lights)
+        return self.waiting_traffic_lights
 
     def compute_total_waiting_time(self):
-        waiting_for_vehicles_in_front = [agent.waiting_for_cars for agent in self.schedule.agents if
-                                         type(agent) is VehicleAgent]
-        waiting_traffic_lights = [agent.waiting_traffic_lights for agent in self.schedule.agents if
-                                  type(agent) is VehicleAgent]
-        total_waiting_time = sum(waiting_for_vehicles_in_front) + sum(waiting_traffic_lights)
-        return total_waiting_time
+        return self.waiting_for_cars + self.waiting_traffic_lights
 
     def __init__(self, width, height, max_steps, non_transitable_cells,
                  vehicles, max_waiting_time_non_transitable_in_steps,
-                 second_scenario = False, third_scenario = False):
+                 second_scenario = False, third_scenario = False, engine = 'agents',
+                 collect_interval = 1, seed = None, sink = None,
+                 instrumentation = None, tiles = (2, 2), scheduler = 'base',
+                 restriction_matrix = None, traffic_lights = None, entry_cells = ((0, 0),),
+                 spawn_rate = 1, poisson_arrivals = False, initial_vehicles = 0, road_network = None,
+                 light_controller = None, recorder = None, heatmap = None):
+        if engine not in ('agents', 'vectorized', 'sharded'):
+            raise ValueError("engine must be 'agents', 'vectorized' or 'sharded', not %r" % engine)
+        if scheduler not in ('base', 'active'):
+            raise ValueError("scheduler must be 'base' or 'active', not %r" % scheduler)
+        # every model draws from its own random number generator (self.random, also used by
+        # agents), so runs with the same seed are reproducible, and can run in parallel
+        self.reset_randomizer(seed)
+
         # global parameters, and scenarios
         self.counter = 0
         self.width = width
         self.height = height
-        self.restriction_matrix = []
+        self.vehicles_percentage = vehicles
+        self.engine = engine
+        self.scheduler = scheduler
+        self.tiles = tiles
+        self.restriction_matrix = None
         self.second_scenario = second_scenario
         self.third_scenario = third_scenario
 
         # grid and global parameters
         # Inverted width and height order, because of matrix accessing purposes, like in many examples:
         #   https://snyk.io/advisor/python/Mesa/functions/mesa.space.MultiGrid
-        self.grid = mesa.space.MultiGrid(height, width, False)
+        self.grid = OccupancyGrid(height, width, False)
         self.max_steps = max_steps
         self.max_waiting_time_non_transitable_in_steps = max_waiting_time_non_transitable_in_steps
-        self.schedule = mesa.time.BaseScheduler(self)
+        # every traffic light is decided at once by a controller (see light_controllers), fixed
+        # time by default, or vehicle actuated in the third scenario
+        self.light_controller = make_controller(light_controller, third_scenario)
+        # agents engine steps every agent, or only the ones that can change (see scheduler.ActiveScheduler)
+        if scheduler == 'active':
+            self.schedule = ActiveScheduler(self)
+        else:
+            self.schedule = mesa.time.BaseScheduler(self)
 
         # global parameters
         self.total_amount_cells = width * height
@@ -56,11 +83,53 @@ class TrafficModel(mesa.Model):
                                          self.total_amount_cells)
         self.transitable_cells = self.total_amount_cells - self.non_transitable_cells
 
-        # generating matrix, and global parameters
-        self.generate_matrix()
+        # running totals of waiting times, every how many steps they are collected, and
+        # optionally a sink (see metrics_sink.MetricsSink) streaming them to disk instead of
+        # keeping them in the datacollector
+        self.waiting_for_cars = 0
+        self.waiting_traffic_lights = 0
+        self.collect_interval = collect_interval
+        self.sink = sink
+        # optionally a recorder (see recorder.TrajectoryRecorder) writing vehicle cells and traffic
+        # light states of every step to a trajectory log, to replay the run
+        self.recorder = recorder
+
+        # per phase timers and event counters (see instrumentation.Instrumentation), None when disabled
+        if instrumentation is True:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation or None
+        # per cell congestion counters (see heatmap.CongestionHeatmap), None when disabled
+        if heatmap is True:
+            heatmap = CongestionHeatmap()
+        if heatmap and engine == 'sharded':
+            raise ValueError('congestion heatmaps are not available with the sharded engine')
+        self.heatmap = heatmap or None
+        if self.heatmap is not None:
+            self.heatmap.attach(self)
+
+        # state of vehicles and traffic lights, as typed columns (agents are views of them)
+        self.vehicle_state = AgentState(self, waiting_for_cars='q', waiting_traffic_lights='q',
+                                        counter_parking='i', parking='b')
+        self.traffic_light_state = AgentState(self, time_green='i', time_red='i',
+                                              time_green_counter='i', time_red_counter='i')
+
+        # generating matrix (unless given, like when restoring a checkpoint), compiling it into
+        # the routing table, and global parameters. A road network (see road_network.RoadNetwork,
+        # or the path of a map file) is already compiled, and has its own non transitable cells
+        self.road_network = None
+        if road_network is not None:
+            self.load_road_network(road_network)
+        elif restriction_matrix is None:
+            self.generate_matrix()
+            self.compile_routing_table()
+        else:
+            self.restriction_matrix = restriction_matrix
+            self.compile_routing_table()
         self.total_amount_vehicles = int((vehicles / 100) *
                                          self.transitable_cells)
-        self.total_amount_traffic_lights = self.set_traffic_lights()
+        self.total_amount_traffic_lights = self.set_traffic_lights(traffic_lights)
+        self.light_watched = self.light_controller.compile(
+            self, self.traffic_light_state.column('position').astype(np.int64))
         self.num_agents = self.total_amount_vehicles \
                           + self.total_amount_traffic_lights
         print('Agents: ', self.num_agents, ' Vehicles: ', self.total_amount_vehicles,
@@ -68,12 +137,24 @@ class TrafficModel(mesa.Model):
         print('Total cells: ', self.total_amount_cells, ' Transitable cells: ', self.transitable_cells,
               ' Non transitable cells: ', self.non_transitable_cells)
 
-        # Generate vehicles
-        self.agents_list = []
-        for i in range(self.total_amount_vehicles):
-            unique_id = self.last_unique_id + i + 1
-            a = VehicleAgent(unique_id, self)
-            self.agents_list.append(a)
+        # vehicles are created when introduced in the grid (see introduce), or stored in arrays
+        # when stepping with the vectorized engine (or with the sharded one, vectorized engines
+        # in tiles[0] x tiles[1] processes)
+        self.introduced_vehicles = 0
+        self.vehicles = []
+        self.vectorized_engine = None
+        if engine == 'vectorized':
+            self.vectorized_engine = VectorizedEngine(self)
+        elif engine == 'sharded':
+            self.vectorized_engine = ShardedEngine(self, tiles)
+        # vehicles arrive at the entry cells, spawn_rate per step (see spawner.Spawner), and
+        # initial_vehicles are spawned at once on random cells before the first step
+        self.spawner = Spawner(self, entry_cells, spawn_rate, poisson_arrivals)
+        self.entry_cells = entry_cells
+        self.spawn_rate = spawn_rate
+        self.poisson_arrivals = poisson_arrivals
+        if initial_vehicles:
+            self.introduce(self.spawner.spawn_bulk(initial_vehicles))
 
         # Traffic light and vehicle in front waiting time
         self.datacollector = mesa.DataCollector(
@@ -85,49 +166,86 @@ class TrafficModel(mesa.Model):
     # generates a matrix with random directions, following a concrete criteria. A cell gets
     # a concrete position from de beginning (right), then with a 80% of probabilities, direction
     # on next cell keeps straight, with a 10% goes to the left, and with 10% to the right (both
-    # with respect to the straight direction)
+    # with respect to the straight direction).
+    # Every cell is drawn at once, instead of cell by cell: non transitable cells are the first
+    # ones (row-major order) under the percentage until reaching the quota, and directions are
+    # the cumulative sum of the turns through transitable cells, starting again from right at
+    # the beginning cell. The matrix is stored as a compact int8 array, -1 is non transitable
     def generate_matrix(self):
-        non_transitable_cells_counter = 0
-        previous_direction = 0
-        for x in range(self.height):
-            row = []
-            for y in range(self.width):
-                if x == self.height - 1 and y == 0:  # beginning cell
-                    row.append(0)  # first direction and cell is right and transitable
-                    previous_direction = 0
-                else:
-                    if random.random() <= (self.non_transitable_cells_percentage / 100) \
-                            and non_transitable_cells_counter < self.non_transitable_cells:
-                        row.append(-1)
-                        non_transitable_cells_counter += 1
-                    else:
-                        if random.random() <= 0.80:
-                            row.append(previous_direction)
-                        elif random.random() <= 0.90:
-                            row.append((previous_direction - 1) % 4)
-                        else:
-                            row.append(abs(previous_direction + 1) % 4)
-                        previous_direction = row[-1]
-            self.restriction_matrix.append(row)
+        rng = np.random.default_rng(self.random.getrandbits(64))
+        beginning = (self.height - 1) * self.width  # beginning cell, first direction is right
+        non_transitable = rng.random(self.total_amount_cells) <= (self.non_transitable_cells_percentage / 100)
+        non_transitable[beginning] = False
+        non_transitable &= np.cumsum(non_transitable) <= self.non_transitable_cells
+        straight = rng.random(self.total_amount_cells) <= 0.80
+        left = rng.random(self.total_amount_cells) <= 0.90
+        turns = np.where(straight, 0, np.where(left, -1, 1))
+        turns[non_transitable] = 0
+        turns[beginning] = 0
+        directions = np.cumsum(turns)
+        directions[beginning:] -= directions[beginning]
+        directions = (directions % 4).astype(np.int8)
+        directions[non_transitable] = -1
+        self.restriction_matrix = directions.reshape(self.height, self.width)
 
         # self.restriction_matrix = [[0, 0, 0, 0, 3, 2, 1, 1, 0, 0, 0, 0, 3, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 3, 3, 3, 3, 3, 3, 3, 3, 2, 2, 2, 2, -1, 2, 2, -1, 2, 2, 2, 2], [2, 2, 2, 2, 2, 2, 1, 0, 0, 3, 2, 2, 2, 2, 1, 1, 1, 0, 0, 0, 0, 0, -1, 0], [0, 0, 1, 0, 3, 3, 3, 3, 3, 2, 2, 2, 2, 2, 2, 2, 2, 1, 1, 1, 1, 1, 1, -1], [-1, 1, -1, 1, 1, -1, 1, 1, 0, 3, -1, 3, 3, 3, 3, 3, 3, 2, 2, 2, 2, 2, 2, 1], [1, 0, 0, 0, -1, 0, 0, 0, 3, 3, -1, 3, 3, 3, 3, 2, 2, 2, 1, 1, 1, 1, -1, 0], [0, 0, 0, 0, -1, 0, 0, 0, 0, 0, 0, 3, 3, 3, 3, 2, 1, -1, 1, 1, 1, 1, 1, 0], [0, 0, 3, 3, 3, 3, 3, 3, 2, 1, 1, -1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0, 3, 3, 0, 0, 3, 2, 2, 2, 2, 2, 1, 1, 1, 1, 0, 0, 0, 0], [0, 3, 3, 3, 3, 3, 3, 3, -1, 2, 2, 2, -1, 1, 1, 1, 1, 1, 0, -1, 0, 0, 0, 3], [3, 2, 2, 2, 2, 1, 1, -1, 1, 0, 3, 3, 3, -1, 3, 3, 3, 3, 3, 2, 2, 2, 2, 1], [0, 0, 3, -1, 3, 2, 2, 2, 2, 2, 2, -1, 2, 2, 2, 2, -1, 2, 2, 1, 0, 0, -1, 3]]
 
-    # method for automatically setting traffic lights on the restriction matrix
-    def set_traffic_lights(self):
-        amount_traffic_lights = 0
-        for x, row in enumerate(reversed(self.restriction_matrix)):
-            for y, cell in enumerate(row):
-                X = self.height - x - 1  # accessing rows from bottom to top
-                if cell != -1:
-                    unique_id = (x * self.width) + y  # 'normal' x for index purposes
-                    self.last_unique_id = unique_id
-                    new_traffic_light = TrafficLightAgent(unique_id, self, [0, 0])
-                    crossing, _ = self.crossing_adjacent([X, y])
-                    if crossing and random.random() <= 0.5:
-                        self.schedule.add(new_traffic_light)
-                        self.grid.place_agent(new_traffic_light, [x, y])  # 'normal' x for grid
-                        amount_traffic_lights += 1
-        return amount_traffic_lights
+    # restriction matrix never changes once generated, so it is compiled once, for all cells at
+    # the same time, into a static routing table (see road_network.compile_routing)
+    def compile_routing_table(self):
+        self.set_routing_table(compile_routing(self.restriction_matrix))
+
+    def set_routing_table(self, compiled):
+        self.crossing_table = compiled['crossing_table']
+        self.successors = compiled['successors']
+        self.successors_count = compiled['successors_count']
+        self.light_candidates = compiled['light_candidates']
+        self.routing_table = {}
+
+    def load_road_network(self, road_network):
+        if not isinstance(road_network, RoadNetwork):
+            road_network = RoadNetwork(road_network)
+        if (road_network.height, road_network.width) != (self.height, self.width):
+            raise ValueError('map %s is %dx%d (height x width), not %dx%d' % (
+                road_network.path, road_network.height, road_network.width, self.height, self.width))
+        self.road_network = road_network
+        self.restriction_matrix = road_network.restriction_matrix
+        self.set_routing_table(road_network.compiled)
+        self.non_transitable_cells = int(np.count_nonzero(road_network.restriction_matrix == -1))
+        self.transitable_cells = self.total_amount_cells - self.non_transitable_cells
+
+    # allowed steps from a certain grid position, taken from the compiled routing table (and
+    # kept as tuples of positions, for the cells vehicles actually visit)
+    def possible_steps(self, pos):
+        steps = self.routing_table.get(pos)
+        if steps is None:
+            cell = pos[0] * self.width + pos[1]
+            steps = tuple(divmod(int(c), self.width) for c in self.successors[cell, :self.successors_count[cell]])
+            self.routing_table[pos] = steps
+        return steps
+
+    # method for automatically setting traffic lights on the restriction matrix. Crossing cells
+    # get a traffic light with a 50% of probabilities, and only those are created. Lights can
+    # also be given, as their cells (flat grid indexes), green times and red times.
+    # Their state columns are filled at once, and traffic light agents (views of them) are only
+    # created for the agents engine, the vectorized and sharded ones just read the columns
+    def set_traffic_lights(self, traffic_lights=None):
+        if traffic_lights is None:
+            rng = np.random.default_rng(self.random.getrandbits(64))
+            placed = self.light_candidates[rng.random(len(self.light_candidates)) <= 0.5]
+            time_green, time_red = rng.integers(1, 11, size=(len(placed), 2)).T
+        else:
+            placed, time_green, time_red = (np.asarray(values) for values in traffic_lights)
+        first = self.traffic_light_state.extend(len(placed), unique_id=placed, position=placed, time_green=time_green,
+                                                time_red=time_red, time_green_counter=time_green)
+        if self.engine == 'agents':
+            lights = [TrafficLightAgent.view(self.traffic_light_state, index) for index in range(first, first + len(placed))]
+            for new_traffic_light in lights:
+                self.schedule.add(new_traffic_light)
+            self.grid.place_traffic_lights(lights, placed.tolist())
+        # unique ids of traffic lights are grid cell indexes, vehicles go after all of them
+        self.last_unique_id = self.total_amount_cells - 1
+        return len(placed)
 
     # checks if a concrete cell is transitable (cell != -1) or not
     def is_transitable(self, pos):
@@ -168,13 +286,85 @@ class TrafficModel(mesa.Model):
             crossing = subtraction == 1 or subtraction == 3
         return crossing, crossing_pos
 
-    def step(self):
-        if self.steps_counter < self.max_steps:
+    # introduces new vehicles in the grid, at the given cells (flat grid indexes, see
+    # spawner.Spawner), in the engine arrays or as new agents
+    def introduce(self, cells):
+        if not cells:
+            return
+        if self.vectorized_engine is not None:
+            self.vectorized_engine.spawn(cells)
+            self.introduced_vehicles += len(cells)
+            return
+        for cell in cells:
+            self.introduced_vehicles += 1
+            vehicle = VehicleAgent(self.last_unique_id + self.introduced_vehicles, self)
+            self.vehicles.append(vehicle)
+            self.schedule.add(vehicle)
+            if self.heatmap is not None:
+                self.heatmap.touch(cell)
+            self.grid.place_agent(vehicle, divmod(cell, self.width))
+
+    def collect(self):
+        if self.sink is not None:
+            self.sink.collect(self)
+        else:
             self.datacollector.collect(self)
-            # First, introduce all vehicles in the grid
+
+    # every traffic light at once, through the light controller, on NumPy views of their
+    # state columns
+    def step_traffic_lights(self):
+        lights = self.traffic_light_state.arrays()
+        lights.light_cell = lights.position
+        self.light_controller.step(lights, self.light_watched, self.grid.vehicle_count)
+
+    # same as self.schedule.step(): traffic lights (the first agents in the schedule), and then
+    # vehicles, in the order they were introduced, timed apart when instrumentation is enabled
+    # (ActiveScheduler steps only the agents that can change, and times them by itself)
+    def step_agents(self):
+        instrumentation = self.instrumentation
+        if type(self.schedule) is ActiveScheduler:
             self.schedule.step()
-            if self.agents_list:
-                a = self.agents_list.pop(0)
-                self.schedule.add(a)
-                self.grid.place_agent(a, (0, 0))
+            return
+        if instrumentation is None:
+            self.step_traffic_lights()
+            for vehicle in self.vehicles:
+                vehicle.step()
+        else:
+            with instrumentation.timer('traffic_lights'):
+                self.step_traffic_lights()
+            with instrumentation.timer('vehicles'):
+                for vehicle in self.vehicles:
+                    vehicle.step()
+        self.schedule.steps += 1
+        self.schedule.time += 1
+
+    def step(self):
+        if self.steps_counter < self.max_steps:
+            instrumentation = self.instrumentation
+            if self.steps_counter % self.collect_interval == 0:
+                if instrumentation is None:
+                    self.collect()
+                else:
+                    with instrumentation.timer('data_collection'):
+                        self.collect()
+            if self.recorder is not None:
+                self.recorder.record(self)
+            if self.vectorized_engine is not None:
+                self.vectorized_engine.step()
+            else:
+                self.step_agents()
+            # then, introduce the vehicles entering the grid in this step
+            self.introduce(self.spawner.step())
             self.steps_counter += 1
+            if instrumentation is not None:
+                instrumentation.step_done(self.steps_counter)
+            if self.heatmap is not None:
+                self.heatmap.step_done(self.steps_counter)
+            if self.steps_counter == self.max_steps:
+                if self.sink is not None:
+                    self.sink.close()
+                if self.recorder is not None:
+                    self.recorder.record(self)
+                    self.recorder.close()
+                if self.vectorized_engine is not None:
+                    self.vectorized_engine.close()
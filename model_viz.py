@@ -2,14 +2,18 @@
 Author: Enrique Vilchez Campillejo
 """
 
+import sys
+
 import mesa
+from live import LiveServer, SnapshotCanvas
 from model import TrafficModel
+from recorder import TrajectoryLog, TrajectoryReplay
 from agents import TrafficLightAgent, VehicleAgent
-from overload_canvas_grid import CanvasGrid
+from overload_canvas_grid import CanvasGrid, ModularServer
 
 
-# creates agent dictionary for rendering it on Canvas Gird
-def agent_portrayal(agent, cell):
+# portrayal of a cell of the restriction matrix (-1 non transitable, or its direction)
+def cell_portrayal(cell):
     portrayal = {"Shape": "rect", "Filled": "true", "h": 1, "w": 1}
     if cell == -1:
         portrayal.update({"Color": "Darkblue", "Layer": 0})
@@ -18,14 +22,32 @@ def agent_portrayal(agent, cell):
         portrayal.update({
             "Shape": "arrowHead", "Color": "grey", "scale": 0.3,
             "heading_x": pos_x[cell], "heading_y": pos_y[cell], "Layer": 1})
+    return portrayal
+
+
+# portrayals of agents (drawn over the cell portrayal CanvasGrid renders them with)
+def traffic_light_portrayal(green, cell=-2):
+    portrayal = cell_portrayal(cell)
+    if green:
+        portrayal.update({"Shape": "rect", "Color": "lightgreen", "Layer": 0})
+    else:
+        portrayal.update({"Shape": "rect", "Color": "#FF5F5F", "Layer": 0})
+    return portrayal
+
+
+def vehicle_portrayal(cell=-2):
+    portrayal = cell_portrayal(cell)
+    portrayal.update({"Shape": "rect", "Color": "black", "Layer": 2, "h": 0.4, "w": 0.4})
+    return portrayal
+
+
+# creates agent dictionary for rendering it on Canvas Gird
+def agent_portrayal(agent, cell):
     if isinstance(agent, TrafficLightAgent):
-        if agent.state():
-            portrayal.update({"Shape": "rect", "Color": "lightgreen", "Layer": 0})
-        else:
-            portrayal.update({"Shape": "rect", "Color": "#FF5F5F", "Layer": 0})
+        return traffic_light_portrayal(agent.state(), cell)
     elif isinstance(agent, VehicleAgent):
-        portrayal.update({"Shape": "rect", "Color": "black", "Layer": 2, "h": 0.4, "w": 0.4})
-    return portrayal
+        return vehicle_portrayal(cell)
+    return cell_portrayal(cell)
 
 
 width = 24
@@ -43,12 +65,34 @@ chart = mesa.visualization.ChartModule([{"Label": "Total waiting time for vehicl
 
 # in python [height, width] for grid, in js [width, height]
 grid = CanvasGrid(agent_portrayal, width, height, 35 * width, 35 * height)
-# initizalize Modular server for mesa Python visualization
-server = mesa.visualization.ModularServer(
+# initizalize Modular server for mesa Python visualization (with the grid rendered per browser,
+# see overload_canvas_grid.ModularServer)
+server = ModularServer(
     TrafficModel, [grid, chart], "Traffic Model", {"width": width, "height": height, "max_steps": 100,
                                                    "non_transitable_cells": 10, "vehicles": 5,
                                                    "max_waiting_time_non_transitable_in_steps": 2,
                                                    "second_scenario": True, "third_scenario": True}
 )
 server.port = 8521  # The default
-server.launch()
+
+if __name__ == '__main__':
+    # --live: the model runs at full speed in its own process, and the browser gets the
+    # latest frame at a fixed rate (see live.LiveServer), for long or large simulations
+    if '--live' in sys.argv:
+        live_parameters = dict(server.model_kwargs, max_steps=10000)
+        live_grid = SnapshotCanvas(agent_portrayal, traffic_light_portrayal, vehicle_portrayal,
+                                   width, height, 35 * width, 35 * height)
+        LiveServer(live_parameters, live_grid, "Traffic Model").launch()
+    # --replay path: steps through a trajectory log (see recorder.TrajectoryRecorder) instead
+    # of simulating
+    elif '--replay' in sys.argv:
+        log_path = sys.argv[sys.argv.index('--replay') + 1]
+        log_height, log_width = TrajectoryLog(log_path).restriction_matrix.shape
+        replay_grid = SnapshotCanvas(agent_portrayal, traffic_light_portrayal, vehicle_portrayal,
+                                     log_width, log_height, 35 * log_width, 35 * log_height)
+        replay_server = ModularServer(
+            TrajectoryReplay, [replay_grid], "Traffic Model (replay)", {"path": log_path})
+        replay_server.port = server.port
+        replay_server.launch()
+    else:
+        server.launch()
@@ -0,0 +1,93 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import mesa
+import numpy as np
+
+from agents import TrafficLightAgent, VehicleAgent
+
+
+# cells of a grid column, only the ones holding agents are stored. Empty cells are read as
+# an empty list, without being allocated
+class SparseColumn(dict):
+    def __missing__(self, key):
+        return []
+
+
+# MultiGrid that keeps typed occupancy structures, updated on place_agent/move_agent:
+# vehicle_count holds how many vehicles are in every cell (flat index x * height + y, also
+# kept as the position of the agent in its state columns, see agent_state.AgentState),
+# and traffic lights are indexed by cell, so asking "is there a vehicle at (x, y)" or
+# "what light governs this cell" doesn't need to scan the contents of the cell. Cell
+# contents are sparse, so low density maps don't allocate a Python list per cell
+class OccupancyGrid(mesa.space.MultiGrid):
+
+    def __init__(self, width, height, torus):
+        self.height = height
+        self.width = width
+        self.torus = torus
+        self.num_cells = height * width
+        self._grid = [SparseColumn() for _ in range(self.width)]
+        self._empties_built = False
+        self._neighborhood_cache = {}
+
+        self.vehicle_count = np.zeros(self.num_cells, dtype=np.int32)
+        self.traffic_lights = {}
+
+    def place_agent(self, agent, pos):
+        x, y = pos
+        cell = self._grid[x].setdefault(y, [])
+        if agent.pos is None or agent not in cell:
+            cell.append(agent)
+            agent.pos = pos
+            if self._empties_built:
+                self._empties.discard(pos)
+            if type(agent) is VehicleAgent:
+                self.vehicle_count[x * self.height + y] += 1
+                agent.store.position[agent.index] = x * self.height + y
+            elif type(agent) is TrafficLightAgent:
+                self.traffic_lights[x * self.height + y] = agent
+                agent.store.position[agent.index] = x * self.height + y
+
+    # places traffic lights at once, at their cells (flat indexes, already their position in
+    # their state columns, see TrafficModel.set_traffic_lights), all of them in empty cells
+    def place_traffic_lights(self, lights, cells):
+        for light, cell in zip(lights, cells):
+            x, y = pos = divmod(cell, self.height)
+            self._grid[x][y] = [light]
+            light.pos = pos
+            self.traffic_lights[cell] = light
+        if self._empties_built:
+            self._empties.difference_update(light.pos for light in lights)
+
+    def remove_agent(self, agent):
+        pos = agent.pos
+        x, y = pos
+        cell = self._grid[x][y]
+        cell.remove(agent)
+        if not cell:
+            del self._grid[x][y]
+            if self._empties_built:
+                self._empties.add(pos)
+        if type(agent) is VehicleAgent:
+            self.vehicle_count[x * self.height + y] -= 1
+            agent.store.position[agent.index] = -1
+        elif type(agent) is TrafficLightAgent:
+            del self.traffic_lights[x * self.height + y]
+            agent.store.position[agent.index] = -1
+        agent.pos = None
+
+    # iterates over the cells holding any agent, with their contents
+    def iter_occupied(self):
+        for x, column in enumerate(self._grid):
+            for y, cell in column.items():
+                yield (x, y), cell
+
+    # checks if there is any vehicle in a certain position
+    def has_vehicle(self, pos):
+        return self.vehicle_count[pos[0] * self.height + pos[1]] > 0
+
+    # returns the traffic light placed in a certain position, or None
+    def traffic_light_at(self, pos):
+        return self.traffic_lights.get(pos[0] * self.height + pos[1])
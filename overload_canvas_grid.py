@@ -4,9 +4,15 @@ Modular Canvas Rendering
 
 Module for visualizing model objects in grid cells.
 """
-from collections import defaultdict
+import json
+import os
 
+import numpy as np
+
+from mesa.visualization.ModularVisualization import ModularServer as MesaModularServer
+from mesa.visualization.ModularVisualization import SocketHandler as MesaSocketHandler
 from mesa.visualization.ModularVisualization import VisualizationElement
+import tornado.web
 
 
 class CanvasGrid(VisualizationElement):
@@ -52,16 +58,52 @@ class CanvasGrid(VisualizationElement):
                       conjunction of "text" property.
 
 
+    Portrayals are not sent one by one on every frame. Cells are addressed by
+    their index, x * grid_width + y, and every distinct portrayal becomes a
+    style, sent once and then referred to by its id. The static layer (the
+    restriction matrix: directions and non transitable cells) is sent only in
+    keyframes, as the matrix values plus the style of each value, and the
+    client (CanvasDeltaModule.js) caches it, drawn on offscreen canvases.
+    Every other frame only carries the cells whose agents (vehicles, traffic
+    light colours) changed since the previous frame:
+
+        {"frame": 7, "base": 6, "styles": {"3": {...}},
+         "cells": [[index, [style ids]], ...]}
+
+    where an empty list of style ids clears the cell. Frames with a null base
+    are keyframes, holding the static layer, the full palette and every
+    occupied cell; they are the first frame of a model, and are sent every
+    keyframe_interval frames, so clients that missed a frame can get back in
+    sync.
+
+    Every browser connected to the server gets its own frames: styles, cells
+    and frame numbers are kept per session (see CanvasSession), one per
+    websocket connection when served by ModularServer below (stock mesa
+    ModularServer renders every connection with the same session, so it only
+    works with a single browser).
+
+    When the model keeps a congestion heatmap (heatmap.CongestionHeatmap),
+    one of its counters can be overlaid on top of the agents: every cell with
+    a count gets a translucent red rectangle, in HEATMAP_LEVELS shades scaled
+    to the highest count of the frame (a snapshot since the beginning, or
+    windowed or decayed, see CongestionHeatmap.snapshot).
+
     Attributes:
         portrayal_method: Function which generates portrayals from objects, as
                           described above.
         grid_height, grid_width: Size of the grid to visualize, in cells.
         canvas_height, canvas_width: Size, in pixels, of the grid visualization
                                      to draw on the client.
-        template: "canvas_module.html" stores the module's HTML template.
+        keyframe_interval: Every how many frames the full state is sent.
+        heatmap: Counter of the congestion heatmap to overlay, or None.
+        heatmap_window, heatmap_half_life: Snapshot of the overlay.
     """
 
-    package_includes = ["GridDraw.js", "CanvasModule.js", "InteractionHandler.js"]
+    HEATMAP_LEVELS = 8
+
+    package_includes = ["GridDraw.js", "InteractionHandler.js"]
+    local_includes = ["CanvasDeltaModule.js"]
+    local_dir = os.path.dirname(os.path.abspath(__file__))
 
     def __init__(
         self,
@@ -70,6 +112,10 @@ class CanvasGrid(VisualizationElement):
         grid_height,
         canvas_width=500,
         canvas_height=500,
+        keyframe_interval=100,
+        heatmap=None,
+        heatmap_window=None,
+        heatmap_half_life=None,
     ):
         """Instantiate a new CanvasGrid.
 
@@ -79,37 +125,173 @@ class CanvasGrid(VisualizationElement):
             grid_width, grid_height: Size of the grid, in cells.
             canvas_height, canvas_width: Size of the canvas to draw in the
                                          client, in pixels. (default: 500x500)
+            keyframe_interval: Every how many frames the full state is sent,
+                               instead of the changes. (default: 100)
+            heatmap: Counter of the model congestion heatmap to overlay
+                     ('occupancy', 'blocked', 'red_light' or 'parking'), or
+                     None for no overlay. (default: None)
+            heatmap_window, heatmap_half_life: Last steps, or half life of
+                                               the decay, of the overlaid
+                                               counts. (default: all steps)
         """
         self.portrayal_method = portrayal_method
         self.grid_width = grid_width
         self.grid_height = grid_height
         self.canvas_width = canvas_width
         self.canvas_height = canvas_height
+        self.keyframe_interval = keyframe_interval
+        self.heatmap = heatmap
+        self.heatmap_window = heatmap_window
+        self.heatmap_half_life = heatmap_half_life
+        self.sessions = {}
+        self.session = None
 
-        new_element = "new CanvasModule({}, {}, {}, {})".format(
+        new_element = "new CanvasDeltaModule({}, {}, {}, {})".format(
             self.canvas_width, self.canvas_height, self.grid_width, self.grid_height
         )
 
         self.js_code = "elements.push(" + new_element + ");"
 
-    def render(self, model):
-        grid_state = defaultdict(list)
-        for x in range(model.grid.width):
-            for y in range(model.grid.height):
-                cell_objects = model.grid.get_cell_list_contents([(x, y)])
-                if model.restriction_matrix[model.height - x - 1][y] == -1:
-                    portrayal = self.portrayal_method(None, -1)
-                else:
-                    portrayal = self.portrayal_method(None, model.restriction_matrix[model.height - x - 1][y])
+    def reset(self, model, client=None):
+        """Start a new session of a client, for a new model: styles, cells
+        and frames are sent again from scratch, starting with a keyframe."""
+        self.session = self.sessions[client] = CanvasSession(model)
+        return self.session
+
+    def close(self, client):
+        """Forget the session of a client, once it is disconnected."""
+        self.sessions.pop(client, None)
+
+    def style_id(self, portrayal):
+        """Id of a portrayal in the palette of the current session, adding it
+        if it is a new one."""
+        styles = self.session.styles
+        key = json.dumps(portrayal, sort_keys=True)
+        style = styles.get(key)
+        if style is None:
+            style = styles[key] = len(styles)
+        return style
+
+    def render_static(self, model):
+        """Restriction matrix values in cell order, and the style of each value."""
+        values = [int(v) for row in reversed(model.restriction_matrix) for v in row]
+        styles = {}
+        for value in set(values):
+            portrayal = self.portrayal_method(None, value)
+            if portrayal:
+                styles[value] = self.style_id(portrayal)
+        return {"values": values, "styles": styles}
+
+    def render_cells(self, model):
+        """Style ids of the agents of every occupied cell."""
+        cells = {}
+        for (x, y), cell_objects in model.grid.iter_occupied():
+            styles = []
+            for obj in cell_objects:
+                portrayal = self.portrayal_method(obj, -2)
                 if portrayal:
-                    portrayal["x"] = y
-                    portrayal["y"] = x
-                    grid_state[portrayal["Layer"]].append(portrayal)
-                for obj in cell_objects:
-                    portrayal = self.portrayal_method(obj, -2)
-                    if portrayal:
-                        portrayal["x"] = y
-                        portrayal["y"] = x
-                        grid_state[portrayal["Layer"]].append(portrayal)
-
-        return grid_state
\ No newline at end of file
+                    styles.append(self.style_id(portrayal))
+            if styles:
+                cells[x * self.grid_width + y] = styles
+        return cells
+
+    def render_heatmap(self, model, cells):
+        """Adds the overlay style of every cell with a count of the heatmap
+        counter to cells (style ids by cell)."""
+        heatmap = getattr(model, "heatmap", None)
+        if self.heatmap is None or heatmap is None:
+            return
+        values = heatmap.snapshot(self.heatmap_window, self.heatmap_half_life)[self.heatmap]
+        highest = values.max()
+        if highest <= 0:
+            return
+        # matrix rows go from top to bottom, cells from bottom to top
+        levels = np.ceil(values[::-1].reshape(-1) / highest * self.HEATMAP_LEVELS).astype(int)
+        for index in np.flatnonzero(levels > 0).tolist():
+            alpha = round(0.7 * levels[index] / self.HEATMAP_LEVELS, 3)
+            style = self.style_id({"Shape": "rect", "Filled": "true", "w": 1, "h": 1, "Layer": 3,
+                                   "Color": "rgba(255, 0, 0, {})".format(alpha)})
+            cells.setdefault(index, []).append(style)
+
+    def render(self, model, client=None):
+        if model.instrumentation is None:
+            return self.render_frame(model, client)
+        with model.instrumentation.timer("rendering"):
+            return self.render_frame(model, client)
+
+    def render_frame(self, model, client=None):
+        session = self.sessions.get(client)
+        if session is None or session.model is not model:
+            session = self.reset(model, client)
+        self.session = session
+        known_styles = len(session.styles)
+        cells = self.render_cells(model)
+        self.render_heatmap(model, cells)
+
+        if session.frame % self.keyframe_interval == 0:
+            session.cells = cells
+            session.frame += 1
+            return self.keyframe(model, client)
+        changed = [[index, styles] for index, styles in cells.items()
+                   if session.cells.get(index) != styles]
+        changed += [[index, []] for index in session.cells if index not in cells]
+        data = {"base": session.frame - 1, "frame": session.frame,
+                "styles": {style: json.loads(key) for key, style in session.styles.items()
+                           if style >= known_styles},
+                "cells": changed}
+        session.cells = cells
+        session.frame += 1
+        return data
+
+    def keyframe(self, model, client=None):
+        """The last frame rendered for a client, as a keyframe: static layer,
+        full palette and every occupied cell (also for clients joining in the
+        middle of a session that is sent to several of them, like in
+        live.LiveServer)."""
+        self.session = session = self.sessions[client]
+        static = self.render_static(model)
+        return {"static": static, "base": None, "frame": session.frame - 1,
+                "styles": {style: json.loads(key) for key, style in session.styles.items()},
+                "cells": list(session.cells.items())}
+
+
+class CanvasSession:
+    """Delta encoding state of the frames sent to a client: the model they
+    are drawing, the next frame number, the palette (portrayal JSON to style
+    id) and the style ids of every cell in the last frame."""
+
+    def __init__(self, model):
+        self.model = model
+        self.frame = 0
+        self.styles = {}
+        self.cells = {}
+
+
+class SocketHandler(MesaSocketHandler):
+    """Websocket handler that renders CanvasGrid elements for this
+    connection, so every browser gets its own delta encoded frames."""
+
+    @property
+    def viz_state_message(self):
+        model = self.application.model
+        data = [element.render(model, self) if isinstance(element, CanvasGrid) else element.render(model)
+                for element in self.application.visualization_elements]
+        return {"type": "viz_state", "data": data}
+
+    def on_close(self):
+        for element in self.application.visualization_elements:
+            if isinstance(element, CanvasGrid):
+                element.close(self)
+
+
+class SocketRouting(tornado.web.Application):
+    """Serves the websocket of ModularServer with SocketHandler above."""
+
+    def __init__(self, handlers, **settings):
+        handlers = [(r"/ws", SocketHandler) if handler[0] == r"/ws" else handler for handler in handlers]
+        super().__init__(handlers, **settings)
+
+
+class ModularServer(MesaModularServer, SocketRouting):
+    """mesa ModularServer, with a CanvasGrid session per connected browser
+    (see SocketHandler)."""
@@ -0,0 +1,160 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import os
+
+import numpy as np
+
+from array_file import read_arrays, write_arrays
+from checkpoint import model_state
+
+# kinds of record, the first value of every record
+KEYFRAME = 0
+DELTA = 1
+
+
+# Trajectory recorder for TrafficModel (TrafficModel(..., recorder=TrajectoryRecorder(path))):
+# the model records the state of the grid before every step, like collect, and after the last
+# one, so a run can be inspected or rendered again (see TrajectoryLog and TrajectoryReplay)
+# without simulating it again. Every recorded step is a record of int32 values:
+#   - a keyframe every keyframe_interval steps: KEYFRAME, amount of vehicles, amount of traffic
+#     lights, 0, the cell of every vehicle (flat grid indexes, in the order they were
+#     introduced) and the red traffic lights (in the order of model.traffic_light_state), as bits
+#   - a delta otherwise: DELTA, amount of vehicles, amount of vehicles that moved (or were
+#     introduced), amount of traffic lights that changed, the vehicles that moved, their new
+#     cells, and the traffic lights that changed
+# Records are appended to a temporary file while running, and when closing (the model closes
+# the recorder when reaching max_steps), they are written as an array file (see array_file),
+# with the offset of every record (the step index), the restriction matrix and traffic lights
+class TrajectoryRecorder:
+
+    def __init__(self, path, keyframe_interval=100):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.records_path = path + '.records'
+        self.file = None
+        self.offsets = [0]
+        self.first_step = None
+        self.layout = None
+        self.positions = None
+        self.red = None
+
+    def record(self, model):
+        if self.file is None:
+            self.file = open(self.records_path, 'wb')
+            self.first_step = model.steps_counter
+            self.layout = {'restriction_matrix': np.asarray(model.restriction_matrix, dtype=np.int8),
+                           'light_cell': model.traffic_light_state.column('position').astype(np.int32)}
+        vehicles, lights, _ = model_state(model)
+        positions = np.array(vehicles['position'], dtype=np.int32)
+        red = np.asarray(lights['time_red_counter']) > 0
+        if (len(self.offsets) - 1) % self.keyframe_interval == 0:
+            bits = np.packbits(red)
+            bits = np.pad(bits, (0, -len(bits) % 4))
+            record = np.concatenate(([KEYFRAME, len(positions), len(red), 0], positions, bits.view(np.int32)))
+        else:
+            known = len(self.positions)
+            moved = np.concatenate((np.flatnonzero(positions[:known] != self.positions),
+                                    np.arange(known, len(positions)))).astype(np.int32)
+            changed = np.flatnonzero(red != self.red)
+            record = np.concatenate(([DELTA, len(positions), len(moved), len(changed)], moved, positions[moved], changed))
+        record = record.astype('<i4')
+        self.file.write(record.tobytes())
+        self.offsets.append(self.offsets[-1] + len(record))
+        self.positions = positions
+        self.red = red
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        records = np.memmap(self.records_path, dtype='<i4', mode='r')
+        arrays = dict(self.layout, offsets=np.asarray(self.offsets, dtype=np.int64), records=records)
+        write_arrays(self.path, {'first_step': self.first_step, 'keyframe_interval': self.keyframe_interval},
+                     arrays)
+        del records, arrays  # the memory map is closed before removing its file
+        os.remove(self.records_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# reader of a trajectory log (see TrajectoryRecorder), memory mapped read only. state(step)
+# decodes the keyframe before step, and the deltas from it (at most keyframe_interval - 1, so
+# it takes the same time for any step of any log). The last decoded state is kept, so reading
+# steps in order only decodes one delta each
+class TrajectoryLog:
+
+    def __init__(self, path):
+        self.path = path
+        header, arrays = read_arrays(path, mode='r')
+        self.first_step = header['first_step']
+        self.keyframe_interval = header['keyframe_interval']
+        self.restriction_matrix = arrays['restriction_matrix']
+        self.light_cell = arrays['light_cell']
+        self.offsets = arrays['offsets']
+        self.records = arrays['records']
+        self.last_step = self.first_step + len(self.offsets) - 2
+        self.decoded = None  # (step, positions, red) of the last decoded state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def record(self, index):
+        return self.records[self.offsets[index]:self.offsets[index + 1]]
+
+    # vehicle cells and red traffic lights (a bool per light) in step
+    def state(self, step):
+        if not self.first_step <= step <= self.last_step:
+            raise IndexError('step %d is not in the log (steps %d to %d)' % (step, self.first_step, self.last_step))
+        index = step - self.first_step
+        keyframe = index - index % self.keyframe_interval
+        decoded = self.decoded
+        if decoded is not None and keyframe <= decoded[0] - self.first_step <= index:
+            start, positions, red = decoded[0] - self.first_step, decoded[1], decoded[2]
+        else:
+            record = self.record(keyframe)
+            vehicles, lights = record[1], record[2]
+            positions = record[4:4 + vehicles].copy()
+            red = np.unpackbits(record[4 + vehicles:].view(np.uint8), count=lights).astype(bool)
+            start = keyframe
+        for delta in range(start + 1, index + 1):
+            record = self.record(delta)
+            vehicles, moved, changed = record[1], record[2], record[3]
+            if vehicles > len(positions):
+                positions = np.concatenate((positions, np.zeros(vehicles - len(positions), dtype=positions.dtype)))
+            positions[record[4:4 + moved]] = record[4 + moved:4 + 2 * moved]
+            red[record[4 + 2 * moved:4 + 2 * moved + changed]] ^= True
+        self.decoded = (step, positions, red)
+        return positions.copy(), red.copy()
+
+
+# replay of a trajectory log, in place of a model for the visualization: live.SnapshotCanvas
+# draws it like a snapshot of the live mode, and with ModularServer (as the model class,
+# {"path": path} as parameters) every step moves to the next recorded one, from start_step
+# (the first one by default)
+class TrajectoryReplay:
+
+    def __init__(self, path, start_step=None):
+        self.log = TrajectoryLog(path)
+        self.restriction_matrix = self.log.restriction_matrix
+        self.light_cell = self.log.light_cell
+        self.max_steps = self.log.last_step
+        self.instrumentation = None
+        self.running = True
+        self.seek(self.log.first_step if start_step is None else start_step)
+
+    def seek(self, step):
+        positions, red = self.log.state(step)
+        self.steps_counter = step
+        self.snapshot = {'step': step, 'vehicles': positions.astype(np.int64), 'red': red}
+
+    def step(self):
+        if self.steps_counter < self.log.last_step:
+            self.seek(self.steps_counter + 1)
+        self.running = self.steps_counter < self.log.last_step
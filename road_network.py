@@ -0,0 +1,154 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from array_file import read_arrays, write_arrays
+
+# bumped whenever compile_routing changes, so older compiled caches are not used
+COMPILED_VERSION = 1
+
+# cells of a text map: directions (right, down, left and up in matrix coordinates, like
+# TrafficModel.crossing_adjacent) and non transitable cells
+DIRECTIONS = '>v<^'
+NON_TRANSITABLE = '#'
+
+
+# compiles a restriction matrix, for all cells at the same time, into a static routing table.
+# Cells are indexed like TrafficModel.grid (x from bottom to top), flattened as x * width + y:
+# successors holds, for each cell, the cells a vehicle standing there is allowed to move to
+# (-1 padded, successors_count of them), crossing_table flags the cells that point to a
+# crossing, and light_candidates are the transitable ones (where traffic lights are set).
+# Same rules as TrafficModel.crossing_adjacent: not oposite directions are allowed, nor
+# adjacent cell that crosses actual one, or same directions, unless actual cell is pointing to it
+def compile_routing(restriction_matrix):
+    matrix = np.asarray(restriction_matrix)
+    height, width = matrix.shape
+    rows, columns = np.indices(matrix.shape)
+    # offsets of the cell each direction points to, in matrix coordinates (like in
+    # crossing_adjacent, -1 of non transitable cells ends up pointing up)
+    adjacent_dirs = np.array([(0, 1), (1, 0), (0, -1), (-1, 0)])
+    pointing = adjacent_dirs[matrix % 4]
+
+    pointed_rows = rows + pointing[..., 0]
+    pointed_columns = columns + pointing[..., 1]
+    inside = (pointed_rows >= 0) & (pointed_rows < height) & \
+             (pointed_columns >= 0) & (pointed_columns < width)
+    pointed_dir = matrix[pointed_rows.clip(0, height - 1), pointed_columns.clip(0, width - 1)]
+    subtraction = np.abs(matrix - pointed_dir)
+    crossing = inside & ((subtraction == 1) | (subtraction == 3))
+    crossing_table = crossing[::-1]
+    light_candidates = np.flatnonzero(crossing_table & (matrix[::-1] != -1))
+
+    # neighbours in the same order than grid.get_neighborhood, (x-1, y), (x, y-1), (x, y+1)
+    # and (x+1, y), as offsets in matrix coordinates
+    neighbours = [(1, 0), (0, -1), (0, 1), (-1, 0)]
+    allowed = np.zeros(matrix.shape + (4,), dtype=bool)
+    targets = np.zeros(matrix.shape + (4,), dtype=np.int64)
+    for k, (offset_row, offset_column) in enumerate(neighbours):
+        adjacent_rows = rows + offset_row
+        adjacent_columns = columns + offset_column
+        inside = (adjacent_rows >= 0) & (adjacent_rows < height) & \
+                 (adjacent_columns >= 0) & (adjacent_columns < width)
+        adjacent_rows = adjacent_rows.clip(0, height - 1)
+        adjacent_columns = adjacent_columns.clip(0, width - 1)
+        adjacent_direction = matrix[adjacent_rows, adjacent_columns]
+        adjacent_pointing = adjacent_dirs[adjacent_direction % 4]
+        oposite_direction = (pointing[..., 0] == -offset_row) & (pointing[..., 1] == -offset_column)
+        pointing_to_adjacent = (pointing[..., 0] == offset_row) & (pointing[..., 1] == offset_column)
+        adjacent_crossing_actual = (adjacent_pointing[..., 0] == -offset_row) & \
+                                   (adjacent_pointing[..., 1] == -offset_column)
+        subtraction = np.abs(matrix - adjacent_direction)
+        allowed[..., k] = inside & ((~oposite_direction & ~adjacent_crossing_actual &
+                                     (subtraction != 0) & (subtraction != 2)) | pointing_to_adjacent)
+        targets[..., k] = (height - adjacent_rows - 1) * width + adjacent_columns
+
+    allowed = allowed[::-1].reshape(-1, 4)
+    targets = targets[::-1].reshape(-1, 4)
+    order = np.argsort(~allowed, axis=1, kind='stable')
+    successors_count = allowed.sum(axis=1).astype(np.int8)
+    successors = np.take_along_axis(targets, order, axis=1).astype(np.int32)
+    successors[np.arange(4) >= successors_count[:, None]] = -1
+    return {'crossing_table': crossing_table, 'successors': successors,
+            'successors_count': successors_count, 'light_candidates': light_candidates}
+
+
+# reads a restriction matrix (rows from top to bottom, like TrafficModel.restriction_matrix)
+# from a map file:
+#   - .npy: a NumPy array of directions, -1 for non transitable cells
+#   - .json: a list of rows, or an object with them in "restriction_matrix"
+#   - any other extension, a text file with a row per line, either of directions separated
+#     by spaces or commas, or of DIRECTIONS and NON_TRANSITABLE characters
+def read_map(path):
+    if path.endswith('.npy'):
+        matrix = np.load(path)
+    elif path.endswith('.json'):
+        with open(path) as file:
+            matrix = json.load(file)
+        if isinstance(matrix, dict):
+            matrix = matrix['restriction_matrix']
+    else:
+        with open(path) as file:
+            lines = [line.strip() for line in file if line.strip()]
+        matrix = [[int(cell) for cell in line.replace(',', ' ').split()]
+                  if any(c.isdigit() for c in line) else
+                  [DIRECTIONS.index(c) if c != NON_TRANSITABLE else -1 for c in line] for line in lines]
+    matrix = np.asarray(matrix)
+    if matrix.ndim != 2 or len({len(row) for row in matrix}) != 1:
+        raise ValueError('%s is not a rectangular map' % path)
+    if not np.isin(matrix, (-1, 0, 1, 2, 3)).all():
+        raise ValueError('%s has cells out of directions 0-3 or -1 (non transitable)' % path)
+    return matrix.astype(np.int8)
+
+
+# writes a restriction matrix as a map file, in the format given by the extension (see read_map)
+def write_map(path, restriction_matrix):
+    matrix = np.asarray(restriction_matrix, dtype=np.int8)
+    if path.endswith('.npy'):
+        np.save(path, matrix)
+    elif path.endswith('.json'):
+        with open(path, 'w') as file:
+            json.dump({'restriction_matrix': matrix.tolist()}, file)
+    else:
+        with open(path, 'w') as file:
+            for row in matrix:
+                file.write(''.join(DIRECTIONS[cell] if cell != -1 else NON_TRANSITABLE for cell in row) + '\n')
+
+
+# road network read from a map file (see read_map), for TrafficModel(..., road_network=path).
+# The first time a map is loaded, it is compiled (see compile_routing) and cached in cache_dir
+# (a __mapcache__ directory next to the map by default), in a file named after the hash of
+# the map file contents. Later loads only hash the file and memory map the cache, read only,
+# so startup doesn't depend on the map size, and processes loading the same map share it
+class RoadNetwork:
+
+    def __init__(self, path, cache_dir=None):
+        self.path = path
+        with open(path, 'rb') as file:
+            digest = hashlib.sha256(file.read())
+        digest.update(b'compiled version %d' % COMPILED_VERSION)
+        self.key = digest.hexdigest()
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), '__mapcache__')
+        self.cache_path = os.path.join(cache_dir, self.key + '.compiled')
+        if not os.path.exists(self.cache_path):
+            self.compile(cache_dir)
+        _, arrays = read_arrays(self.cache_path, mode='r')
+        self.restriction_matrix = arrays.pop('restriction_matrix')
+        self.compiled = arrays  # the arrays of compile_routing
+        self.height, self.width = self.restriction_matrix.shape
+
+    # writes the compiled cache, through a temporary file, so processes compiling the same map
+    # at the same time never read a half written one
+    def compile(self, cache_dir):
+        matrix = read_map(self.path)
+        arrays = dict(restriction_matrix=matrix, **compile_routing(matrix))
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        write_arrays(temporary, {'map': os.path.abspath(self.path)}, arrays)
+        os.replace(temporary, self.cache_path)
@@ -0,0 +1,205 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import heapq
+
+import mesa
+import numpy as np
+
+from agents import TrafficLightAgent
+from light_controllers import FixedTimeController, VehicleActuatedController
+
+
+# Event driven scheduler for TrafficModel (TrafficModel(..., scheduler='active')). Same order
+# than BaseScheduler (traffic lights first, then vehicles, by unique id), but only agents
+# whose state can change are stepped, so the cost of a step follows the amount of moving
+# vehicles instead of the amount of agents:
+#   - fixed time traffic lights only change at their phase changes, known in advance, which
+#     are kept in a timer wheel (due step -> lights). Vehicle actuated lights (third scenario)
+#     are only checked with a vehicle in their cell (read from the grid occupancy of the light
+#     cells), the rest can't change. Other controllers
+#     decide every light every step (see TrafficModel.step_traffic_lights)
+#   - vehicles stopped at a fixed time red light sleep until it turns green, and their
+#     waiting time is credited when waking up (the model totals are still updated every step)
+#   - parked vehicles (out of traffic light cells) sleep until their parking time expires
+# In between events, traffic light counters keep the values of their last phase change
+# (state() is always right), and sleeping vehicles are not credited their waiting time yet.
+# Parked vehicles don't draw their next cell from the model random generator while
+# sleeping, so seeded runs are not the same than with BaseScheduler. Checkpoints keep the
+# sleeping vehicles (see sleepers), so restored runs continue exactly
+class ActiveScheduler(mesa.time.BaseScheduler):
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.vehicles = []
+        self.active = []
+        self.phase_changes = {}
+        self.next_phase_change = {}
+        self.wakeups = {}
+        self.red_sleepers = 0
+        self.light_cells = None  # cells of the traffic lights, for vehicle actuated lights
+
+    def add(self, agent):
+        super().add(agent)
+        if type(agent) is TrafficLightAgent:
+            if self.fixed_time():
+                self.schedule_traffic_light(agent)
+        else:
+            self.vehicles.append(agent)
+            self.active.append(agent)
+
+    def remove(self, agent):
+        super().remove(agent)
+        if agent in self.vehicles:
+            self.vehicles.remove(agent)
+        if agent in self.active:
+            self.active.remove(agent)
+
+    def fixed_time(self):
+        return type(self.model.light_controller) is FixedTimeController
+
+    # next phase change of a fixed time light, from its counters
+    def schedule_traffic_light(self, light):
+        remaining = light.time_green_counter if light.state() else light.time_red_counter
+        self.schedule_phase_change(light, self.steps + max(remaining, 1))
+
+    # schedules again every traffic light, after their counters are set (like when restoring a
+    # checkpoint)
+    def reschedule_traffic_lights(self):
+        self.phase_changes = {}
+        self.next_phase_change = {}
+        if self.fixed_time():
+            for agent in self.agents:
+                if type(agent) is TrafficLightAgent:
+                    self.schedule_traffic_light(agent)
+
+    # brings a copy of the state columns (see checkpoint.model_state) up to date: sleeping
+    # vehicles get the waiting time and parking countdown they would have with BaseScheduler,
+    # and traffic lights the counters of their current phase
+    def bring_up_to_date(self, vehicles, lights):
+        now = self.steps
+        for step, sleepers in self.wakeups.items():
+            for vehicle, red_light_since in sleepers:
+                if red_light_since is not None:
+                    vehicles['waiting_traffic_lights'][vehicle.index] += now - red_light_since
+                elif step - 2 - now >= 0:
+                    vehicles['counter_parking'][vehicle.index] = step - 2 - now
+                else:
+                    vehicles['counter_parking'][vehicle.index] = self.model.max_waiting_time_non_transitable_in_steps
+                    vehicles['parking'][vehicle.index] = False
+        for unique_id, step in self.next_phase_change.items():
+            index = self._agents[unique_id].index
+            if lights['time_red_counter'][index] == 0:
+                lights['time_green_counter'][index] = step - now
+            else:
+                lights['time_red_counter'][index] = step - now
+
+    # sleeping vehicles, as arrays of their index in the state columns, the step they wake up,
+    # and the step they went to sleep at a red light (-1 for parked vehicles)
+    def sleepers(self):
+        sleepers = [(vehicle.index, step, -1 if red_light_since is None else red_light_since)
+                    for step, sleepers in self.wakeups.items() for vehicle, red_light_since in sleepers
+                    if vehicle.unique_id in self._agents]
+        return tuple(np.array(values, dtype=np.int64) for values in zip(*sleepers)) if sleepers else \
+            tuple(np.zeros(0, dtype=np.int64) for _ in range(3))
+
+    # puts to sleep again the vehicles of sleepers(), once the state columns are restored
+    # brought up to date: their waiting time at red lights is credited again when waking up,
+    # and parked vehicles are still parked until then
+    def load_sleepers(self, indexes, wakeups, red_light_since):
+        vehicles = self.model.vehicles
+        sleeping = set()
+        for index, step, since in zip(indexes.tolist(), wakeups.tolist(), red_light_since.tolist()):
+            vehicle = vehicles[index]
+            if since >= 0:
+                vehicle.waiting_traffic_lights -= self.steps - since
+                self.sleep(vehicle, step, since)
+            else:
+                vehicle.parking = True
+                self.sleep(vehicle, step)
+            sleeping.add(vehicle)
+        self.active = [vehicle for vehicle in self.active if vehicle not in sleeping]
+
+    # cells of the vehicles sleeping at red lights, and the waiting time they are not credited yet
+    def pending_red_light_waits(self):
+        for sleepers in self.wakeups.values():
+            for vehicle, red_light_since in sleepers:
+                if red_light_since is not None:
+                    yield vehicle.store.position[vehicle.index], self.steps - red_light_since
+
+    def schedule_phase_change(self, light, step):
+        self.next_phase_change[light.unique_id] = step
+        self.phase_changes.setdefault(step, []).append(light)
+
+    def sleep(self, vehicle, step, red_light_since=None):
+        self.wakeups.setdefault(step, []).append((vehicle, red_light_since))
+        if red_light_since is not None:
+            self.red_sleepers += 1
+
+    def step_traffic_lights(self, step):
+        controller = self.model.light_controller
+        if type(controller) is FixedTimeController:
+            for light in self.phase_changes.pop(step, ()):
+                self.schedule_phase_change(light, step + max(light.change_phase(), 1))
+        elif type(controller) is VehicleActuatedController:
+            # only the lights with a vehicle in their cell
+            grid = self.model.grid
+            if self.light_cells is None:
+                self.light_cells = np.array(sorted(grid.traffic_lights), dtype=np.int64)
+            occupied = self.light_cells[grid.vehicle_count[self.light_cells] > 0]
+            for cell in occupied.tolist():
+                grid.traffic_lights[cell].check_for_other_vehicles()
+        else:
+            self.model.step_traffic_lights()
+
+    def step_vehicles(self, step):
+        model = self.model
+        fixed_time = self.fixed_time()
+        woken = []
+        for vehicle, red_light_since in self.wakeups.pop(step, ()):
+            if vehicle.unique_id not in self._agents:
+                continue
+            if red_light_since is not None:
+                # waited at the red light since red_light_since, the step it went to sleep
+                vehicle.waiting_traffic_lights += step - 1 - red_light_since
+                if model.heatmap is not None:
+                    model.heatmap.red_light[vehicle.store.position[vehicle.index]] += step - 1 - red_light_since
+                self.red_sleepers -= 1
+            else:
+                vehicle.counter_parking = model.max_waiting_time_non_transitable_in_steps
+                vehicle.parking = False
+            woken.append(vehicle)
+        model.waiting_traffic_lights += self.red_sleepers
+        if model.instrumentation is not None:
+            model.instrumentation.count('red_light_waits', self.red_sleepers)
+
+        woken.sort(key=lambda vehicle: vehicle.unique_id)
+        active = []
+        for vehicle in heapq.merge(self.active, woken, key=lambda vehicle: vehicle.unique_id):
+            pos = vehicle.pos
+            vehicle.step()
+            light = model.grid.traffic_light_at(vehicle.pos)
+            if vehicle.parking and light is None:
+                # counts down counter_parking steps, and resets parking in the next one
+                self.sleep(vehicle, step + vehicle.counter_parking + 2)
+            elif light is not None and fixed_time and vehicle.pos == pos \
+                    and not light.state() and self.next_phase_change[light.unique_id] > step + 1:
+                self.sleep(vehicle, self.next_phase_change[light.unique_id], step)
+            else:
+                active.append(vehicle)
+        self.active = active
+
+    def step(self):
+        step = self.steps + 1
+        instrumentation = self.model.instrumentation
+        if instrumentation is None:
+            self.step_traffic_lights(step)
+            self.step_vehicles(step)
+        else:
+            with instrumentation.timer('traffic_lights'):
+                self.step_traffic_lights(step)
+            with instrumentation.timer('vehicles'):
+                self.step_vehicles(step)
+        self.steps += 1
+        self.time += 1
@@ -0,0 +1,407 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import multiprocessing
+import queue
+
+import numpy as np
+
+from instrumentation import Instrumentation
+from vectorized import VectorizedEngine
+
+VEHICLE_FIELDS = ('gid', 'position', 'waiting_for_cars', 'waiting_traffic_lights', 'counter_parking', 'parking')
+
+
+# stand-in of TrafficModel inside a tile process, with what VectorizedEngine reads from the
+# model: the second scenario, the light controller, and the waiting totals and
+# instrumentation of the tile, handed to the real model after every step
+class TileModel:
+    def __init__(self, second_scenario, max_waiting_time_non_transitable_in_steps, light_controller):
+        self.second_scenario = second_scenario
+        self.light_controller = light_controller
+        self.max_waiting_time_non_transitable_in_steps = max_waiting_time_non_transitable_in_steps
+        self.waiting_for_cars = 0
+        self.waiting_traffic_lights = 0
+        self.instrumentation = Instrumentation()
+        self.heatmap = None
+
+
+# a rectangle of the grid (x in [x0, x1), y in [y0, y1)) stepped by its own process, with
+# VectorizedEngine code. Tile arrays cover the rectangle plus a halo of one cell around it
+# (the extended rectangle), since vehicles move one cell per step: cells are addressed by
+# their index in the extended rectangle, and converted to global grid indexes (x * width + y)
+# when talking to the neighbour tiles. Every cell is owned by one tile, which keeps its
+# occupancy and resolves the moves into it, so a move across a border is a request to the
+# neighbour tile, which accepts it or not like VectorizedEngine.resolve_moves would (free
+# cell, lowest vehicle index first), and then the vehicle is handed off to it
+class Tile(VectorizedEngine):
+
+    def __init__(self, tile_id, bounds, layout, seed):
+        x_bounds, y_bounds = bounds
+        tiles_y = len(y_bounds) - 1
+        self.tile_id = tile_id
+        self.x0, self.x1 = x_bounds[tile_id // tiles_y], x_bounds[tile_id // tiles_y + 1]
+        self.y0, self.y1 = y_bounds[tile_id % tiles_y], y_bounds[tile_id % tiles_y + 1]
+        self.width = layout.width
+        self.height = layout.height
+        self.ex0, self.ex1 = max(0, self.x0 - 1), min(self.height, self.x1 + 1)
+        self.ey0, self.ey1 = max(0, self.y0 - 1), min(self.width, self.y1 + 1)
+        self.bounds = bounds
+        self.rng = np.random.default_rng(seed)
+        model = layout.model
+        self.model = TileModel(model.second_scenario, model.max_waiting_time_non_transitable_in_steps,
+                               model.light_controller)
+
+        # extended rectangle: global index and owner tile of every cell, and the static layer
+        xs, ys = np.meshgrid(np.arange(self.ex0, self.ex1), np.arange(self.ey0, self.ey1), indexing='ij')
+        self.cell_global = (xs * self.width + ys).reshape(-1)
+        self.owner = self.tile_of(self.cell_global)
+        own = self.owner == tile_id
+        self.transitable = layout.transitable[self.cell_global]
+        self.successors = np.full((len(self.cell_global), 4), -1, dtype=np.int64)
+        self.successors_count = np.zeros(len(self.cell_global), dtype=np.int8)
+        successors = layout.successors[self.cell_global[own]]
+        self.successors[own] = np.where(successors >= 0, self.ext_index(successors), -1)
+        self.successors_count[own] = layout.successors_count[self.cell_global[own]]
+
+        # traffic lights of the tile, and the cells watched by the light controller (in the
+        # halo, when at the border, and -1 when out of the extended rectangle)
+        lights = np.flatnonzero(self.tile_of(layout.light_cell) == tile_id)
+        self.light_index = lights
+        self.light_cell = self.ext_index(layout.light_cell[lights])
+        self.time_green = layout.time_green[lights]
+        self.time_red = layout.time_red[lights]
+        self.time_green_counter = layout.time_green_counter[lights]
+        self.time_red_counter = layout.time_red_counter[lights]
+        self.light_at_cell = np.full(len(self.cell_global), -1, dtype=np.int64)
+        self.light_at_cell[self.light_cell] = np.arange(len(lights))
+        watched = layout.watched[lights]
+        x, y = np.divmod(watched, self.width)
+        extended = (watched >= 0) & (x >= self.ex0) & (x < self.ex1) & (y >= self.ey0) & (y < self.ey1)
+        self.watched = np.where(extended, self.ext_index(watched), -1)
+
+        # vehicles of the tile, always sorted by gid (their global vehicle index)
+        self.gid = np.zeros(0, dtype=np.int64)
+        self.position = np.zeros(0, dtype=np.int64)
+        self.waiting_for_cars = np.zeros(0, dtype=np.int64)
+        self.waiting_traffic_lights = np.zeros(0, dtype=np.int64)
+        self.counter_parking = np.zeros(0, dtype=np.int64)
+        self.parking = np.zeros(0, dtype=bool)
+        self.occupancy = np.zeros(len(self.cell_global), dtype=np.int64)
+
+        # neighbour tiles (the owners of the halo), and the halo cells exchanged with them
+        self.neighbours = sorted(set(np.unique(self.owner).tolist()) - {tile_id})
+        self.halo_out = {n: np.flatnonzero(own & self.in_extended(n)) for n in self.neighbours}
+        self.halo_in = {n: np.flatnonzero(self.owner == n) for n in self.neighbours}
+        self.inboxes = None
+        self.inbox = None
+        self.exchanges = 0
+        self.stash = {}
+
+    def tile_of(self, cells):
+        x_bounds, y_bounds = self.bounds
+        x, y = np.divmod(cells, self.width)
+        return (np.searchsorted(x_bounds, x, 'right') - 1) * (len(y_bounds) - 1) + \
+               np.searchsorted(y_bounds, y, 'right') - 1
+
+    # mask of the cells of this tile extended rectangle that are also in the extended
+    # rectangle of tile n
+    def in_extended(self, n):
+        x_bounds, y_bounds = self.bounds
+        tiles_y = len(y_bounds) - 1
+        x, y = np.divmod(self.cell_global, self.width)
+        return (x >= x_bounds[n // tiles_y] - 1) & (x < x_bounds[n // tiles_y + 1] + 1) & \
+               (y >= y_bounds[n % tiles_y] - 1) & (y < y_bounds[n % tiles_y + 1] + 1)
+
+    def ext_index(self, cells):
+        x, y = np.divmod(cells, self.width)
+        return (x - self.ex0) * (self.ey1 - self.ey0) + y - self.ey0
+
+    # sends a payload to every neighbour tile (payloads[n]), and receives theirs, for the same exchange. Neighbours can be one exchange ahead, so
+    # messages of later exchanges are stashed until asked for
+    def exchange(self, payloads):
+        self.exchanges += 1
+        for n in self.neighbours:
+            self.inboxes[n].put((self.tile_id, self.exchanges, payloads[n]))
+        received = self.stash.pop(self.exchanges, {})
+        while len(received) < len(self.neighbours):
+            sender, exchange, payload = self.inbox.get()
+            if exchange == self.exchanges:
+                received[sender] = payload
+            else:
+                self.stash.setdefault(exchange, {})[sender] = payload
+        return received
+
+    # occupancy of the halo, read by the light controller (see light_controllers)
+    def exchange_halo(self):
+        received = self.exchange({n: self.occupancy[self.halo_out[n]] for n in self.neighbours})
+        for n, occupancy in received.items():
+            self.occupancy[self.halo_in[n]] = occupancy
+
+    # moves into own cells are resolved here, the rest are sent to the tile owning the target
+    # cell, in two exchanges (requests, and accepted or not replies). Every tile takes part in
+    # every call, even without moves, as step_vehicles calls it the same times in all of them
+    def resolve_moves(self, candidates, targets):
+        gids = self.gid[candidates]
+        owners = self.owner[targets]
+        requests = self.exchange({n: (gids[owners == n], self.cell_global[targets[owners == n]])
+                                  for n in self.neighbours})
+        local = owners == self.tile_id
+        request_gids = np.concatenate([gids[local]] + [requests[n][0] for n in self.neighbours])
+        request_targets = np.concatenate([targets[local]] +
+                                         [self.ext_index(requests[n][1]) for n in self.neighbours])
+
+        free = self.occupancy[request_targets] == 0
+        order = np.argsort(request_gids[free], kind='stable')
+        _, first = np.unique(request_targets[free][order], return_index=True)
+        accepted = np.zeros(len(request_gids), dtype=bool)
+        accepted[np.flatnonzero(free)[order[first]]] = True
+        self.occupancy[request_targets[accepted]] += 1
+
+        replies = {}
+        offset = np.count_nonzero(local)
+        for n in self.neighbours:
+            replies[n] = accepted[offset:offset + len(requests[n][0])]
+            offset += len(requests[n][0])
+        replies = self.exchange(replies)
+        moved = np.zeros(len(candidates), dtype=bool)
+        moved[local] = accepted[:np.count_nonzero(local)]
+        for n in self.neighbours:
+            moved[owners == n] = replies[n]
+        winners = candidates[moved]
+        np.subtract.at(self.occupancy, self.position[winners], 1)
+        self.position[winners] = targets[moved]
+        return moved
+
+    # hands off the vehicles that moved into a neighbour tile, and takes the ones moved here
+    def migrate(self):
+        owners = self.owner[self.position]
+        leaving = {}
+        for n in self.neighbours:
+            out = owners == n
+            leaving[n] = {field: getattr(self, field)[out] for field in VEHICLE_FIELDS}
+            leaving[n]['position'] = self.cell_global[leaving[n]['position']]
+        staying = owners == self.tile_id
+        arriving = self.exchange(leaving)
+        for field in VEHICLE_FIELDS:
+            values = [getattr(self, field)[staying]]
+            for n in self.neighbours:
+                values.append(self.ext_index(arriving[n][field]) if field == 'position' else arriving[n][field])
+            setattr(self, field, np.concatenate(values))
+        order = np.argsort(self.gid, kind='stable')
+        for field in VEHICLE_FIELDS:
+            setattr(self, field, getattr(self, field)[order])
+
+    def step_vehicles(self):
+        super().step_vehicles()
+        self.migrate()
+
+    # vehicles spawned in the tile (global cells), with gids above every vehicle in it
+    def spawn(self, gids, cells):
+        if len(gids):
+            cells = self.ext_index(cells)
+            self.gid = np.append(self.gid, gids)
+            self.position = np.append(self.position, cells)
+            self.waiting_for_cars = np.append(self.waiting_for_cars, np.zeros(len(gids), dtype=np.int64))
+            self.waiting_traffic_lights = np.append(self.waiting_traffic_lights, np.zeros(len(gids), dtype=np.int64))
+            self.counter_parking = np.append(self.counter_parking, np.full(
+                len(gids), self.model.max_waiting_time_non_transitable_in_steps, dtype=np.int64))
+            self.parking = np.append(self.parking, np.zeros(len(gids), dtype=bool))
+            np.add.at(self.occupancy, cells, 1)
+
+    def step(self):
+        if self.model.light_controller.reads_occupancy:
+            with self.model.instrumentation.timer('traffic_lights'):
+                self.exchange_halo()
+        super().step()
+        model = self.model
+        result = (model.waiting_for_cars, model.waiting_traffic_lights, model.instrumentation.snapshot())
+        model.waiting_for_cars = model.waiting_traffic_lights = 0
+        model.instrumentation.reset()
+        return result
+
+    def vehicle_waiting_times(self):
+        return self.gid, self.waiting_for_cars, self.waiting_traffic_lights
+
+    # vehicles (with global positions) and traffic light counters of the tile, see ShardedEngine.state
+    def state(self):
+        vehicles = {field: getattr(self, field) for field in VEHICLE_FIELDS}
+        vehicles['position'] = self.cell_global[self.position]
+        return (vehicles, self.light_index, self.time_green_counter, self.time_red_counter,
+                self.rng.bit_generator.state)
+
+    # takes the vehicles in the tile, and the counters of its traffic lights, from the state of
+    # the whole grid
+    def load_state(self, vehicles, lights, random_state=None):
+        position = np.asarray(vehicles['position'])
+        self.gid = np.flatnonzero(self.tile_of(position) == self.tile_id)
+        for field in VEHICLE_FIELDS[1:]:
+            setattr(self, field, np.array(vehicles[field], dtype=getattr(self, field).dtype)[self.gid])
+        self.position = self.ext_index(self.position)
+        self.occupancy[:] = 0
+        np.add.at(self.occupancy, self.position, 1)
+        self.time_green_counter = np.array(lights['time_green_counter'], dtype=np.int64)[self.light_index]
+        self.time_red_counter = np.array(lights['time_red_counter'], dtype=np.int64)[self.light_index]
+        if random_state is not None:
+            self.rng.bit_generator.state = random_state
+
+
+# loop of a tile process, running the commands of ShardedEngine (after spawning the vehicles
+# sent with them)
+def run_tile(tile, inboxes, commands, results):
+    tile.inboxes = inboxes
+    tile.inbox = inboxes[tile.tile_id]
+    while True:
+        command, spawned = commands.get()
+        tile.spawn(*spawned)
+        if command == 'step':
+            results.put((tile.tile_id, tile.step()))
+        elif command == 'vehicles':
+            results.put((tile.tile_id, tile.vehicle_waiting_times()))
+        elif command == 'state':
+            results.put((tile.tile_id, tile.state()))
+        else:
+            break
+
+
+# Multi-process stepping engine for TrafficModel (engine='sharded'), for maps too big for
+# a single core. The grid is partitioned into tiles[0] x tiles[1] rectangular tiles, each one
+# stepped by its own process (see Tile), exchanging halo occupancy and border crossing
+# vehicles with its neighbours every step, while waiting totals and instrumentation are
+# aggregated into the model. Same rules than the vectorized engine, but every tile draws
+# from its own random number generator, so runs are not the same than with one process.
+# Processes are started on the first step, and stopped when reaching max_steps (or close())
+class ShardedEngine:
+
+    def __init__(self, model, tiles=(2, 2)):
+        if not (1 <= tiles[0] <= model.height and 1 <= tiles[1] <= model.width):
+            raise ValueError('tiles must be between (1, 1) and (height, width), not %r' % (tiles,))
+        self.model = model
+        layout = VectorizedEngine(model)
+        bounds = (np.linspace(0, model.height, tiles[0] + 1).astype(np.int64),
+                  np.linspace(0, model.width, tiles[1] + 1).astype(np.int64))
+        seeds = np.random.SeedSequence(model.random.getrandbits(64)).spawn(tiles[0] * tiles[1])
+        self.tiles = [Tile(i, bounds, layout, seed) for i, seed in enumerate(seeds)]
+        # vehicles spawned since the last command, sent with the next one
+        self.spawned = []
+        self.next_vehicle = 0
+        self.processes = None
+        self.commands = None
+        self.results = None
+
+    def start(self):
+        inboxes = {tile.tile_id: multiprocessing.Queue() for tile in self.tiles}
+        self.commands = [multiprocessing.Queue() for _ in self.tiles]
+        self.results = multiprocessing.Queue()
+        self.processes = []
+        for tile, commands in zip(self.tiles, self.commands):
+            process = multiprocessing.Process(target=run_tile, args=(tile, inboxes, commands, self.results),
+                                              daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def spawn(self, cells):
+        self.spawned.extend(cells)
+
+    # vehicles spawned since the last command, as their gids and cells for every tile
+    def take_spawned(self):
+        cells = np.array(self.spawned, dtype=np.int64)
+        gids = np.arange(self.next_vehicle, self.next_vehicle + len(cells))
+        owner = self.tiles[0].tile_of(cells)
+        self.spawned = []
+        self.next_vehicle += len(cells)
+        return [(gids[owner == i], cells[owner == i]) for i in range(len(self.tiles))]
+
+    # sends a command to every tile (with the vehicles spawned in it), and waits for all the
+    # results, by tile
+    def broadcast(self, command):
+        if self.processes is None:
+            self.start()
+        for commands, spawned in zip(self.commands, self.take_spawned()):
+            commands.put((command, spawned))
+        results = {}
+        while len(results) < len(self.tiles):
+            try:
+                tile_id, result = self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    self.close()
+                    raise RuntimeError('a tile process of the sharded engine died')
+                continue
+            results[tile_id] = result
+        return [results[i] for i in range(len(self.tiles))]
+
+    # phase times are the slowest tile ones, and counters the sum of all tiles
+    def step(self):
+        model = self.model
+        instrumentation = model.instrumentation
+        results = self.broadcast('step')
+        for waiting_for_cars, waiting_traffic_lights, _ in results:
+            model.waiting_for_cars += waiting_for_cars
+            model.waiting_traffic_lights += waiting_traffic_lights
+        if instrumentation is not None:
+            for phase in ('traffic_lights', 'vehicles'):
+                instrumentation.timers[phase] += max(snapshot['timers'][phase] for _, _, snapshot in results)
+            for _, _, snapshot in results:
+                for counter, amount in snapshot['counters'].items():
+                    instrumentation.count(counter, amount)
+
+    # waiting counters of the vehicles introduced in the grid, gathered from every tile
+    def vehicle_waiting_times(self):
+        gids, waiting_for_cars, waiting_traffic_lights = (np.concatenate(values) for values in
+                                                          zip(*self.broadcast('vehicles')))
+        order = np.argsort(gids)
+        return gids[order], waiting_for_cars[order], waiting_traffic_lights[order]
+
+    # state of the whole grid, gathered from every tile, in the same form than
+    # VectorizedEngine.state (with the random generator state of every tile)
+    def state(self):
+        if self.processes is None:
+            for tile, spawned in zip(self.tiles, self.take_spawned()):
+                tile.spawn(*spawned)
+            states = [tile.state() for tile in self.tiles]
+        else:
+            states = self.broadcast('state')
+        order = np.argsort(np.concatenate([vehicles['gid'] for vehicles, *_ in states]))
+        vehicles = {field: np.concatenate([state[0][field] for state in states])[order]
+                    for field in VEHICLE_FIELDS[1:]}
+        n_lights = sum(len(state[1]) for state in states)
+        lights = {'time_green_counter': np.zeros(n_lights, dtype=np.int64),
+                  'time_red_counter': np.zeros(n_lights, dtype=np.int64)}
+        for _, light_index, time_green_counter, time_red_counter, _ in states:
+            lights['time_green_counter'][light_index] = time_green_counter
+            lights['time_red_counter'][light_index] = time_red_counter
+        return vehicles, lights, [state[4] for state in states]
+
+    # loads the state of the whole grid into the tiles, before they are started
+    def load_state(self, vehicles, lights, random_state=None):
+        if self.processes is not None:
+            raise RuntimeError('state can only be loaded before the first step')
+        self.spawned = []
+        self.next_vehicle = len(vehicles['position'])
+        for i, tile in enumerate(self.tiles):
+            tile.load_state(vehicles, lights, None if random_state is None else random_state[i])
+
+    # occupancy counters of the whole grid, from the vehicles of every tile
+    @property
+    def occupancy(self):
+        n_cells = self.model.width * self.model.height
+        return np.bincount(self.state()[0]['position'], minlength=n_cells)
+
+    # stops the processes, keeping the state of the tiles in this process (so the state can
+    # still be read after max_steps, like for a checkpoint)
+    def close(self):
+        if self.processes is not None:
+            state = None
+            if all(process.is_alive() for process in self.processes):
+                state = self.state()
+            for commands in self.commands:
+                commands.put(('stop', ([], [])))
+            for process in self.processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+            self.processes = None
+            if state is not None:
+                self.load_state(*state)
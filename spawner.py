@@ -0,0 +1,88 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+from collections import deque
+
+import numpy as np
+
+
+# Arrival of vehicles into the grid of a TrafficModel (see TrafficModel(..., entry_cells,
+# spawn_rate, poisson_arrivals, initial_vehicles)). Every step, spawn_rate vehicles arrive
+# (a fractional rate is accumulated between steps, or drawn as Poisson arrivals with that mean)
+# and are queued to the entry cells, in turns. Each entry cell lets one queued vehicle in per
+# step, and the rest keep waiting in the queue, so vehicles are only created when they actually
+# enter the grid. Default is one vehicle per step at (0, 0). Vehicles can also be spawned in
+# bulk, all at once on random free transitable cells (see spawn_bulk). Cells are flat grid
+# indexes, x * width + y, like in the engines
+class Spawner:
+
+    def __init__(self, model, entry_cells=((0, 0),), rate=1, poisson=False):
+        if rate < 0:
+            raise ValueError('spawn rate must not be negative, not %r' % rate)
+        for pos in entry_cells:
+            if not (0 <= pos[0] < model.height and 0 <= pos[1] < model.width) or not model.is_transitable(pos):
+                raise ValueError('entry cell %r is not a transitable cell of the grid' % (pos,))
+        self.model = model
+        self.entry_cells = [pos[0] * model.width + pos[1] for pos in entry_cells]
+        self.rate = rate
+        self.poisson = poisson
+        self.rng = None
+        if poisson:
+            self.rng = np.random.default_rng(model.random.getrandbits(64))
+        self.credit = 0.0
+        self.next_entry = 0
+        self.pending = deque()
+        self.arrived = 0  # vehicles that arrived so far, queued or already in the grid
+
+    # amount of vehicles arriving in this step, up to the amount of vehicles of the model
+    def arrivals(self):
+        if self.poisson:
+            arrivals = int(self.rng.poisson(self.rate))
+        else:
+            self.credit += self.rate
+            arrivals = int(self.credit)
+            self.credit -= arrivals
+        return min(arrivals, self.model.total_amount_vehicles - self.arrived)
+
+    # queues this step arrivals, and returns the cells of the vehicles entering the grid. Entry
+    # cells are assigned in turns, so the first len(entry_cells) queued vehicles wait at
+    # different entries
+    def step(self):
+        for _ in range(self.arrivals()):
+            self.pending.append(self.entry_cells[self.next_entry])
+            self.next_entry = (self.next_entry + 1) % len(self.entry_cells)
+            self.arrived += 1
+        return [self.pending.popleft() for _ in range(min(len(self.pending), len(self.entry_cells)))]
+
+    # cells for amount vehicles spawned at once (not queued), on random free transitable cells
+    def spawn_bulk(self, amount):
+        model = self.model
+        if self.rng is None:
+            self.rng = np.random.default_rng(model.random.getrandbits(64))
+        engine = model.vectorized_engine
+        occupancy = model.grid.vehicle_count if engine is None else engine.occupancy
+        free = np.flatnonzero((np.asarray(model.restriction_matrix)[::-1] != -1).reshape(-1) & (occupancy == 0))
+        amount = min(amount, len(free), model.total_amount_vehicles - self.arrived)
+        self.arrived += amount
+        return self.rng.choice(free, size=amount, replace=False).tolist()
+
+    # queue and arrival counters, and random generator state (see checkpoint)
+    def state(self):
+        return {'credit': self.credit, 'next_entry': self.next_entry, 'pending': list(self.pending),
+                'arrived': self.arrived, 'random_state': None if self.rng is None else self.rng.bit_generator.state}
+
+    def load_state(self, state, random_state=True):
+        self.credit = state['credit']
+        self.next_entry = state['next_entry']
+        self.pending = deque(state['pending'])
+        if not set(self.pending) <= set(self.entry_cells):
+            # entry cells changed (like a fork with other ones), queued vehicles wait at the new ones
+            self.pending = deque(self.entry_cells[i % len(self.entry_cells)] for i in range(len(self.pending)))
+            self.next_entry = len(self.pending)
+        self.next_entry %= len(self.entry_cells)
+        self.arrived = state['arrived']
+        if random_state and state['random_state'] is not None:
+            if self.rng is None:
+                self.rng = np.random.default_rng()
+            self.rng.bit_generator.state = state['random_state']
@@ -0,0 +1,72 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import argparse
+import itertools
+import json
+from multiprocessing import Pool
+
+import pandas as pd
+
+from model import TrafficModel
+
+
+# expands a grid of TrafficModel parameters (a single value, or values to sweep wrapped as
+# {"sweep": [values]}, for each one, like width, height, non_transitable_cells, vehicles,
+# second_scenario...) into every combination of them, repeated for every seed. Any other
+# value is passed as it is, also sequences like entry_cells or tiles
+def make_runs(parameters, seeds):
+    names = list(parameters)
+    values = [value['sweep'] if swept(value) else [value] for value in parameters.values()]
+    runs = []
+    for combination in itertools.product(*values):
+        for seed in seeds:
+            runs.append(dict(zip(names, combination), seed=seed))
+    return runs
+
+
+def swept(value):
+    return isinstance(value, dict) and list(value) == ['sweep']
+
+
+# runs a single model until max_steps, without visualization, and returns its collected
+# metrics as rows, one per collected step (plus the final state) with the run parameters
+def run_model(run):
+    run_id, kwargs = run
+    model = TrafficModel(**kwargs)
+    for _ in range(model.max_steps):
+        model.step()
+    model.datacollector.collect(model)
+    data = model.datacollector.get_model_vars_dataframe()
+    data.insert(0, 'Step', list(range(0, model.max_steps, model.collect_interval)) + [model.max_steps])
+    for name, value in reversed(list(kwargs.items())):
+        data.insert(0, name, [value] * len(data))
+    data.insert(0, 'RunId', run_id)
+    return data
+
+
+# runs every parameter combination for every seed, spread across a process pool (all cores
+# by default), and merges the results into a single table, sorted by run
+def run_sweep(parameters, seeds, processes=None):
+    runs = list(enumerate(make_runs(parameters, seeds)))
+    if processes == 1:
+        results = [run_model(run) for run in runs]
+    else:
+        with Pool(processes) as pool:
+            results = list(pool.imap_unordered(run_model, runs))
+    results = pd.concat(results, ignore_index=True)
+    return results.sort_values(['RunId', 'Step'], ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless parameter sweep of TrafficModel')
+    parser.add_argument('parameters', help='JSON file with TrafficModel parameters, single values '
+                                           'or {"sweep": [values]} to sweep')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--processes', type=int, default=None, help='defaults to all cores')
+    parser.add_argument('--output', default='sweep.csv')
+    args = parser.parse_args()
+    with open(args.parameters) as f:
+        parameters = json.load(f)
+    run_sweep(parameters, args.seeds, args.processes).to_csv(args.output, index=False)
@@ -0,0 +1,26 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+# modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import TrafficModel  # noqa: E402
+
+
+# builds a TrafficModel without its startup summary
+@pytest.fixture
+def build():
+    def build(width=30, height=20, max_steps=100, non_transitable_cells=10, vehicles=20,
+              second_scenario=True, third_scenario=False, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return TrafficModel(width, height, max_steps, non_transitable_cells, vehicles, 2,
+                                second_scenario, third_scenario, **kwargs)
+    return build
@@ -0,0 +1,26 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import pytest
+
+from benchmark import compare, run_case
+
+
+@pytest.mark.parametrize('engine', ['agents', 'vectorized'])
+def test_render_times_only_for_the_agents_engine(engine):
+    case = dict(size=20, vehicles=5, non_transitable=10, scenario='first', engine=engine, seed=0)
+    _, result = run_case((case, 10, 3))
+    assert ('render_mean' in result) == (engine == 'agents')
+    assert result['steps_per_second'] > 0
+
+
+def test_compare_ignores_changes_under_the_noise_floor():
+    baseline = {'steps': 100, 'cases': {'case': {'startup': 0.002, 'step_p50': 0.0001, 'steps_per_second': 10000,
+                                                 'peak_memory': 1000, 'render_mean': 0.5}}}
+    results = {'steps': 100, 'cases': {'case': {'startup': 0.004, 'step_p50': 0.0002, 'steps_per_second': 7000,
+                                                'peak_memory': 1500, 'render_mean': 0.7}}}
+    regressions = compare(results, baseline, 0.2, noise_floor=0.01)
+    assert [metric for _, metric, _, _, _ in regressions] == ['peak_memory', 'render_mean']
+    regressions = compare(results, baseline, 0.2, noise_floor=0)
+    assert len(regressions) == 5
@@ -0,0 +1,97 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import contextlib
+import io
+
+import pytest
+
+from overload_canvas_grid import CanvasGrid
+
+with contextlib.redirect_stdout(io.StringIO()):
+    from model_viz import agent_portrayal
+
+
+# client side of the frames, like CanvasDeltaModule.js: the palette, the static layer and the
+# style ids of every cell, updated by every frame on top of the previous one
+class Client:
+    def __init__(self):
+        self.styles = {}
+        self.static = None
+        self.cells = {}
+        self.frame = None
+
+    def receive(self, data):
+        self.styles.update(data['styles'])
+        if 'static' in data:
+            self.static = data['static']
+        if data['base'] is None:
+            self.cells = {}
+        elif data['base'] != self.frame:
+            return False
+        for index, styles in data['cells']:
+            if styles:
+                self.cells[index] = styles
+            else:
+                self.cells.pop(index, None)
+        self.frame = data['frame']
+        return True
+
+    # portrayals of every cell, and of every static value
+    def picture(self):
+        cells = {index: [self.styles[style] for style in styles] for index, styles in self.cells.items()}
+        static = {value: self.styles[style] for value, style in self.static['styles'].items()}
+        return cells, self.static['values'], static
+
+
+# a full render of the model, as a new client sees it
+def full_picture(model):
+    client = Client()
+    client.receive(CanvasGrid(agent_portrayal, model.width, model.height).render(model))
+    return client.picture()
+
+
+@pytest.mark.parametrize('third_scenario', [False, True])
+def test_deltas_on_keyframes_match_full_render(build, third_scenario):
+    model = build(max_steps=40, third_scenario=third_scenario, seed=2, initial_vehicles=40)
+    grid = CanvasGrid(agent_portrayal, model.width, model.height, keyframe_interval=8)
+    client = Client()
+    for step in range(40):
+        data = grid.render(model)
+        if step % 8 == 0:
+            assert data['base'] is None and 'static' in data
+            assert len(data['styles']) == len(grid.session.styles)
+        else:
+            assert 'static' not in data
+        assert client.receive(data)
+        assert client.picture() == full_picture(model)
+        model.step()
+
+
+# every client gets its own frames: clients stepping the same model in turns, or one of them
+# resetting it, don't break the frames of the others
+def test_sessions_per_client(build):
+    model = build(max_steps=30, seed=3, initial_vehicles=30)
+    grid = CanvasGrid(agent_portrayal, model.width, model.height)
+    clients = {'a': Client(), 'b': Client()}
+    for _ in range(10):
+        for key, client in clients.items():
+            assert client.receive(grid.render(model, key))
+            assert client.picture() == full_picture(model)
+            model.step()
+
+    other = build(max_steps=30, seed=4, initial_vehicles=30)
+    data = grid.render(other, 'b')
+    assert data['base'] is None and 'static' in data
+    assert clients['b'].receive(data)
+    assert clients['b'].picture() == full_picture(other)
+    assert clients['a'].receive(grid.render(model, 'a'))
+    assert clients['a'].picture() == full_picture(model)
+
+    # clients joining in the middle get the last frame as a keyframe
+    late = Client()
+    late.receive(grid.keyframe(model, 'a'))
+    assert late.picture() == clients['a'].picture()
+    grid.close('a')
+    assert list(grid.sessions) == ['b']
@@ -0,0 +1,67 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+from checkpoint import load_checkpoint, model_state, save_checkpoint
+
+
+def collected(model):
+    return model.datacollector.get_model_vars_dataframe().values.tolist()
+
+
+# a restored model continues exactly like the saved one, with the same engine
+@pytest.mark.parametrize('engine, scheduler', [('agents', 'base'), ('agents', 'active'), ('vectorized', 'base'),
+                                               ('sharded', 'base')])
+@pytest.mark.parametrize('third_scenario', [False, True])
+def test_resume_is_exact(build, tmp_path, engine, scheduler, third_scenario):
+    parameters = dict(width=20, height=15, max_steps=90, vehicles=30, third_scenario=third_scenario,
+                      engine=engine, scheduler=scheduler, seed=7)
+    uninterrupted = build(**parameters)
+    saved = build(**parameters)
+    for _ in range(40):
+        uninterrupted.step()
+        saved.step()
+    save_checkpoint(saved, str(tmp_path / 'model.ckpt'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        restored = load_checkpoint(str(tmp_path / 'model.ckpt'))
+    for _ in range(50):
+        uninterrupted.step()
+        restored.step()
+    assert collected(restored) == collected(uninterrupted)
+    if engine != 'sharded':
+        for before, after in zip(model_state(uninterrupted)[:2], model_state(restored)[:2]):
+            for name in before:
+                assert np.array_equal(before[name], after[name]), name
+
+
+# vehicles sleeping in ActiveScheduler (parked, or at a red light) are still asleep when restored
+@pytest.mark.parametrize('seed', range(4))
+def test_resume_keeps_active_scheduler_sleepers(build, tmp_path, seed):
+    parameters = dict(width=30, height=20, non_transitable_cells=15, vehicles=25, scheduler='active', seed=seed)
+    uninterrupted = build(**parameters)
+    for _ in range(60):
+        uninterrupted.step()
+    save_checkpoint(uninterrupted, str(tmp_path / 'model.ckpt'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        restored = load_checkpoint(str(tmp_path / 'model.ckpt'))
+    for _ in range(40):
+        uninterrupted.step()
+        restored.step()
+        assert (restored.waiting_for_cars, restored.waiting_traffic_lights) == \
+               (uninterrupted.waiting_for_cars, uninterrupted.waiting_traffic_lights)
+    before, after = model_state(uninterrupted)[0], model_state(restored)[0]
+    for name in before:
+        assert np.array_equal(before[name], after[name]), name
+
+
+def test_map_parameters_are_fixed(build, tmp_path):
+    model = build(seed=1)
+    save_checkpoint(model, str(tmp_path / 'model.ckpt'))
+    with pytest.raises(ValueError):
+        load_checkpoint(str(tmp_path / 'model.ckpt'), width=40)
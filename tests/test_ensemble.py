@@ -0,0 +1,73 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import pandas as pd
+import pytest
+
+from ensemble import METRICS, Configuration, run_ensemble, t_quantile
+
+
+# tables of the Student's t distribution
+@pytest.mark.parametrize('p, df, expected', [
+    (0.975, 1, 12.706205), (0.975, 2, 4.302653), (0.975, 3, 3.182446), (0.995, 3, 5.840909),
+    (0.995, 4, 4.604095), (0.975, 10, 2.228139), (0.95, 99, 1.660391), (0.025, 3, -3.182446),
+])
+def test_t_quantile(p, df, expected):
+    assert t_quantile(p, df) == pytest.approx(expected, abs=1e-6)
+
+
+def test_replications_accepted_in_order():
+    values = [[1, 2, 3], [4, 6, 8], [2, 2, 2], [7, 1, 5]]
+    in_order, shuffled = Configuration(0, {}), Configuration(0, {})
+    for replication, value in enumerate(values):
+        in_order.accept(replication, value)
+        assert in_order.accept_next()
+    shuffled.accept(2, values[2])
+    shuffled.accept(1, values[1])
+    assert not shuffled.accept_next()
+    shuffled.accept(0, values[0])
+    while shuffled.accept_next():
+        pass
+    assert shuffled.accepted == values[:3] and shuffled.pending == {}
+    shuffled.accept(3, values[3])
+    assert shuffled.accept_next()
+    assert shuffled.summary(0.95) == in_order.summary(0.95)
+
+
+CONFIGURATIONS = [dict(width=12, height=10, max_steps=30, non_transitable_cells=4, vehicles=10,
+                       max_waiting_time_non_transitable_in_steps=2, second_scenario=True, third_scenario=third)
+                  for third in (False, True)]
+
+
+def test_stops_at_min_replications_when_precise():
+    summary, replications = run_ensemble(CONFIGURATIONS, relative_precision=1e9, min_replications=3,
+                                         max_replications=6, processes=1)
+    assert summary['Replications'].tolist() == [3, 3]
+    assert summary['Converged'].all()
+    assert len(replications) == 6
+
+
+def test_stops_at_max_replications_when_not_precise():
+    summary, _ = run_ensemble(CONFIGURATIONS, relative_precision=1e-9, min_replications=2,
+                              max_replications=4, processes=1)
+    assert summary['Replications'].tolist() == [4, 4]
+    assert not summary['Converged'].any()
+
+
+# the configurations converge after different amounts of replications, while more are in flight
+def test_same_result_for_any_amount_of_processes():
+    results = [run_ensemble(CONFIGURATIONS, relative_precision=0.7, min_replications=2, max_replications=10,
+                            processes=processes) for processes in (1, 3)]
+    (summary, replications), (other_summary, other_replications) = results
+    assert summary['Replications'].tolist() == [10, 7] and summary['Converged'].all()
+    pd.testing.assert_frame_equal(summary, other_summary)
+    pd.testing.assert_frame_equal(replications, other_replications)
+    assert set(METRICS) <= set(replications.columns)
+
+
+def test_invalid_replications():
+    with pytest.raises(ValueError):
+        run_ensemble(CONFIGURATIONS, min_replications=1)
+    with pytest.raises(ValueError):
+        run_ensemble(CONFIGURATIONS, min_replications=5, max_replications=4)
@@ -0,0 +1,100 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+from checkpoint import load_checkpoint, model_state, save_checkpoint
+from heatmap import COUNTERS, CongestionHeatmap
+
+ENGINES = [('agents', 'base'), ('agents', 'active'), ('vectorized', 'base')]
+
+
+# waits and parking events of every cell add up to the totals of the model, and occupancy
+# steps to the vehicles counted in every cell at the end of every step
+@pytest.mark.parametrize('engine, scheduler', ENGINES)
+@pytest.mark.parametrize('third_scenario', [False, True])
+def test_counters(build, engine, scheduler, third_scenario):
+    model = build(seed=3, vehicles=25, engine=engine, scheduler=scheduler, third_scenario=third_scenario,
+                  heatmap=True, instrumentation=True)
+    occupancy = np.zeros(model.width * model.height, dtype=np.int64)
+    for _ in range(60):
+        model.step()
+        occupancy += np.bincount(model_state(model)[0]['position'], minlength=len(occupancy))
+        counters = model.heatmap.counters()
+        assert np.array_equal(counters['occupancy'], occupancy)
+        assert counters['blocked'].sum() == model.waiting_for_cars
+        assert counters['red_light'].sum() == model.waiting_traffic_lights
+        assert counters['parking'].sum() == model.instrumentation.snapshot()['counters']['parking_events']
+
+
+def test_snapshot_shape(build):
+    model = build(seed=4, heatmap=True)
+    for _ in range(30):
+        model.step()
+    counters, snapshot = model.heatmap.counters(), model.heatmap.snapshot()
+    for name in COUNTERS:
+        assert snapshot[name].shape == np.shape(model.restriction_matrix)
+        # row height - x - 1 and column y of the restriction matrix for grid cell (x, y)
+        for cell in np.flatnonzero(counters[name]):
+            x, y = divmod(cell, model.width)
+            assert snapshot[name][model.height - x - 1, y] == counters[name][cell]
+
+
+def test_window_and_half_life(build):
+    model = build(seed=5, heatmap=CongestionHeatmap(interval=10))
+    kept = {}
+    for _ in range(35):
+        model.step()
+        if model.steps_counter % 10 == 0:
+            kept[model.steps_counter] = model.heatmap.counters()
+    heatmap, now = model.heatmap, model.heatmap.counters()
+    # windows start at the last counters kept at or before now - window
+    window = heatmap.snapshot(window=15)
+    whole = heatmap.snapshot(window=50)
+    for name in COUNTERS:
+        assert np.array_equal(window[name], heatmap.snapshot()[name] - kept[20][name].reshape(20, 30)[::-1])
+        assert np.array_equal(whole[name], heatmap.snapshot()[name])
+    # counts between kept counters weigh as old as the end of their interval
+    decayed = heatmap.snapshot(half_life=10)
+    for name in COUNTERS:
+        expected = (0.5 ** 2.5 * kept[10][name] + 0.5 ** 1.5 * (kept[20][name] - kept[10][name]) +
+                    0.5 ** 0.5 * (kept[30][name] - kept[20][name]) + (now[name] - kept[30][name]))
+        assert np.allclose(decayed[name], expected.reshape(20, 30)[::-1])
+
+
+def test_window_without_kept_counters(build):
+    model = build(seed=6, max_steps=200, heatmap=CongestionHeatmap(interval=100))
+    for _ in range(120):
+        model.step()
+    with pytest.raises(ValueError):
+        model.heatmap.snapshot(window=50)
+    model.heatmap.snapshot(window=20)
+    model = build(seed=6, heatmap=CongestionHeatmap(interval=10, history=2))
+    for _ in range(55):
+        model.step()
+    model.heatmap.snapshot(window=15)
+    with pytest.raises(ValueError):
+        model.heatmap.snapshot(window=30)
+
+
+# a restored model counts from the restored step, what the saved one counts since then
+def test_restored_checkpoint(build, tmp_path):
+    parameters = dict(seed=7, vehicles=25, heatmap=True)
+    uninterrupted, saved = build(**parameters), build(**parameters)
+    for _ in range(40):
+        uninterrupted.step()
+        saved.step()
+    at_save = uninterrupted.heatmap.counters()
+    save_checkpoint(saved, str(tmp_path / 'model.ckpt'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        restored = load_checkpoint(str(tmp_path / 'model.ckpt'), heatmap=True)
+    for _ in range(30):
+        uninterrupted.step()
+        restored.step()
+    for name, values in uninterrupted.heatmap.counters().items():
+        assert np.array_equal(restored.heatmap.counters()[name], values - at_save[name]), name
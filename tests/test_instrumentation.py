@@ -0,0 +1,44 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import json
+import time
+
+import pytest
+
+from instrumentation import COUNTERS, PHASES, Instrumentation
+
+
+def test_disabled_by_default(build):
+    model = build(seed=1)
+    assert model.instrumentation is None
+    instrumented = build(seed=1, instrumentation=True)
+    for _ in range(50):
+        model.step()
+        instrumented.step()
+    # instrumentation doesn't change the run
+    assert (model.waiting_for_cars, model.waiting_traffic_lights) == \
+           (instrumented.waiting_for_cars, instrumented.waiting_traffic_lights)
+
+
+@pytest.mark.parametrize('engine, scheduler', [('agents', 'base'), ('agents', 'active'), ('vectorized', 'base')])
+def test_counters_and_phase_timers(build, engine, scheduler):
+    output = []
+    model = build(seed=2, engine=engine, scheduler=scheduler,
+                  instrumentation=Instrumentation(dump_interval=10, output=output.append))
+    start = time.perf_counter()
+    for _ in range(50):
+        model.step()
+    elapsed = time.perf_counter() - start
+    snapshot = model.instrumentation.snapshot()
+    assert set(snapshot['timers']) == set(PHASES) and set(snapshot['counters']) == set(COUNTERS)
+    for phase in ('traffic_lights', 'vehicles', 'data_collection'):
+        assert snapshot['timers'][phase] > 0
+    # phases are timed apart, within the time of the steps
+    assert sum(snapshot['timers'].values()) <= elapsed
+    assert snapshot['counters']['red_light_waits'] == model.waiting_traffic_lights
+    assert snapshot['counters']['blocked_moves'] == model.waiting_for_cars
+    assert [json.loads(line)['step'] for line in output] == [10, 20, 30, 40, 50]
+    model.instrumentation.reset()
+    assert sum(model.instrumentation.snapshot()['counters'].values()) == 0
@@ -0,0 +1,108 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from light_controllers import QueueLengthController, make_controller
+
+
+# a step of a traffic light with the per light rules the controllers replaced: a fixed time
+# cycle, or (third scenario) red when there is a vehicle in its cell and in any of the two
+# corners in its direction, green with a vehicle and free corners, unchanged otherwise
+def per_light_step(model, light, counters, third_scenario):
+    green_counter, red_counter = counters
+    if not third_scenario:
+        if red_counter == 0:
+            green_counter = max(0, green_counter - 1)
+            if green_counter == 0:
+                red_counter = light.time_red
+        else:
+            red_counter = max(0, red_counter - 1)
+            if red_counter == 0:
+                green_counter = light.time_green
+        return green_counter, red_counter
+    x, y = light.pos
+    direction = model.get_direction([x, y])
+    first = (x + [1, -1, -1, 1][direction], y + [1, 1, -1, -1][direction])
+    second = (x + [-1, -1, 1, 1][direction], y + [1, -1, -1, 1][direction])
+    in_limits = all(0 <= cx < model.height and 0 <= cy < model.width for cx, cy in (first, second))
+    if in_limits and model.grid.has_vehicle((x, y)):
+        if model.grid.has_vehicle(first) or model.grid.has_vehicle(second):
+            return 0, 1
+        return 1, 0
+    return green_counter, red_counter
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('third_scenario', [False, True])
+def test_batched_controllers_match_per_light_rules(build, seed, third_scenario):
+    model = build(40, 30, max_steps=80, vehicles=30, third_scenario=third_scenario, seed=seed, initial_vehicles=200)
+    lights = [light for light in model.schedule.agents if type(light).__name__ == 'TrafficLightAgent']
+    for _ in range(80):
+        # lights are decided before vehicles move, on the occupancy at the start of the step
+        expected = [per_light_step(model, light, (light.time_green_counter, light.time_red_counter), third_scenario)
+                    for light in lights]
+        model.step()
+        assert [(light.time_green_counter, light.time_red_counter) for light in lights] == expected
+
+
+# two lights on a hand built map: L1 at grid cell (0, 2) pointing right, watching (0, 2),
+# (0, 1) and (0, 0), and L2 at (1, 3) pointing down, watching (1, 3), (2, 3) and (3, 3)
+@pytest.fixture
+def queue_lights():
+    matrix = np.zeros((4, 4), dtype=np.int8)
+    matrix[0:3, 3] = 1  # grid cells (1..3, 3) point down
+    layout = SimpleNamespace(width=4, height=4, restriction_matrix=matrix)
+    controller = QueueLengthController(threshold=2, depth=3, min_green=2, max_red=5)
+    cells = np.array([0 * 4 + 2, 1 * 4 + 3])
+    watched = controller.compile(layout, cells)
+    lights = SimpleNamespace(light_cell=cells, time_green=np.array([4, 4]), time_red=np.array([9, 9]),
+                             time_green_counter=np.array([0, 0]), time_red_counter=np.array([5, 5]))
+    return controller, watched, lights
+
+
+def occupancy_of(cells):
+    occupancy = np.zeros(16, dtype=np.int32)
+    for x, y in cells:
+        occupancy[x * 4 + y] += 1
+    return occupancy
+
+
+def test_queue_cells(queue_lights):
+    _, watched, _ = queue_lights
+    assert watched.tolist() == [[2, 1, 0], [7, 11, 15]]
+
+
+def test_queue_controller_turns_green_the_longer_queue(queue_lights):
+    controller, watched, lights = queue_lights
+    # L1 has 3 vehicles queued, L2 only 1: L1 turns green, L2 keeps waiting
+    controller.step(lights, watched, occupancy_of([(0, 0), (0, 1), (0, 2), (2, 3)]))
+    assert (lights.time_red_counter == 0).tolist() == [True, False]
+    assert lights.time_green_counter[0] == 2
+    # the queues swap: L2 turns green, and L1 stays green while its min_green lasts
+    occupancy = occupancy_of([(0, 2), (1, 3), (2, 3), (3, 3)])
+    controller.step(lights, watched, occupancy)
+    assert (lights.time_red_counter == 0).tolist() == [True, True]
+    # L1 stays green after min_green while its queue is not empty, and turns red once it is
+    controller.step(lights, watched, occupancy)
+    assert lights.time_red_counter[0] == 0
+    controller.step(lights, watched, occupancy_of([(1, 3)]))
+    assert lights.time_red_counter.tolist() == [5, 0]
+    # a red light without queue turns green after max_red steps
+    for _ in range(5):
+        controller.step(lights, watched, occupancy_of([(1, 3)]))
+    assert lights.time_red_counter[0] == 0
+
+
+def test_make_controller():
+    assert make_controller(None, False).policy == 'fixed'
+    assert make_controller(None, True).policy == 'actuated'
+    controller = make_controller({'policy': 'queue', 'threshold': 3})
+    assert (controller.policy, controller.threshold) == ('queue', 3)
+    assert make_controller(controller.spec()).spec() == controller.spec()
+    with pytest.raises(ValueError):
+        make_controller('unknown')
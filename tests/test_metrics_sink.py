@@ -0,0 +1,69 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import pandas as pd
+import pytest
+
+from metrics_sink import MetricsSink
+
+
+def read(path):
+    if path.endswith('.csv'):
+        return pd.read_csv(path)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_feather(path)
+
+
+# waiting counters of every vehicle in the grid, read from the vehicles themselves
+def vehicle_counters(model):
+    step = model.steps_counter
+    engine = model.vectorized_engine
+    if engine is None:
+        return [[step, vehicle.unique_id, vehicle.waiting_for_cars, vehicle.waiting_traffic_lights]
+                for vehicle in model.vehicles]
+    return [[step, model.last_unique_id + 1 + i, int(engine.waiting_for_cars[i]), int(engine.waiting_traffic_lights[i])]
+            for i in range(engine.next_vehicle)]
+
+
+# rows streamed to disk are the ones the datacollector keeps in memory, and per vehicle rows
+# the waiting counters of every vehicle at every collected step. Without non transitable
+# cells, ActiveScheduler runs the same than BaseScheduler, which the reference run uses
+@pytest.mark.parametrize('extension', ['.csv', '.parquet', '.arrow'])
+@pytest.mark.parametrize('engine, scheduler', [('agents', 'base'), ('agents', 'active'), ('vectorized', 'base')])
+def test_sink_rows_match_datacollector(build, tmp_path, extension, engine, scheduler):
+    parameters = dict(max_steps=60, non_transitable_cells=0, engine=engine, seed=4, collect_interval=3)
+    reference = build(**parameters)
+    vehicle_rows = []
+    for _ in range(60):
+        if reference.steps_counter % 3 == 0:
+            vehicle_rows.extend(vehicle_counters(reference))
+        reference.step()
+    parameters['scheduler'] = scheduler
+
+    path = str(tmp_path / ('metrics' + extension))
+    model = build(**parameters, sink=MetricsSink(path, chunk_size=7, vehicles=True))
+    for _ in range(60):
+        model.step()
+    expected = reference.datacollector.get_model_vars_dataframe().reset_index(drop=True)
+    written = read(path)
+    assert written['Step'].tolist() == list(range(0, 60, 3))
+    assert written.drop(columns='Step').values.tolist() == expected.values.tolist()
+    vehicles = read(path.replace('metrics', 'metrics_vehicles'))
+    assert vehicles.values.tolist() == vehicle_rows
+
+
+# only full chunks are written while running, the rest when closing
+def test_sink_flushes_in_chunks(build, tmp_path):
+    path = str(tmp_path / 'metrics.csv')
+    sink = MetricsSink(path, chunk_size=4)
+    model = build(max_steps=20, seed=1, sink=sink)
+    for _ in range(10):
+        model.step()
+    assert len(pd.read_csv(path)) == 8
+    assert len(sink.model_rows) == 2
+    for _ in range(10):
+        model.step()
+    assert len(pd.read_csv(path)) == 20
+    assert sink.model_writer is None
@@ -0,0 +1,60 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import os
+import random
+
+import numpy as np
+import pytest
+
+from checkpoint import model_state
+from recorder import TrajectoryLog, TrajectoryRecorder, TrajectoryReplay
+
+
+def grid_state(model):
+    vehicles, lights, _ = model_state(model)
+    return np.array(vehicles['position']), np.asarray(lights['time_red_counter']) > 0
+
+
+# every recorded step decodes to the state the model had, in any order
+@pytest.mark.parametrize('engine, scheduler', [('agents', 'base'), ('agents', 'active'), ('vectorized', 'base'),
+                                               ('sharded', 'base')])
+def test_decoded_steps_match_the_run(build, tmp_path, engine, scheduler):
+    parameters = dict(width=40, height=30, max_steps=120, engine=engine, scheduler=scheduler, seed=5,
+                      initial_vehicles=60, third_scenario=engine == 'agents')
+    reference = build(**parameters)
+    states = []
+    for _ in range(120):
+        states.append(grid_state(reference))
+        reference.step()
+    states.append(grid_state(reference))
+
+    path = str(tmp_path / 'run.traj')
+    model = build(**parameters, recorder=TrajectoryRecorder(path, keyframe_interval=16))
+    for _ in range(120):
+        model.step()
+    assert not os.path.exists(path + '.records')
+    log = TrajectoryLog(path)
+    assert len(log) == 121
+    steps = list(range(121))
+    random.Random(1).shuffle(steps)
+    for step in steps + list(range(121)):
+        positions, red = log.state(step)
+        assert np.array_equal(positions, states[step][0]), step
+        assert np.array_equal(red, states[step][1]), step
+
+
+def test_replay_steps_to_the_end(build, tmp_path):
+    path = str(tmp_path / 'run.traj')
+    model = build(max_steps=50, seed=2, recorder=TrajectoryRecorder(path))
+    for _ in range(50):
+        model.step()
+    replay = TrajectoryReplay(path, start_step=45)
+    steps = 0
+    while replay.running:
+        replay.step()
+        steps += 1
+    assert (steps, replay.steps_counter) == (5, 50)
+    with pytest.raises(IndexError):
+        TrajectoryLog(path).state(51)
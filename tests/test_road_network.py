@@ -0,0 +1,114 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from road_network import RoadNetwork, compile_routing, read_map, write_map
+
+# small map, written in every map file format
+MATRIX = np.array([[0, 0, 1, -1],
+                   [3, -1, 1, 2],
+                   [3, 2, 2, 2]], dtype=np.int8)
+
+
+# allowed steps of a cell with the per cell rules compile_routing replaced: not oposite
+# directions, nor adjacent cell that crosses actual one, or same directions, unless actual
+# cell is pointing to it
+def per_cell_steps(model, pos):
+    direction = model.get_direction(pos)
+    # matrix coordinates of actual position, and the cell it is pointing to
+    _, pointed = model.crossing_adjacent([model.height - pos[0] - 1, pos[1]])
+    steps = []
+    for adjacent in model.grid.get_neighborhood(pos, moore=False, include_center=False):
+        adjacent_direction = model.get_direction(adjacent)
+        adjacent_matrix_pos = [model.height - adjacent[0] - 1, adjacent[1]]
+        _, pointed_from_adjacent = model.crossing_adjacent(adjacent_matrix_pos)
+        oposite = (pos[0] + [0, 1, 0, -1][direction], pos[1] + [-1, 0, 1, 0][direction]) == adjacent
+        if not oposite and pointed_from_adjacent != [model.height - pos[0] - 1, pos[1]] and \
+                abs(direction - adjacent_direction) not in (0, 2) or pointed == adjacent_matrix_pos:
+            steps.append(adjacent)
+    return tuple(steps)
+
+
+@pytest.mark.parametrize('seed', range(8))
+@pytest.mark.parametrize('non_transitable_cells', [0, 10, 40])
+def test_compile_routing_matches_per_cell_rules(build, seed, non_transitable_cells):
+    rng = np.random.default_rng(seed)
+    width, height = rng.integers(2, 30, size=2).tolist()
+    model = build(width, height, non_transitable_cells=non_transitable_cells, seed=seed)
+    compiled = compile_routing(model.restriction_matrix)
+    for x in range(height):
+        for y in range(width):
+            crossing, _ = model.crossing_adjacent([height - x - 1, y])
+            assert bool(compiled['crossing_table'][x][y]) == crossing, (x, y)
+            assert model.possible_steps((x, y)) == per_cell_steps(model, (x, y)), (x, y)
+
+
+@pytest.mark.parametrize('name', ['map.npy', 'map.json', 'map.txt'])
+def test_map_formats_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    write_map(path, MATRIX)
+    assert np.array_equal(read_map(path), MATRIX)
+
+
+def test_map_formats_read(tmp_path):
+    (tmp_path / 'digits.txt').write_text('0, 0, 1, -1\n3 -1 1 2\n\n3 2 2 2\n')
+    (tmp_path / 'symbols.map').write_text('>>v#\n^#v<\n^<<<\n')
+    (tmp_path / 'rows.json').write_text(json.dumps(MATRIX.tolist()))
+    for name in ('digits.txt', 'symbols.map', 'rows.json'):
+        assert np.array_equal(read_map(str(tmp_path / name)), MATRIX), name
+
+
+@pytest.mark.parametrize('contents', ['>>v\n^#\n', '0 1 7\n2 3 0\n', '>>x\n>>>\n'])
+def test_malformed_maps(tmp_path, contents):
+    (tmp_path / 'bad.txt').write_text(contents)
+    with pytest.raises(ValueError):
+        read_map(str(tmp_path / 'bad.txt'))
+
+
+def compiled_files(path):
+    cache_dir = os.path.join(os.path.dirname(path), '__mapcache__')
+    return sorted(os.listdir(cache_dir)) if os.path.isdir(cache_dir) else []
+
+
+def test_cache_round_trip(tmp_path):
+    path = str(tmp_path / 'map.txt')
+    write_map(path, MATRIX)
+    first = RoadNetwork(path)
+    assert compiled_files(path) == [first.key + '.compiled']
+    modified = os.path.getmtime(first.cache_path)
+    second = RoadNetwork(path)
+    # the second load reads the cache written by the first one, without compiling again
+    assert second.cache_path == first.cache_path and os.path.getmtime(second.cache_path) == modified
+    assert np.array_equal(second.restriction_matrix, MATRIX)
+    for name, values in compile_routing(MATRIX).items():
+        assert np.array_equal(second.compiled[name], values), name
+
+
+def test_edited_map_is_compiled_again(tmp_path):
+    path = str(tmp_path / 'map.txt')
+    write_map(path, MATRIX)
+    before = RoadNetwork(path)
+    edited = MATRIX.copy()
+    edited[0, 3] = 1
+    write_map(path, edited)
+    after = RoadNetwork(path)
+    assert after.key != before.key
+    assert sorted(compiled_files(path)) == sorted([before.key + '.compiled', after.key + '.compiled'])
+    assert np.array_equal(after.restriction_matrix, edited)
+    assert np.array_equal(after.compiled['successors'], compile_routing(edited)['successors'])
+
+
+def test_model_on_a_map_file(build, tmp_path):
+    path = str(tmp_path / 'map.npy')
+    write_map(path, build(seed=5).restriction_matrix)
+    with_map = build(seed=5, road_network=path)
+    generated = build(seed=5)
+    assert np.array_equal(with_map.restriction_matrix, generated.restriction_matrix)
+    with pytest.raises(ValueError):
+        build(40, 20, road_network=path)
@@ -0,0 +1,25 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import pytest
+
+from checkpoint import model_state
+
+
+# Without non transitable cells no vehicle parks, so ActiveScheduler draws the same than
+# BaseScheduler, and the collected reporters and the state of every vehicle are the same
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('third_scenario', [False, True])
+def test_active_scheduler_matches_base_scheduler(build, seed, third_scenario):
+    runs = {}
+    for scheduler in ('base', 'active'):
+        model = build(40, 30, max_steps=150, non_transitable_cells=0, vehicles=30, third_scenario=third_scenario,
+                      scheduler=scheduler, seed=seed, initial_vehicles=150)
+        for _ in range(150):
+            model.step()
+        vehicles, lights, _ = model_state(model)
+        runs[scheduler] = (model.datacollector.get_model_vars_dataframe().values.tolist(),
+                           {name: values.tolist() for name, values in vehicles.items()},
+                           {name: values.tolist() for name, values in lights.items()})
+    assert runs['active'] == runs['base']
@@ -0,0 +1,48 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import numpy as np
+import pytest
+
+
+# random generator drawing always the same value, so tiles (each one with its own generator)
+# draw the same than a single vectorized engine
+class ConstantGenerator:
+    def __init__(self, value):
+        self.value = value
+        self.bit_generator = np.random.PCG64(0)
+
+    def random(self, size):
+        return np.full(size, self.value)
+
+
+def waiting_times(model, steps):
+    totals = []
+    for _ in range(steps):
+        model.step()
+        totals.append((model.waiting_for_cars, model.waiting_traffic_lights))
+    return totals
+
+
+@pytest.mark.parametrize('seed', range(2))
+@pytest.mark.parametrize('second_scenario, third_scenario', [(False, False), (True, False), (False, True)])
+def test_single_tile_matches_vectorized(build, seed, second_scenario, third_scenario):
+    sharded = build(max_steps=120, second_scenario=second_scenario, third_scenario=third_scenario,
+                    engine='sharded', tiles=(1, 1), seed=seed)
+    vectorized = build(max_steps=120, second_scenario=second_scenario, third_scenario=third_scenario,
+                       engine='vectorized', seed=seed)
+    vectorized.vectorized_engine.rng.bit_generator.state = sharded.vectorized_engine.tiles[0].rng.bit_generator.state
+    assert waiting_times(sharded, 120) == waiting_times(vectorized, 120)
+
+
+# vehicles crossing tile borders, and halo occupancy, give the same moves than a single grid
+@pytest.mark.parametrize('tiles', [(2, 2), (3, 4), (20, 1)])
+@pytest.mark.parametrize('draw', [0.0, 0.6, 0.99])
+def test_sharded_halo_matches_vectorized(build, tiles, draw):
+    sharded = build(31, 20, max_steps=100, vehicles=25, engine='sharded', tiles=tiles, seed=1)
+    vectorized = build(31, 20, max_steps=100, vehicles=25, engine='vectorized', seed=1)
+    for tile in sharded.vectorized_engine.tiles:
+        tile.rng = ConstantGenerator(draw)
+    vectorized.vectorized_engine.rng = ConstantGenerator(draw)
+    assert waiting_times(sharded, 100) == waiting_times(vectorized, 100)
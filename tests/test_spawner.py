@@ -0,0 +1,40 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import pytest
+
+
+
+def waiting_times(model, steps):
+    totals = []
+    for _ in range(steps):
+        model.step()
+        totals.append((model.waiting_for_cars, model.waiting_traffic_lights))
+    return totals
+
+
+# vehicles queued at the entry cells, and let in one per entry cell every step (random spawns,
+# like initial vehicles, are drawn after the engines are set up, so they differ between them)
+@pytest.mark.parametrize('entries', [1, 3])
+def test_sharded_spawns_match_vectorized(build, entries):
+    probe = build(40, 30, vehicles=30, seed=3)
+    entry_cells = [(0, 0)] + [divmod(int(cell), 40) for cell in probe.light_candidates[::97][:entries - 1]]
+    sharded = build(40, 30, vehicles=30, engine='sharded', tiles=(1, 1), seed=3, entry_cells=entry_cells,
+                    spawn_rate=2.5)
+    vectorized = build(40, 30, vehicles=30, engine='vectorized', seed=3, entry_cells=entry_cells, spawn_rate=2.5)
+    vectorized.vectorized_engine.rng.bit_generator.state = sharded.vectorized_engine.tiles[0].rng.bit_generator.state
+    assert waiting_times(sharded, 100) == waiting_times(vectorized, 100)
+    assert sharded.introduced_vehicles == vectorized.introduced_vehicles
+
+
+@pytest.mark.parametrize('engine', ['agents', 'vectorized', 'sharded'])
+def test_spawn_rate(build, engine):
+    model = build(40, 30, vehicles=30, engine=engine, seed=3, spawn_rate=2.5)
+    for _ in range(40):
+        model.step()
+    # 2.5 vehicles arrive per step, and the single entry cell lets one of them in every step
+    assert model.introduced_vehicles == min(40, model.total_amount_vehicles)
+    assert len(model.spawner.pending) == min(100, model.total_amount_vehicles) - model.introduced_vehicles
+    if model.vectorized_engine is not None:
+        model.vectorized_engine.close()
@@ -0,0 +1,29 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+from sweep import make_runs, run_sweep
+
+
+def test_make_runs_expands_only_wrapped_values():
+    runs = make_runs({'width': {'sweep': [20, 25]}, 'height': 15, 'entry_cells': [(0, 0), (1, 1)],
+                      'tiles': (2, 2), 'engine': {'sweep': ['agents', 'vectorized']}}, [0, 1])
+    assert len(runs) == 8
+    assert [(run['width'], run['engine'], run['seed']) for run in runs[:4]] == \
+           [(20, 'agents', 0), (20, 'agents', 1), (20, 'vectorized', 0), (20, 'vectorized', 1)]
+    for run in runs:
+        assert run['height'] == 15
+        assert run['entry_cells'] == [(0, 0), (1, 1)]
+        assert run['tiles'] == (2, 2)
+
+
+def test_run_sweep_rows_keep_sequence_parameters():
+    parameters = {'width': {'sweep': [20, 25]}, 'height': 15, 'max_steps': 10, 'non_transitable_cells': 10,
+                  'vehicles': 5, 'max_waiting_time_non_transitable_in_steps': 2, 'second_scenario': True,
+                  'third_scenario': False, 'entry_cells': [[0, 0]]}
+    results = run_sweep(parameters, [0], processes=1)
+    # a row per collected step, plus the final state, for every run
+    assert len(results) == 2 * 11
+    assert results['RunId'].tolist() == [0] * 11 + [1] * 11
+    assert results['width'].tolist() == [20] * 11 + [25] * 11
+    assert all(value == [[0, 0]] for value in results['entry_cells'])
@@ -0,0 +1,189 @@
+"""
+Author: Enrique Vilchez Campillejo
+"""
+
+import numpy as np
+
+
+# Alternative stepping engine for TrafficModel (engine='vectorized'). Instead of one Python
+# step() per agent, vehicles and traffic lights are stored as NumPy arrays and the whole
+# fleet is advanced with batched array operations. Cells are addressed by their flat grid
+# index, x * width + y, with x counted from bottom to top like in self.grid. Vehicles are
+# not placed on the grid, so only their aggregated metrics are available.
+class VectorizedEngine:
+
+    def __init__(self, model, seed=None):
+        self.model = model
+        self.width = model.width
+        self.height = model.height
+        self.n_cells = model.width * model.height
+        if seed is None:
+            seed = model.random.getrandbits(64)
+        self.rng = np.random.default_rng(seed)
+
+        # static layer: transitable cells, and the compiled routing table
+        self.transitable = (np.array(model.restriction_matrix, dtype=np.int8)[::-1] != -1).reshape(-1)
+        self.successors = model.successors
+        self.successors_count = model.successors_count
+
+        # traffic lights, taken from the ones set by set_traffic_lights (their state columns)
+        lights = model.traffic_light_state
+        self.light_cell = lights.column('position').astype(np.int64)
+        self.time_green = lights.column('time_green').astype(np.int64)
+        self.time_red = lights.column('time_red').astype(np.int64)
+        self.time_green_counter = lights.column('time_green_counter').astype(np.int64)
+        self.time_red_counter = lights.column('time_red_counter').astype(np.int64)
+        self.light_at_cell = np.full(self.n_cells, -1, dtype=np.int64)
+        self.light_at_cell[self.light_cell] = np.arange(len(lights))
+        # cells watched by the light controller (see light_controllers), compiled by the model
+        self.watched = model.light_watched
+
+        # vehicles, -1 position means not introduced in the grid yet
+        n = model.total_amount_vehicles
+        self.position = np.full(n, -1, dtype=np.int64)
+        self.waiting_for_cars = np.zeros(n, dtype=np.int64)
+        self.waiting_traffic_lights = np.zeros(n, dtype=np.int64)
+        self.counter_parking = np.full(n, model.max_waiting_time_non_transitable_in_steps, dtype=np.int64)
+        self.parking = np.zeros(n, dtype=bool)
+        self.next_vehicle = 0
+        # vehicles are not placed on the grid, but share its occupancy counters
+        self.occupancy = model.grid.vehicle_count
+
+    def cell_index(self, pos):
+        return pos[0] * self.width + pos[1]
+
+    def light_state(self):
+        return self.time_red_counter == 0  # True is green, False is red
+
+    def step_traffic_lights(self):
+        self.model.light_controller.step(self, self.watched, self.occupancy)
+
+    # moves the vehicles in candidates (sorted by vehicle index) to targets, when target is
+    # free. When several vehicles target the same cell, the one introduced first wins, which
+    # is the order BaseScheduler would have stepped them. Returns the mask of moved vehicles
+    def resolve_moves(self, candidates, targets):
+        free = self.occupancy[targets] == 0
+        _, first = np.unique(targets[free], return_index=True)
+        moved = np.zeros(len(candidates), dtype=bool)
+        moved[np.flatnonzero(free)[first]] = True
+        winners = candidates[moved]
+        heatmap = self.model.heatmap
+        if heatmap is not None:
+            heatmap.touch(np.unique(np.concatenate((self.position[winners], targets[moved]))))
+        np.subtract.at(self.occupancy, self.position[winners], 1)
+        self.position[winners] = targets[moved]
+        self.occupancy[targets[moved]] += 1
+        return moved
+
+    def step_vehicles(self):
+        active = np.flatnonzero(self.position >= 0)
+        light = self.light_at_cell[self.position[active]]
+        red = light >= 0
+        red[red] = ~self.light_state()[light[red]]
+        self.waiting_traffic_lights[active[red]] += 1
+        self.model.waiting_traffic_lights += int(red.sum())
+        heatmap = self.model.heatmap
+        if heatmap is not None:
+            np.add.at(heatmap.red_light, self.position[active[red]], 1)
+
+        movers = active[~red]
+        pos = self.position[movers]
+        count = self.successors_count[pos]
+        movers, pos, count = movers[count > 0], pos[count > 0], count[count > 0]
+        choice = (self.rng.random(len(movers)) * count).astype(np.int64)
+        target = self.successors[pos, choice]
+
+        # same parking rule as VehicleAgent.move, for vehicles facing a non transitable cell
+        driving = self.transitable[target] & ~self.parking[movers]
+        parkers = movers[~driving]
+        counting = parkers[self.counter_parking[parkers] > 0]
+        resetting = parkers[self.counter_parking[parkers] == 0]
+        parking_events = np.count_nonzero(~self.parking[counting])
+        if heatmap is not None:
+            np.add.at(heatmap.parking, self.position[counting[~self.parking[counting]]], 1)
+        self.counter_parking[counting] -= 1
+        self.parking[counting] = True
+        self.counter_parking[resetting] = self.model.max_waiting_time_non_transitable_in_steps
+        self.parking[resetting] = False
+
+        drivers, pos, count, choice = movers[driving], pos[driving], count[driving], choice[driving]
+        blocked = ~self.resolve_moves(drivers, target[driving])
+        first_blocked = np.count_nonzero(blocked)
+        if self.model.second_scenario:
+            # blocked vehicles try the rest of their options, in routing table order
+            for k in range(self.successors.shape[1]):
+                trying = blocked & (k < count) & (k != choice)
+                alternative = self.successors[pos[trying], k]
+                usable = self.transitable[alternative]
+                candidates = np.flatnonzero(trying)[usable]
+                moved = self.resolve_moves(drivers[candidates], alternative[usable])
+                blocked[candidates[moved]] = False
+        self.waiting_for_cars[drivers[blocked]] += 1
+        self.model.waiting_for_cars += int(blocked.sum())
+        if heatmap is not None:
+            np.add.at(heatmap.blocked, self.position[drivers[blocked]], 1)
+
+        instrumentation = self.model.instrumentation
+        if instrumentation is not None:
+            still_blocked = int(np.count_nonzero(blocked))
+            instrumentation.count('moves', len(drivers) - still_blocked)
+            instrumentation.count('detours', int(first_blocked) - still_blocked)
+            instrumentation.count('blocked_moves', still_blocked)
+            instrumentation.count('red_light_waits', int(np.count_nonzero(red)))
+            instrumentation.count('parking_events', int(parking_events))
+
+    # introduces new vehicles in the grid, at the given cells (see spawner.Spawner)
+    def spawn(self, cells):
+        spawned = slice(self.next_vehicle, self.next_vehicle + len(cells))
+        self.position[spawned] = cells
+        if self.model.heatmap is not None:
+            self.model.heatmap.touch(np.unique(cells))
+        np.add.at(self.occupancy, self.position[spawned], 1)
+        self.next_vehicle += len(cells)
+
+    # vehicle indexes of the vehicles introduced in the grid, and their waiting counters
+    def vehicle_waiting_times(self):
+        entered = np.flatnonzero(self.position >= 0)
+        return entered, self.waiting_for_cars[entered], self.waiting_traffic_lights[entered]
+
+    # state of the vehicles introduced in the grid (in the order they were introduced) and of
+    # the traffic light counters, in the same form for every engine (see checkpoint), and the
+    # state of the random number generator
+    def state(self):
+        n = self.next_vehicle
+        vehicles = {name: getattr(self, name)[:n] for name in
+                    ('position', 'waiting_for_cars', 'waiting_traffic_lights', 'counter_parking', 'parking')}
+        lights = {'time_green_counter': self.time_green_counter, 'time_red_counter': self.time_red_counter}
+        return vehicles, lights, self.rng.bit_generator.state
+
+    def load_state(self, vehicles, lights, random_state=None):
+        n = len(vehicles['position'])
+        for name, values in vehicles.items():
+            getattr(self, name)[:n] = values
+        self.next_vehicle = n
+        heatmap = self.model.heatmap
+        if heatmap is not None:
+            heatmap.touch(np.arange(len(self.occupancy)))
+        self.occupancy[:] = 0
+        np.add.at(self.occupancy, self.position[:n], 1)
+        self.time_green_counter[:] = lights['time_green_counter']
+        self.time_red_counter[:] = lights['time_red_counter']
+        if random_state is not None:
+            self.rng.bit_generator.state = random_state
+
+    # nothing to release, processes of ShardedEngine are stopped here
+    def close(self):
+        pass
+
+    # same order than BaseScheduler: traffic lights (added first), and vehicles (new vehicles are
+    # introduced afterwards by the model, see TrafficModel.introduce)
+    def step(self):
+        instrumentation = self.model.instrumentation
+        if instrumentation is None:
+            self.step_traffic_lights()
+            self.step_vehicles()
+        else:
+            with instrumentation.timer('traffic_lights'):
+                self.step_traffic_lights()
+            with instrumentation.timer('vehicles'):
+                self.step_vehicles()